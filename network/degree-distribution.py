@@ -1,29 +1,23 @@
+import numpy as np
 import pandas as pd
-import networkx as nx
+import scipy.sparse as sp
 import matplotlib.pyplot as plt
-from collections import Counter
 
 # Load your dataset
-df = pd.read_csv('/home/user/IRTify/network/2024-11-24T23-18_export.csv')
+df = pd.read_csv('/home/user/IRTify/network/2024-11-24T23-18_export.csv', index_col=0)
 
+# Student x question biadjacency matrix of the correct answers (item columns between student_id and Score)
+items = df.drop(columns=['student_id', 'Score'], errors='ignore')
+answers = sp.csr_matrix(items.to_numpy() == 1, dtype=np.int64)
 
-# Initialize a graph
-G = nx.Graph()
-
-# Add edges from the DataFrame
-for _, row in df.iterrows():
-    student_id = row['student_id']
-    for question_id in row.index[1:]:  # Skip 'student_id' column
-        if row[question_id] == 1:
-            G.add_edge(student_id, question_id)
-
-# Calculate the degree of each node
-degrees = [degree for _, degree in G.degree()]
+# Degrees of the students (row sums) and of the questions (column sums)
+degrees = np.concatenate([np.asarray(answers.sum(axis=1)).ravel(), np.asarray(answers.sum(axis=0)).ravel()])
+degrees = degrees[degrees > 0]  # Nodes without edges are not part of the graph
 
 # Calculate frequency of each degree
-degree_counts = Counter(degrees)
-x = list(degree_counts.keys())  # Degree values
-y = list(degree_counts.values())  # Frequencies
+degree_counts = np.bincount(degrees)
+x = np.flatnonzero(degree_counts)  # Degree values
+y = degree_counts[x]  # Frequencies
 
 # Create scatter plot
 plt.figure(figsize=(10, 6))
@@ -37,4 +31,4 @@ plt.grid(alpha=0.5, linestyle='--')
 plt.savefig('degree_distribution_scatter.png', dpi=300, bbox_inches='tight')  # Save with high resolution
 
 # Optional: Close the plot to free up memory
-plt.close()
\ No newline at end of file
+plt.close()
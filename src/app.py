@@ -4,34 +4,21 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import cv2
 import numpy as np
+import zipfile
+from io import BytesIO
+from omr import read_bubbles, scan_batch, write_answer_sheet, parse_key, scan_folder, OPTION_LABELS, SCAN_ROOT
 
 def process_image(image):
     # Convert image to grayscale
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    
-    # Apply thresholding
-    _, thresh = cv2.threshold(gray, 150, 255, cv2.THRESH_BINARY_INV)
-
-    # Detect contours
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Process each contour to extract information
-    data = []
-    for contour in contours:
-        x, y, w, h = cv2.boundingRect(contour)
-        if w > 50 and h > 50:  # Assuming a minimum size for bubbles
-            # Extract the region of interest (ROI)
-            roi = thresh[y:y+h, x:x+w]
-            # Analyze the ROI to determine if a bubble is filled
-            filled = np.mean(roi) > 127  # Adjust this threshold based on your needs
-            data.append((x, y, filled))
 
-    # Sort data by x and y coordinates to match the answer sheet layout
-    data.sort(key=lambda k: (k[1], k[0]))
+    # Find the bubbles and the share of dark pixels in each
+    boxes, fill = read_bubbles(gray)
+    filled = fill > 0.3  # Adjust this threshold based on your needs
 
-    # Convert data to DataFrame
-    student_data = pd.DataFrame(data, columns=['x', 'y', 'filled'])
-    return student_data
+    # Sort data by x and y coordinates to match the answer sheet layout
+    student_data = pd.DataFrame({'x': boxes[:, 0], 'y': boxes[:, 1], 'filled': filled})
+    return student_data.sort_values(['y', 'x'], ignore_index=True)
 
 # Title and subtitle of the app
 st.title("IRTify")
@@ -67,6 +54,36 @@ if uploaded_image is not None:
 else:
     st.write("Please upload an answer sheet image to process and extract data.")
 
+# Batch scanning of a whole exam session into the answer sheet CSV of the analysis app
+st.subheader("Batch Scanning")
+scans_zip = st.file_uploader("Upload a zip archive of scanned answer sheets (named by student ID)", type=["zip"])
+# Only folders inside the configured scan root can be read from the server
+scans_folder = st.text_input("Or scan a folder of the server's scan directory") if SCAN_ROOT else ""
+n_options = st.number_input("Options per question", min_value=2, max_value=len(OPTION_LABELS), value=4)
+orientation = st.selectbox("Question layout", ["columns", "rows"], format_func=lambda o: {"columns": "One question per column", "rows": "One question per row"}[o])
+key = st.text_input("Answer key (e.g. cbaad... or c, b, a, a, d; leave empty to read the scan named 'key')")
+output_format = st.selectbox("Output format", ["csv", "parquet"])
+
+scan_source = scans_zip if scans_zip is not None else scans_folder or None
+if scan_source is not None and st.button("Scan Answer Sheets"):
+    progress_text = "Scanning answer sheets. Please wait."
+    scan_bar = st.progress(0, text=progress_text)
+    try:
+        if scans_zip is None:
+            scan_source = scan_folder(scans_folder)
+        sheet_df = scan_batch(scan_source, key=parse_key(key, n_options) or None, n_options=n_options, orientation=orientation,
+                              on_progress=lambda done, total: scan_bar.progress(done / total, text=progress_text))
+    except (ValueError, OSError, zipfile.BadZipFile) as e:
+        st.error(f"Could not scan the answer sheets: {e}")
+    else:
+        st.write(f"Scanned {len(sheet_df) - 2} answer sheets.")
+        for name, error in sheet_df.attrs['errors'].items():
+            st.warning(f"Could not scan {name}: {error}")
+        buffer = BytesIO()
+        write_answer_sheet(sheet_df, buffer, fmt=output_format)
+        st.download_button("Download Answer Sheet", buffer.getvalue(), file_name=f"answer-data.{output_format}")
+    scan_bar.empty()
+
 # File uploader
 uploaded_file = st.file_uploader("Upload your CSV file", type=["csv"])
 
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "irtify"))
+CACHE_MAX_MB = float(os.getenv("ANALYSIS_CACHE_MAX_MB", "1024"))
+# Part of every key; bump it whenever a cached class or result layout changes so old pickles are never read
+CACHE_VERSION = 2
+TEMP_MAX_AGE = 3600  # Seconds after which a temporary file is taken to belong to a writer that died
+_MISSING = object()
+
+def content_hash(data):
+    """SHA-256 hex digest of uploaded bytes (or of a str)."""
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+def cache_key(*parts):
+    """Key of an analysis result: a hash over the cache version, content hashes and parameters that determine it."""
+    return content_hash(repr((CACHE_VERSION,) + parts))
+
+class DiskCache:
+    """
+    Content-addressed store of pickled analysis results shared by every session on this machine.
+
+    Entries are files named after their key. Reading an entry refreshes its modification time and
+    the least recently used entries are evicted once the store grows beyond max_bytes. Writes go
+    through a temporary file and an atomic rename, so concurrent sessions never read partial entries.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_MB * 1024 ** 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def get(self, key, default=None):
+        """Cached value of key, or default when it is missing or can no longer be unpickled (which evicts it)."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return default
+        except Exception:
+            # Truncated files and pickles of classes that changed or moved since they were written
+            self._remove(path)
+            return default
+        try:
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            pass  # Evicted by another session meanwhile
+        return value
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Already evicted by another session
+
+    def put(self, key, value):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            self._remove(temp_path)  # Unpicklable value or full disk: no orphan temporary file
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the store fits in max_bytes.
+
+        Temporary files of writers that died mid-write (older than TEMP_MAX_AGE) are removed too.
+        Entries evicted or replaced by another session meanwhile are skipped.
+        """
+        entries, now = [], time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith('.pkl'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                elif entry.name.endswith('.tmp') and now - entry.stat().st_mtime > TEMP_MAX_AGE:
+                    self._remove(entry.path)
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def get_or_compute(self, key, compute):
+        """Return the cached result for key, computing and storing it on a miss."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+_default_cache = None
+
+def get_cache():
+    """The process-wide DiskCache in CACHE_DIR."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DiskCache()
+    return _default_cache
+
+def cached(namespace, parts, compute):
+    """Look up (or compute and store) the result of an analysis identified by a namespace and key parts."""
+    return get_cache().get_or_compute(cache_key(namespace, *parts), compute)
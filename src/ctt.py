@@ -1,53 +1,46 @@
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import streamlit as st
-from scipy.stats import pearsonr
+from figures import render_many, paginate, as_tuple
+from response_matrix import BLOCK_ROWS
 
-def create_ctt_report(df):
-    # Assuming the first row contains the correct answers
-    correct_answers = df.iloc[1]
-    students_answers_df = df.iloc[2:]
-    ctt_metrics = calculate_ctt_metrics(df)
+def create_ctt_report(responses, ctt_metrics=None, distractor_metrics=None):
+    if ctt_metrics is None:
+        ctt_metrics = calculate_ctt_metrics(responses)
+    if distractor_metrics is None:
+        distractor_metrics = calculate_distractor_metrics(responses)
 
     report = []
+    st.metric("Cronbach's Alpha", f"{ctt_metrics.attrs['cronbachs-alpha']:.3f}")
     
-    # Extract all unique options from the dataset (excluding the first column)
-    all_options = sorted(df.iloc[2:].stack().unique())
+    # Count every option of every item in one pass over the encoded responses
+    all_options = tuple(responses.option_labels)
+    option_counts = responses.option_counts()[:, 1:]  # Drop the blank column
+
+    # Render the histograms of the current page in parallel; unchanged items come from the cache
+    page = paginate(responses.n_items, key='ctt_page')
+    images = render_many([
+        ('option_bars', (f'Question: {responses.item_labels[item]}', all_options, as_tuple(option_counts[item]), int(responses.key[item]) - 1))
+        for item in page
+    ])
     
-    # Generate a histogram for each question
-    for col in students_answers_df.columns:
+    # Show a histogram for each question
+    for item, image in zip(page, images):
+        col = responses.item_labels[item]
         # Initialize the layout: two columns
         col1, col2 = st.columns(2)
 
-        # Plot the histogram in the left column
+        # Show the histogram in the left column, the correct answer is highlighted in red
         with col1:
-            fig, ax = plt.subplots(figsize=(8, 6))
-            
-            # Count the answers, including missing categories
-            answers = students_answers_df[col].value_counts().reindex(all_options, fill_value=0)
-            
-            sns.barplot(x=answers.index, y=answers.values, ax=ax, palette="viridis")
-
-            # Highlight the correct answer
-            correct_answer = correct_answers[col]
-            if correct_answer in all_options:
-                ax.bar(all_options.index(correct_answer), answers[correct_answer], color='red', alpha=0.7, label='Correct Answer')
-
-            ax.set_title(f'Question: {col}')
-            ax.set_xlabel('Answer')
-            ax.set_ylabel('Number of Responses')
-            ax.set_xticks(range(len(all_options)))
-            ax.set_xticklabels(all_options)
-            ax.legend()
-
-            st.pyplot(fig)
+            st.image(image)
 
         # Display the data for this item in the right column
         with col2:
             st.subheader(f'CTT Metrics for {col}')
             question_metrics = ctt_metrics[ctt_metrics['question_number'] == col]
-            st.table(question_metrics[['difficulty-rate', 'discrimination-rate', 'cronbachs-alpha']])
+            st.table(question_metrics[['difficulty-rate', 'discrimination-rate', 'point-biserial', 'item-rest-correlation', 'alpha-if-deleted']])
+            st.write('Distractor Analysis')
+            st.table(distractor_metrics[distractor_metrics['question_number'] == col].drop(columns=['question_number']))
     return report
 
 # import pandas as pd
@@ -55,45 +48,176 @@ def create_ctt_report(df):
 # import seaborn as sns
 # import streamlit as st
 
-def calculate_difficulty_rate(responses, correct_answer):
-    """Calculates the difficulty rate for a given question."""
-    return (responses == correct_answer).mean()
+def accumulate_ctt_statistics(responses, block_rows=BLOCK_ROWS):
+    """
+    Sufficient statistics of the CTT metrics, accumulated over blocks of examinees and merged by summation.
+
+    Works the same on an in-memory ResponseMatrix and on a memory-mapped MappedResponses, so
+    memory stays bounded by one block plus a few items x items matrices. Returns the pairwise
+    answered counts (n), sums of item i over the students who answered item j (sums), cross
+    products (products) and the correct and answered counts of the upper score group.
+    """
+    # Proportion correct over answered items ranks students like the raw score on complete data
+    scores = responses.proportion_correct
+    upper_cut = np.median(scores)
+    n_items = responses.n_items
+    statistics = {name: np.zeros((n_items, n_items)) for name in ('n', 'sums', 'products')}
+    statistics.update({name: np.zeros(n_items) for name in ('upper_correct', 'upper_valid')})
+
+    for rows, correct, valid in responses.blocks(block_rows):
+        # float32 products are exact for the counts of a single block
+        item_scores = correct.astype(np.float32)
+        answered = valid.astype(np.float32)
+        upper = scores[rows] >= upper_cut
+        block = {
+            'n': answered.T @ answered,
+            'sums': item_scores.T @ answered,
+            'products': item_scores.T @ item_scores,
+            'upper_correct': item_scores[upper].sum(axis=0),
+            'upper_valid': answered[upper].sum(axis=0)
+        }
+        for name, value in block.items():
+            statistics[name] += value
+    return statistics
+
+def item_covariance(statistics):
+    """
+    Covariance matrix of the 0/1 item scores from the accumulated statistics.
+
+    With missing responses every entry uses the students who answered both items (pairwise deletion).
+    """
+    n, sums = statistics['n'], statistics['sums']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (statistics['products'] - sums * sums.T / n) / (n - 1)
+
+def calculate_difficulty_rate(statistics):
+    """Calculates the difficulty rate for every question, over the students who answered it."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.diag(statistics['sums']) / np.diag(statistics['n'])
+
+def calculate_discrimination_rate(statistics):
+    """Calculates the upper-lower (median split) discrimination rate for every question."""
+    lower_correct = np.diag(statistics['sums']) - statistics['upper_correct']
+    lower_valid = np.diag(statistics['n']) - statistics['upper_valid']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return statistics['upper_correct'] / statistics['upper_valid'] - lower_correct / lower_valid
 
-def calculate_discrimination_rate(responses, correct_answer, scores):
-    """Calculates the discrimination rate for a given question."""
-    upper_group = responses[scores >= scores.median()]
-    lower_group = responses[scores < scores.median()]
-    return (upper_group == correct_answer).mean() - (lower_group == correct_answer).mean()
+def calculate_reliability(covariance):
+    """
+    Cronbach's alpha of the test plus the point-biserial, corrected item-rest correlation and
+    alpha-if-item-deleted of every question, all derived from the item covariance matrix.
+    """
+    n_items = len(covariance)
+    covariance = np.nan_to_num(covariance)
+    item_variance = np.diag(covariance)
+    # Covariance of each item with the total score, and variance of the total score
+    item_total = covariance.sum(axis=1)
+    total_variance = item_total.sum()
+    rest_variance = total_variance - 2 * item_total + item_variance
 
-def calculate_cronbach_alpha(responses, correct_answer, scores):
-    """Calculates Cronbach's alpha for a given question."""
-    item_scores = (responses == correct_answer).astype(int)
-    return pearsonr(item_scores, scores)[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        alpha = n_items / (n_items - 1) * (1 - item_variance.sum() / total_variance)
+        point_biserial = item_total / np.sqrt(item_variance * total_variance)
+        item_rest = (item_total - item_variance) / np.sqrt(item_variance * rest_variance)
+        alpha_if_deleted = (n_items - 1) / (n_items - 2) * (1 - (item_variance.sum() - item_variance) / rest_variance)
+    return alpha, point_biserial, item_rest, alpha_if_deleted
 
-def calculate_ctt_metrics(df):
-    """Calculates all CTT metrics for each question in the dataset."""
-    correct_answers = df.iloc[1]
-    students_answers_df = df.iloc[2:]
-    scores = (students_answers_df == correct_answers).sum(axis=1)
+def calculate_ctt_metrics(responses):
+    """
+    Calculates all CTT metrics for each question in the dataset.
+
+    Cronbach's alpha of the whole test and the number of students with each summed score are
+    stored in the 'cronbachs-alpha' and 'score-distribution' entries of the returned DataFrame's attrs.
+    """
+    statistics = accumulate_ctt_statistics(responses)
+    alpha, point_biserial, item_rest, alpha_if_deleted = calculate_reliability(item_covariance(statistics))
 
     metrics = {
-        'question_number': [],
-        'difficulty-rate': [],
-        'discrimination-rate': [],
-        'cronbachs-alpha': []
+        'question_number': responses.item_labels,
+        'difficulty-rate': calculate_difficulty_rate(statistics),
+        'discrimination-rate': calculate_discrimination_rate(statistics),
+        'point-biserial': point_biserial,
+        'item-rest-correlation': item_rest,
+        'alpha-if-deleted': alpha_if_deleted
     }
-    
-    for col in students_answers_df.columns:
-        
-        correct_answer = correct_answers[col]
-        responses = students_answers_df[col]
-        
-        metrics['difficulty-rate'].append(calculate_difficulty_rate(responses, correct_answer))
-        metrics['discrimination-rate'].append(calculate_discrimination_rate(responses, correct_answer, scores))
-        metrics['cronbachs-alpha'].append(calculate_cronbach_alpha(responses, correct_answer, scores))
-        metrics['question_number'].append(col)
-
-    return pd.DataFrame(metrics)
+
+    metrics_df = pd.DataFrame(metrics)
+    metrics_df.attrs['cronbachs-alpha'] = alpha
+    metrics_df.attrs['score-distribution'] = np.bincount(responses.scores, minlength=responses.n_items + 1)
+    return metrics_df
+
+def score_groups(scores, n_groups=5):
+    """Assign every student to a score quantile group (0 = lowest); tied scores share a group."""
+    edges = np.quantile(scores, np.linspace(0, 1, n_groups + 1)[1:-1])
+    return np.searchsorted(edges, scores, side='right')
+
+def distractor_counts(responses, groups, n_groups, block_rows=BLOCK_ROWS):
+    """
+    Count tensor (items x options + 1 x groups) of every option chosen in every score group,
+    plus the sum of the students' scores per item and option, from one bincount per block of rows.
+
+    Option code 0 (blank) is kept in the first slot of the option axis.
+    """
+    width = responses.n_options + 1
+    cells = responses.n_items * width * n_groups
+    offsets = np.arange(responses.n_items, dtype=np.int64) * width
+    scores = responses.proportion_correct
+    counts = np.zeros(cells, dtype=np.int64)
+    score_sums = np.zeros(responses.n_items * width)
+    for start in range(0, responses.n_examinees, block_rows):
+        rows = slice(start, start + block_rows)
+        item_options = responses.codes[rows] + offsets
+        flat = (item_options * n_groups + groups[rows, None]).ravel()
+        counts += np.bincount(flat, minlength=cells)
+        score_sums += np.bincount(item_options.ravel(), weights=np.repeat(scores[rows], responses.n_items),
+                                  minlength=len(score_sums))
+    return counts.reshape(responses.n_items, width, n_groups), score_sums.reshape(responses.n_items, width)
+
+def calculate_distractor_metrics(responses, n_groups=5, min_proportion=0.05):
+    """
+    Distractor analysis of every option of every question.
+
+    Parameters:
+    - responses: ResponseMatrix with the encoded student responses.
+    - n_groups: Number of score quantile groups used for the option trace table.
+    - min_proportion: Share of students a distractor must attract to count as functional.
+
+    Returns:
+    - A DataFrame with one row per question and option: count, proportion, point-biserial with the
+      score, whether the option is the key, whether a distractor is functional (chosen by at least
+      min_proportion of the students and negatively correlated with the score) and the proportion
+      of every score group choosing it.
+    """
+    scores = responses.proportion_correct
+    groups = score_groups(scores, n_groups)
+    counts, score_sums = distractor_counts(responses, groups, n_groups)
+    n_examinees = responses.n_examinees
+
+    option_totals = counts.sum(axis=2)
+    proportion = option_totals / n_examinees
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # r_pb = (M_option - M) / s * sqrt(p / (1 - p)), from the per-option score sums
+        option_mean = score_sums / option_totals
+        point_biserial = (option_mean - scores.mean()) / scores.std() * np.sqrt(proportion / (1 - proportion))
+        group_proportion = counts / np.bincount(groups, minlength=n_groups)
+
+    option_codes = np.arange(responses.n_options + 1)
+    is_key = option_codes == responses.key[:, None]
+    is_distractor = ~is_key & (option_codes != 0)
+    metrics_df = pd.DataFrame({
+        'question_number': np.repeat(responses.item_labels, responses.n_options + 1),
+        'option': np.tile(['(blank)'] + responses.option_labels, responses.n_items),
+        'is-key': is_key.ravel(),
+        'count': option_totals.ravel(),
+        'proportion': proportion.ravel(),
+        'point-biserial': point_biserial.ravel(),
+        'functional': (is_distractor & (proportion >= min_proportion) & (point_biserial < 0)).ravel()
+    })
+    for g in range(n_groups):
+        metrics_df[f'group-{g + 1}'] = group_proportion[:, :, g].ravel()
+
+    # Options nobody chose are not part of the question
+    return metrics_df[metrics_df['count'] > 0].reset_index(drop=True)
 
 # def create_ctt_report(df):
 #     """Generates the CTT report with histograms and metrics."""
@@ -1,138 +1,470 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+from scipy import sparse
 from scipy.stats import chi2
 import streamlit as st
-from irt import calculate_irt_metrics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from irt import calibrate, calibrate_groups
+from figures import render_many, paginate
 
-def create_dif_report(answer_df, student_info_df, group_column):
+MATCHING = ('rest', 'total', 'theta')
+
+def align_groups(responses, student_info_df, group_column, positions=None):
     """
-    Perform Differential Item Functioning (DIF) analysis based on a specified group column.
-    
+    Group of every row of the response matrix for one column of the student info CSV.
+
+    positions (the response-matrix row of every student info row) can be passed to avoid
+    re-matching IDs for each column. Returns integer group codes (-1 for students without a
+    group) and the group labels, ordered from the largest to the smallest group.
+    """
+    if group_column not in student_info_df.columns:
+        raise ValueError(f"The specified group column '{group_column}' does not exist in the student info data.")
+    if positions is None:
+        positions = responses.positions(student_info_df['student_id'])
+
+    info_codes, labels = pd.factorize(student_info_df[group_column])
+    matched = (positions >= 0) & (info_codes >= 0)
+
+    # Largest group first, it becomes the default reference
+    sizes = np.bincount(info_codes[matched], minlength=len(labels))
+    order = np.argsort(-sizes, kind='stable')
+    order = order[sizes[order] > 0]
+    remap = np.full(len(labels), -1)
+    remap[order] = np.arange(len(order))
+
+    # Reversed assignment keeps the first row of a student ID listed more than once
+    group_codes = np.full(responses.n_examinees, -1)
+    group_codes[positions[matched][::-1]] = remap[info_codes[matched]][::-1]
+    return group_codes, [labels[g] for g in order]
+
+def matching_strata(responses, matching='rest', abilities=None, n_strata=20):
+    """
+    Matching stratum of every examinee, used to compare groups at equal ability.
+
+    - 'rest' and 'total': number correct on the test (rest scores are derived from it per item).
+    - 'theta': IRT ability estimates (abilities) grouped into n_strata quantile bins.
+
+    Returns the stratum of each examinee and the number of strata.
+    """
+    if matching not in MATCHING:
+        raise ValueError(f"Unknown matching criterion '{matching}'. Choose one of {', '.join(MATCHING)}.")
+
+    if matching == 'theta':
+        if abilities is None:
+            raise ValueError("Matching on theta requires ability estimates.")
+        edges = np.unique(np.quantile(abilities, np.linspace(0, 1, n_strata + 1)[1:-1]))
+        return np.searchsorted(edges, abilities, side='right'), len(edges) + 1
+
+    return responses.scores, responses.n_items + 1
+
+def contingency_counts(responses, group_codes, n_groups, strata, n_strata, rest=False):
+    """
+    Count examinees per group, item, matching stratum and correctness.
+
+    All items are counted at once as a sparse (group, stratum) one-hot matrix times the
+    correctness matrix. With rest=True the strata are total scores and are converted to rest
+    scores: a right answer at total t sits at rest t - 1, a wrong answer stays at rest t.
+
+    Returns an int array of shape (groups x items x strata x 2), the last axis being (wrong, right).
+    Missing responses and students without a group are not counted.
+    """
+    rows = np.flatnonzero(group_codes >= 0)
+    cells = group_codes[rows].astype(np.int64) * n_strata + strata[rows]
+    one_hot = sparse.csc_matrix((np.ones(len(rows), dtype=np.float32), (cells, rows)),
+                                shape=(n_groups * n_strata, responses.n_examinees))
+
+    # Accumulated over row blocks, so the correctness matrix is never materialized whole
+    right = np.zeros((n_groups * n_strata, responses.n_items), dtype=np.int64)
+    answered = np.zeros_like(right)
+    for block, correct, valid in responses.blocks():
+        right += np.rint(one_hot[:, block] @ correct.view(np.uint8)).astype(np.int64)
+        if responses.has_missing:
+            answered += np.rint(one_hot[:, block] @ np.ascontiguousarray(valid).view(np.uint8)).astype(np.int64)
+    if not responses.has_missing:
+        answered = np.bincount(cells, minlength=n_groups * n_strata)[:, None]
+
+    answered = np.broadcast_to(answered, right.shape)
+    right = right.reshape(n_groups, n_strata, -1).transpose(0, 2, 1)
+    wrong = answered.reshape(n_groups, n_strata, -1).transpose(0, 2, 1) - right
+    if rest:
+        right, wrong = right[..., 1:], wrong[..., :-1]
+    return np.stack([wrong, right], axis=-1)
+
+def mantel_haenszel(reference_counts, focal_counts):
+    """
+    Mantel-Haenszel DIF statistics for every item (and focal group) at once.
+
+    Both arguments are (... x items x strata x 2) contingency counts. Returns a dict of arrays with
+    the common odds ratio, the ETS delta (MH D-DIF), its standard error, the MH chi-square
+    (with continuity correction), its p-value and the ETS A/B/C classification.
+    """
+    A = reference_counts[..., 1].astype(float)  # Reference right
+    B = reference_counts[..., 0].astype(float)  # Reference wrong
+    C = focal_counts[..., 1].astype(float)      # Focal right
+    D = focal_counts[..., 0].astype(float)      # Focal wrong
+    N = A + B + C + D
+    n_reference, n_focal = A + B, C + D
+    right, wrong = A + C, B + D
+
+    # Strata with fewer than two examinees, or without one of the groups, carry no information
+    informative = (N > 1) & (n_reference > 0) & (n_focal > 0)
+    N_safe = np.where(informative, N, 1)
+    N_minus_one = np.where(informative, N - 1, 1)
+
+    R = np.where(informative, A * D / N_safe, 0).sum(axis=-1)
+    S = np.where(informative, B * C / N_safe, 0).sum(axis=-1)
+    P = (A + D) / N_safe
+    Q = (B + C) / N_safe
+    with np.errstate(invalid='ignore', divide='ignore'):
+        alpha = R / S
+        delta = -2.35 * np.log(alpha)
+
+        # Robins-Breslow-Greenland variance of log(alpha)
+        variance = (np.where(informative, P * A * D / N_safe, 0).sum(axis=-1) / (2 * R ** 2)
+                    + np.where(informative, (P * B * C + Q * A * D) / N_safe, 0).sum(axis=-1) / (2 * R * S)
+                    + np.where(informative, Q * B * C / N_safe, 0).sum(axis=-1) / (2 * S ** 2))
+        delta_se = 2.35 * np.sqrt(variance)
+
+        expected_A = np.where(informative, n_reference * right / N_safe, 0).sum(axis=-1)
+        variance_A = np.where(informative, n_reference * n_focal * right * wrong / (N_safe ** 2 * N_minus_one), 0).sum(axis=-1)
+        chi_square = (np.abs(np.where(informative, A, 0).sum(axis=-1) - expected_A) - 0.5).clip(min=0) ** 2 / variance_A
+    p_value = chi2.sf(chi_square, 1)
+
+    # ETS rules: C is large and significantly above 1 delta unit, A is small or not significant
+    abs_delta = np.abs(delta)
+    ets_class = np.where((abs_delta >= 1.5) & ((abs_delta - 1) / delta_se > 1.96), 'C',
+                         np.where((abs_delta < 1) | ~(p_value < 0.05), 'A', 'B'))
+    ets_class = np.where(np.isnan(delta), 'A', ets_class)
+
+    return {
+        'MH Alpha': alpha,
+        'MH D-DIF': delta,
+        'MH D-DIF SE': delta_se,
+        'MH Chi2': chi_square,
+        'MH p-value': p_value,
+        'ETS Class': ets_class
+    }
+
+def _fit_logistic(successes, trials, design, n_iter=25, tol=1e-8):
+    """Batched Newton-Raphson logistic regression on grouped data; returns the log-likelihood of each fit."""
+    n_params = design.shape[1]
+    coefficients = np.zeros(successes.shape[:-1] + (n_params,))
+    ridge = 1e-6 * np.eye(n_params)
+    # Hessians of all fits come from one matrix product with the per-cell outer products
+    outer_products = (design[:, :, None] * design[:, None, :]).reshape(len(design), -1)
+    previous = -np.inf
+    for _ in range(n_iter):
+        p = np.clip(1 / (1 + np.exp(-np.clip(coefficients @ design.T, -30, 30))), 1e-12, 1 - 1e-12)
+        log_lik = (successes * np.log(p) + (trials - successes) * np.log1p(-p)).sum(axis=-1)
+        # Separated items keep creeping towards +-infinity, so stop on the log-likelihood instead of the steps
+        if np.abs(log_lik - previous).max() < tol * max(np.abs(log_lik).max(), 1):
+            break
+        previous = log_lik
+        gradient = (successes - trials * p) @ design
+        hessian = ((trials * p * (1 - p)) @ outer_products).reshape(coefficients.shape + (n_params,)) + ridge
+        coefficients += np.clip(np.linalg.solve(hessian, gradient[..., None])[..., 0], -5, 5)
+    return log_lik
+
+def logistic_regression_dif(reference_counts, focal_counts):
+    """
+    Logistic-regression DIF (uniform, non-uniform and total) for every item (and focal group) at once.
+
+    The models only depend on the matching stratum and the group, so they are fitted on the
+    grouped contingency counts instead of one row per examinee. Returns a dict of arrays with the
+    likelihood-ratio chi-squares, the 2-df p-value, the Nagelkerke R-squared change and the
+    Jodoin-Gierl A/B/C classification.
+    """
+    n_strata = reference_counts.shape[-2]
+    counts = np.concatenate([reference_counts, focal_counts], axis=-2).astype(float)
+    successes, trials = counts[..., 1], counts.sum(axis=-1)
+
+    # One cell per (stratum, group): columns are intercept, matching score, group and interaction
+    stratum = np.tile(np.arange(n_strata), 2).astype(float)
+    stratum = (stratum - stratum.mean()) / max(stratum.std(), 1)
+    group = np.repeat([0.0, 1.0], n_strata)
+    design = np.column_stack([np.ones(2 * n_strata), stratum, group, stratum * group])
+
+    # Cells nobody falls in add nothing to any likelihood
+    occupied = trials.reshape(-1, 2 * n_strata).sum(axis=0) > 0
+    successes, trials, design = successes[..., occupied], trials[..., occupied], design[occupied]
+
+    log_lik_null = _fit_logistic(successes, trials, design[:, :1])
+    log_lik_score = _fit_logistic(successes, trials, design[:, :2])
+    log_lik_uniform = _fit_logistic(successes, trials, design[:, :3])
+    log_lik_full = _fit_logistic(successes, trials, design)
+
+    uniform = np.maximum(2 * (log_lik_uniform - log_lik_score), 0)
+    nonuniform = np.maximum(2 * (log_lik_full - log_lik_uniform), 0)
+    total = uniform + nonuniform
+    p_value = chi2.sf(total, 2)
+
+    # Nagelkerke R-squared of the score-only and full models
+    n = np.maximum(trials.sum(axis=-1), 1)
+    max_r2 = 1 - np.exp(2 * log_lik_null / n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r2_score = (1 - np.exp(2 * (log_lik_null - log_lik_score) / n)) / max_r2
+        r2_full = (1 - np.exp(2 * (log_lik_null - log_lik_full) / n)) / max_r2
+    delta_r2 = np.nan_to_num(r2_full - r2_score)
+    lr_class = np.where((p_value < 0.05) & (delta_r2 >= 0.07), 'C',
+                        np.where((p_value < 0.05) & (delta_r2 >= 0.035), 'B', 'A'))
+
+    return {
+        'LR Chi2 Uniform': uniform,
+        'LR Chi2 Nonuniform': nonuniform,
+        'LR Chi2 Total': total,
+        'LR p-value': p_value,
+        'Delta R2': delta_r2,
+        'LR Class': lr_class
+    }
+
+def dif_sweep(responses, student_info_df, group_columns, matching='rest', abilities=None, references=None):
+    """
+    Run Mantel-Haenszel and logistic-regression DIF for every item, every grouping column and every focal group.
+
     Parameters:
-    - answer_df: DataFrame with student responses and true answers.
-    - student_info_df: DataFrame with student IDs and groups (e.g., 'Gender').
-    - group_column: Column name in student_info_df to be used for grouping (e.g., 'gender').
-    
+    - responses: ResponseMatrix with the encoded student responses.
+    - student_info_df: DataFrame with student IDs and one or more grouping columns.
+    - group_columns: Columns of student_info_df to analyse; each can have any number of groups.
+    - matching: Matching criterion, 'rest', 'total' or 'theta' (see matching_strata).
+    - abilities: Ability estimate of every row of the response matrix, required for 'theta'.
+    - references: Optional dict mapping a column to its reference group (default: the largest group).
+
     Returns:
-    - A DataFrame with DIF analysis results, including IRT parameter differences and significance.
+    - A DataFrame with one row per (column, focal group, item).
     """
-    # Select student answer rows, starting from the third row
-    # Select student answer rows starting from the third row
-    student_answers_df = answer_df.iloc[2:].copy()  # Start from third row onward
-    student_answers_df.reset_index(inplace=True)
+    references = references or {}
+    strata, n_strata = matching_strata(responses, matching, abilities)
+    positions = responses.positions(student_info_df['student_id'])
+    results = []
 
-    
-    column_names = ['student_id'] + [str(i) for i in range(1, len(student_answers_df.columns))]
-    student_answers_df.columns = column_names    
+    for group_column in group_columns:
+        group_codes, labels = align_groups(responses, student_info_df, group_column, positions)
+        if len(labels) < 2:
+            continue
 
-    # Ensure student_id is string type in both DataFrames for consistent merging
-    student_answers_df['student_id'] = student_answers_df['student_id'].astype(str)
-    student_info_df['student_id'] = student_info_df['student_id'].astype(str)
+        reference = labels.index(references[group_column]) if group_column in references else 0
+        focal = [g for g in range(len(labels)) if g != reference]
+        counts = contingency_counts(responses, group_codes, len(labels), strata, n_strata, rest=(matching == 'rest'))
 
-    # Merge on 'student_id'
-    merged_df = student_answers_df.merge(student_info_df, on='student_id', how='left')
-    
+        # Every focal group is compared with the reference in the same batched computation
+        reference_counts = np.broadcast_to(counts[reference], counts[focal].shape)
+        statistics = mantel_haenszel(reference_counts, counts[focal])
+        statistics.update(logistic_regression_dif(reference_counts, counts[focal]))
 
-    # Separate correct answers from student responses
-    correct_answers = merged_df.iloc[0, 1:-1]  # True answers row (excluding 'student_id' and group_column)
-    student_data = merged_df.iloc[1:].reset_index(drop=True)  # Remaining rows as student data
-    
-    # Check if group_column exists in the data
-    if group_column not in student_data.columns:
-        raise ValueError(f"The specified group column '{group_column}' does not exist in the merged data.")
-
-    # Group the data by the specified column
-    groups = student_data[group_column].unique()
-    if len(groups) != 2:
-        raise ValueError("DIF analysis requires exactly two groups for comparison.")
-
-    group1, group2 = groups
-    group1_data = student_data[student_data[group_column] == group1].iloc[:, 1:-1]
-    group2_data = student_data[student_data[group_column] == group2].iloc[:, 1:-1]
-    
-    # Calculate IRT parameters for each group
+        column_df = pd.DataFrame({name: values.ravel() for name, values in statistics.items()})
+        column_df.insert(0, 'Group Column', group_column)
+        column_df.insert(1, 'Reference', labels[reference])
+        column_df.insert(2, 'Focal', np.repeat([labels[g] for g in focal], responses.n_items))
+        column_df.insert(3, 'Item', np.tile(responses.item_labels, len(focal)))
+        column_df.insert(4, 'N Reference', np.tile(counts[reference].sum(axis=(1, 2)), len(focal)))
+        column_df.insert(5, 'N Focal', counts[focal].sum(axis=(2, 3)).ravel())
+        results.append(column_df)
 
-    group1_data = group1_data.values.tolist()
-    group2_data = group2_data.values.tolist()
+    if not results:
+        return pd.DataFrame()
+    return pd.concat(results, ignore_index=True)
 
-    correct_answers = correct_answers.values.tolist()
-    irt_metrics_g1 = calculate_irt_metrics(correct_answers, group1_data)
-    irt_metrics_g2 = calculate_irt_metrics(correct_answers, group2_data)
+_WORKER_DATA = {}    # Response arrays attached from shared memory in each worker process
+_WORKER_BLOCKS = []  # Keeps the shared memory blocks of a worker open while it runs
 
-    # Prepare results DataFrame for DIF analysis
-    dif_results = []
+N_PARAMETERS = {'1PL': 1, '2PL': 2, '3PL': 3}
+
+def _collapse_group_patterns(responses, group_codes):
+    """Distinct (group, correctness, validity) patterns of the grouped examinees and their counts."""
+    rows = np.flatnonzero(group_codes >= 0)
+    group_bytes = group_codes[rows].astype('<u2').view(np.uint8).reshape(-1, 2)
+    keys = np.ascontiguousarray(np.hstack([responses.packed[rows], responses.packed_valid[rows], group_bytes]))
+    _, first, counts = np.unique(keys.view(np.dtype((np.void, keys.shape[1])))[:, 0], return_index=True, return_counts=True)
+    rows = rows[first]
+    patterns = responses.subset(rows)
+    return {
+        'correct': patterns.correct.astype(np.float32),
+        'valid': patterns.valid.astype(np.float32) if responses.has_missing else None,
+        'counts': counts.astype(float),
+        'groups': group_codes[rows]
+    }
+
+def _share_arrays(arrays):
+    """Copy arrays into shared memory; returns the blocks (to release later) and the specs workers attach to."""
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        if array is None:
+            specs[name] = None
+            continue
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+def _attach_shared_arrays(specs):
+    """Process pool initializer: map the shared response arrays without copying them."""
+    for name, spec in specs.items():
+        if spec is None:
+            _WORKER_DATA[name] = None
+            continue
+        block = shared_memory.SharedMemory(name=spec[0])
+        _WORKER_BLOCKS.append(block)
+        _WORKER_DATA[name] = np.ndarray(spec[1], np.dtype(spec[2]), buffer=block.buf)
+
+def _refit_item(item, constrained, baseline, n_groups, model, tol):
+    """Refit the multiple-group model with the constraint on one item toggled."""
+    constrained = constrained.copy()
+    constrained[item] = not constrained[item]
+    fit = calibrate_groups(_WORKER_DATA['correct'], _WORKER_DATA['valid'], _WORKER_DATA['counts'], _WORKER_DATA['groups'],
+                           n_groups, constrained, model=model, init=baseline, tol=tol)
+    return item, fit
+
+def select_anchors(responses, group_codes, n_groups):
+    """Anchor items: ETS class A in the Mantel-Haenszel rest-score analysis for every focal group."""
+    strata, n_strata = matching_strata(responses, 'rest')
+    counts = contingency_counts(responses, group_codes, n_groups, strata, n_strata, rest=True)
+    reference_counts = np.broadcast_to(counts[0], counts[1:].shape)
+    anchors = (mantel_haenszel(reference_counts, counts[1:])['ETS Class'] == 'A').all(axis=0)
+    # Without any clean item every other item serves as anchor
+    return anchors if anchors.any() else np.ones(responses.n_items, dtype=bool)
+
+def irt_lr_dif(responses, group_codes, labels, model='2PL', anchors=None, max_workers=None, tol=1e-3):
+    """
+    IRT likelihood-ratio DIF for every item of one grouping column.
+
+    A baseline multiple-group model holds the anchor items equal across groups and frees the
+    rest. Every item is then refitted once with its constraint toggled, in a process pool that
+    reads the collapsed response patterns from shared memory, and the likelihood ratio between
+    the freed and constrained fits is tested with (groups - 1) x parameters degrees of freedom.
+
+    Parameters:
+    - responses: ResponseMatrix with the encoded student responses.
+    - group_codes, labels: Output of align_groups; group 0 is the reference group.
+    - model: '1PL', '2PL' or '3PL'.
+    - anchors: Boolean array of anchor items (default: select_anchors).
+    - max_workers: Number of worker processes (default: number of CPUs).
+    - tol: Convergence threshold of every refit.
+
+    Returns:
+    - A DataFrame with one row per item: anchor flag, LR chi-square, df, p-value and the item
+      parameters of every group in the model where the item is free.
+    """
+    n_groups = len(labels)
+    if anchors is None:
+        anchors = select_anchors(responses, group_codes, n_groups)
+    anchors = np.asarray(anchors, dtype=bool)
+
+    patterns = _collapse_group_patterns(responses, group_codes)
+    start = calibrate(responses.subset(group_codes >= 0), model=model)
+    baseline = calibrate_groups(patterns['correct'], patterns['valid'], patterns['counts'], patterns['groups'],
+                                n_groups, anchors, model=model, init=start, tol=tol)
+
+    refits = {}
+    blocks, specs = _share_arrays(patterns)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_attach_shared_arrays, initargs=(specs,)) as pool:
+            futures = [pool.submit(_refit_item, item, anchors, baseline, n_groups, model, tol) for item in range(responses.n_items)]
+            for future in as_completed(futures):
+                item, fit = future.result()
+                refits[item] = fit
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    rows = []
+    for item in range(responses.n_items):
+        # The fit where the item is free is the augmented model, the other one the compact model
+        free_fit, compact_fit = (refits[item], baseline) if anchors[item] else (baseline, refits[item])
+        lr_statistic = max(2 * (free_fit.log_likelihood - compact_fit.log_likelihood), 0)
+        df = (n_groups - 1) * N_PARAMETERS[model]
+        row = {
+            'Item': responses.item_labels[item],
+            'Anchor': anchors[item],
+            'LR Chi2': lr_statistic,
+            'df': df,
+            'p-value': chi2.sf(lr_statistic, df),
+        }
+        row['DIF Detected'] = row['p-value'] < 0.05
+        for g, label in enumerate(labels):
+            a, d, c = free_fit.a[g, item], free_fit.d[g, item], free_fit.c[g, item]
+            row[f'Discrimination {label}'] = a
+            row[f'Difficulty {label}'] = -d / a
+            row[f'Guessing {label}'] = c
+        rows.append(row)
+
+    lr_df = pd.DataFrame(rows)
+    lr_df.attrs['means'] = dict(zip(labels, baseline.means))
+    lr_df.attrs['sds'] = dict(zip(labels, baseline.sds))
+    return lr_df
+
+def run_dif_analysis(responses, student_info_df, group_columns, matching='rest', abilities=None, irt_lr=False, model='2PL'):
+    """
+    Perform Differential Item Functioning (DIF) analysis for one or more grouping columns.
     
-    for item in range(len(correct_answers)):
-        # Extract parameters for the item in both groups
-        difficulty_g1 = irt_metrics_g1.loc[item, 'Difficulty']
-        discrimination_g1 = irt_metrics_g1.loc[item, 'Discrimination']
-        guessing_g1 = irt_metrics_g1.loc[item, 'Guessing']
-
-        difficulty_g2 = irt_metrics_g2.loc[item, 'Difficulty']
-        discrimination_g2 = irt_metrics_g2.loc[item, 'Discrimination']
-        guessing_g2 = irt_metrics_g2.loc[item, 'Guessing']
-        
-        # Calculate differences in parameters
-        difficulty_diff = difficulty_g1 - difficulty_g2
-        discrimination_diff = discrimination_g1 - discrimination_g2
-        guessing_diff = guessing_g1 - guessing_g2
-
-        # Chi-square test
-        chi2_val = (difficulty_diff ** 2 + discrimination_diff ** 2 + guessing_diff ** 2)
-        p_value = chi2.sf(chi2_val, 3)  # 3 degrees of freedom
-
-        # Collect results
-        dif_results.append({
-            'Item': item,
-            'Difficulty Group 1': difficulty_g1,
-            'Difficulty Group 2': difficulty_g2,
-            'Discrimination Group 1': discrimination_g1,
-            'Discrimination Group 2': discrimination_g2,
-            'Guessing Group 1': guessing_g1,
-            'Guessing Group 2': guessing_g2,
-            'Difficulty Difference': difficulty_diff,
-            'Discrimination Difference': discrimination_diff,
-            'Guessing Difference': guessing_diff,
-            'Chi2 Value': chi2_val,
-            'p-value': p_value,
-            'DIF Detected': p_value < 0.05
-        })
-
-    # Convert results to DataFrame
-    dif_df = pd.DataFrame(dif_results)
+    Parameters:
+    - responses: ResponseMatrix with the encoded student responses and true answers.
+    - student_info_df: DataFrame with student IDs and groups (e.g., 'Gender').
+    - group_columns: Column names in student_info_df to be used for grouping (e.g., ['gender']).
+    - matching: Matching criterion for the observed-score DIF statistics ('rest', 'total' or 'theta').
+    - abilities: Ability estimate of every row of the response matrix, required when matching on theta.
+    - irt_lr: Also run IRT likelihood-ratio DIF for every grouping column.
+    - model: IRT model used by the likelihood-ratio DIF.
     
-    # Visualize DIF Analysis: ICC for each item
-    for item in range(len(correct_answers)):
+    Returns:
+    - A DataFrame with the Mantel-Haenszel and logistic-regression DIF results. The IRT-LR results
+      and group labels of every grouping column are kept in its attrs under 'irt_lr'.
+    """
+    if isinstance(group_columns, str):
+        group_columns = [group_columns]
+
+    sweep_df = dif_sweep(responses, student_info_df, group_columns, matching=matching, abilities=abilities)
+    sweep_df.attrs['irt_lr'] = {}
+    if irt_lr and not sweep_df.empty:
+        for group_column in group_columns:
+            group_codes, labels = align_groups(responses, student_info_df, group_column)
+            if len(labels) < 2:
+                continue
+            with st.spinner(f"Fitting one multiple-group model per item for {group_column}..."):
+                sweep_df.attrs['irt_lr'][group_column] = (irt_lr_dif(responses, group_codes, labels, model=model), labels)
+    return sweep_df
+
+def create_dif_report(responses, student_info_df, group_columns, matching='rest', abilities=None, irt_lr=False, model='2PL'):
+    """Run the DIF analysis (see run_dif_analysis), display it and return the results."""
+    sweep_df = run_dif_analysis(responses, student_info_df, group_columns, matching=matching, abilities=abilities, irt_lr=irt_lr, model=model)
+    show_dif_report(sweep_df)
+    return sweep_df
+
+def show_dif_report(sweep_df):
+    """Display the DIF results returned by create_dif_report."""
+    if sweep_df.empty:
+        st.write("The selected columns need at least two groups for DIF analysis.")
+        return
+
+    st.subheader("Observed-Score DIF (Mantel-Haenszel and Logistic Regression)")
+    flagged = sweep_df[(sweep_df['ETS Class'] != 'A') | (sweep_df['LR Class'] != 'A')]
+    st.write(f"{len(flagged)} of {len(sweep_df)} item comparisons show B or C level DIF.")
+    st.dataframe(sweep_df)
+
+    for group_column, (lr_df, labels) in sweep_df.attrs.get('irt_lr', {}).items():
+        st.subheader(f"IRT Likelihood-Ratio DIF for {group_column}")
+        st.dataframe(lr_df)
+        plot_group_iccs(lr_df, labels, key=f'dif_page_{group_column}')
+
+def plot_group_iccs(lr_df, labels, key='dif_page'):
+    """Show the item characteristic curve of every group next to the IRT-LR DIF metrics of each item, paginated."""
+    page = paginate(len(lr_df), key=key)
+    rows = lr_df.iloc[list(page)]
+    images = render_many([
+        ('icc', (f'Item Characteristic Curve for Item: {row["Item"]}',
+                 tuple((f'{label} ICC', row[f'Discrimination {label}'], row[f'Difficulty {label}'], row[f'Guessing {label}']) for label in labels)))
+        for _, row in rows.iterrows()
+    ])
+    for (_, row), image in zip(rows.iterrows(), images):
         col1, col2 = st.columns(2)
         with col1:
-            theta = np.linspace(-3, 3, 100)
-            
-            # Parameters for each group
-            a_g1, b_g1, c_g1 = irt_metrics_g1.loc[item, 'Discrimination'], irt_metrics_g1.loc[item, 'Difficulty'], irt_metrics_g1.loc[item, 'Guessing']
-            a_g2, b_g2, c_g2 = irt_metrics_g2.loc[item, 'Discrimination'], irt_metrics_g2.loc[item, 'Difficulty'], irt_metrics_g2.loc[item, 'Guessing']
-
-            # Calculate ICC for each group
-            prob_g1 = c_g1 + (1 - c_g1) / (1 + np.exp(-a_g1 * (theta - b_g1)))
-            prob_g2 = c_g2 + (1 - c_g2) / (1 + np.exp(-a_g2 * (theta - b_g2)))
-
-            fig, ax = plt.subplots(figsize=(8, 6))
-            ax.plot(theta, prob_g1, color='blue', label=f'{group1} ICC')
-            ax.plot(theta, prob_g2, color='red', linestyle='--', label=f'{group2} ICC')
-            ax.set_title(f'Item Characteristic Curve for Item: {item + 1}')
-            ax.set_xlabel('Theta')
-            ax.set_ylabel('Probability of Correct Response')
-            ax.legend()
-
-            st.pyplot(fig)
+            st.image(image)
 
         # Display DIF Metrics
         with col2:
-            st.subheader(f'DIF Metrics for {item + 1}')
-            item_metrics = dif_df[dif_df['Item'] == item]
-            st.table(item_metrics[['Difficulty Group 1', 'Difficulty Group 2', 'Discrimination Group 1', 
-                                   'Discrimination Group 2', 'Guessing Group 1', 'Guessing Group 2', 
-                                   'Difficulty Difference', 'Discrimination Difference', 'Guessing Difference', 
-                                   'Chi2 Value', 'p-value', 'DIF Detected']])
-    
-    return dif_df
\ No newline at end of file
+            st.subheader(f'DIF Metrics for {row["Item"]}')
+            st.table(row.to_frame().T.drop(columns=['Item']))
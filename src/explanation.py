@@ -1,82 +1,155 @@
-import pandas as pd
-import os
-from langchain.llms import OpenAI
-from dotenv import load_dotenv
+import asyncio
 import streamlit as st
+from cache import get_cache, cache_key, content_hash
+from llm import get_gateway, model_name, LLM_CONCURRENCY
+from semantic import question_text as passage_text
+from vector_index import VectorIndex, split_passages
 
-# Load API key from .env file
-load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
+EXPLANATION_RETRIES = 3
+RETRIEVAL_TOP_K = 3  # Passages of the question bank and reference material added to every prompt
+EXPLANATION_INDEX = 'explanations'  # VectorIndex shared by every upload
+ANSWER_COLUMNS = {'A': 2, 'B': 3, 'C': 4, 'D': 5, 'E': 6}  # Letter of the key -> column of the alternative text
 
-# Initialize LangChain model
-llm = OpenAI(openai_api_key=openai_api_key)
+# Process-wide LLM gateway shared by every session (a StubLLM behind it when LLM_BACKEND=stub)
+default_llm = get_gateway()
 
-def get_correct_answers(answer_sheet_df):
-    # Retrieve the correct answers from the answer sheet DataFrame
-    return answer_sheet_df.iloc[1].values[0:]  # Assuming the first row has titles and the second row has correct answers
+def get_correct_answers(responses):
+    # Retrieve the correct answers from the encoded answer key
+    return responses.key_labels
 
-def generate_explanation(question, correct_answer):
-    # Create a prompt for OpenAI
+def build_explanation_prompt(question, correct_answer, passages=()):
     prompt = f"Explain why the answer to the question '{question}' is '{correct_answer}'."
-    
-    try:
-        # Call OpenAI API
-        explanation = llm(prompt)
-        return explanation
-    except Exception as e:
-        print(f"Error occurred while calling OpenAI: {e}")
-        return None
-
-def create_explanations(question_df, answer_sheet_df):
-    correct_answers = get_correct_answers(answer_sheet_df)
-    answer_map = {'A': 2, 'B': 3, 'C': 4, 'D': 5}
-    explanations = {}
-    progress_text = "Explaining operation in progress. Please wait."
-    my_bar = st.progress(0, text=progress_text)
-    percent_complete = 0
-    total_len = len(question_df)
-    pace = 1/total_len
-    count = 0
-    for i, row in question_df.iterrows():
-
-        my_bar.progress(percent_complete + pace, text=progress_text)
-        percent_complete += pace
+    if passages:
+        context = "\n\n".join(f"[{i}] {passage}" for i, passage in enumerate(passages, start=1))
+        prompt = f"Use the following reference passages where they are relevant.\n\n{context}\n\n{prompt}"
+    return prompt
+
+def explanation_key(question, correct_answer, llm, passages=()):
+    """
+    Cache key of the explanation of one question, from its correct alternative, the model and the
+    passages retrieved for its prompt, so only questions whose context changed are explained again.
+    """
+    return cache_key('explanation', question, correct_answer, model_name(llm), content_hash(repr(tuple(passages))))
+
+def build_explanation_index(question_df, reference_text=None, name=EXPLANATION_INDEX):
+    """
+    Add the questions (statement and alternatives) and optional reference material to the shared VectorIndex.
+
+    One persistent index serves every upload and only embeds passages it has not seen before, so
+    an edited question bank costs one embedding per changed question. Returns the index and the
+    content hashes of this upload's passages, to restrict the search to them (see create_explanations).
+    """
+    questions = [passage_text(row) for _, row in question_df.iterrows()]
+    references = split_passages(reference_text) if reference_text else []
+    index = VectorIndex(name)
+    index.add(questions, source='questions')
+    if references:
+        index.add(references, source='reference')
+    return index, {content_hash(text) for text in questions + references}
+
+async def generate_explanation(question, correct_answer, llm, on_token=None, retries=EXPLANATION_RETRIES, backoff=1.0, passages=()):
+    """
+    Stream the explanation of one question, retrying failed requests with exponential backoff.
+
+    on_token is called with the text received so far after every streamed chunk. Returns the
+    explanation, or raises the last error once every retry failed.
+    """
+    prompt = build_explanation_prompt(question, correct_answer, passages)
+    for attempt in range(retries + 1):
+        try:
+            text = ''
+            async for chunk in llm.astream(prompt):
+                text += chunk
+                if on_token is not None:
+                    on_token(text)
+            return text.strip()
+        except Exception:
+            if attempt == retries:
+                raise
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+async def _generate_all(jobs, llm, concurrency, placeholders, on_done):
+    """Generate the explanation of every job, at most concurrency at a time, streaming into its placeholder."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def explain(job):
+        number, question, correct_answer, passages = job
+        placeholder = placeholders[number]
+        async with semaphore:
+            try:
+                explanation = await generate_explanation(
+                    question, correct_answer, llm, on_token=lambda text: placeholder.markdown(f"Explanation: {text}"),
+                    passages=passages)
+            except Exception as e:
+                placeholder.error(f"Could not generate the explanation: {e}")
+                explanation = None
+        on_done(number, explanation)
+
+    await asyncio.gather(*(explain(job) for job in jobs))
+
+def create_explanations(question_df, responses, llm=None, concurrency=LLM_CONCURRENCY, index=None, scope=None, k=RETRIEVAL_TOP_K):
+    """
+    Explain the correct answer of every question.
+
+    Explanations are generated concurrently (at most concurrency requests at a time), streamed into
+    the page as they arrive and stored in the disk cache under (question, correct alternative,
+    model, retrieved passages), so generating the report again costs no API calls. With a
+    VectorIndex (see build_explanation_index) each prompt includes the k passages most similar to
+    the question, searched among the passage hashes in scope (every passage when None).
+
+    Returns:
+    - A dictionary mapping each question statement to its explanation.
+    """
+    llm = llm or default_llm
+    correct_answers = get_correct_answers(responses)
+    cache = get_cache()
+    explanations, jobs, placeholders = {}, [], {}
+    # Retrieve the passages of every question in one batched search
+    if index is not None:
+        retrieved = index.search([passage_text(row) for _, row in question_df.iterrows()], k=k, within=scope)
+    else:
+        retrieved = [[] for _ in range(len(question_df))]
 
+    for (_, row), matches in zip(question_df.iterrows(), retrieved):
         question_text = row['statement']  # Extract the question statement
         question_num = row['question_number']
-        
-        # Get the correct answer letter for this question from correct_answers_df
-        correct_letter = correct_answers[int(question_num)-1].upper()
 
-        if len(correct_letter) > 0 and correct_letter in answer_map:
-            # Find the correct column index based on the answer letter
-            correct_col = answer_map[correct_letter[0]]
+        # Get the correct answer letter for this question from the answer key
+        correct_letter = str(correct_answers[int(question_num) - 1]).upper()
+        if correct_letter[:1] not in ANSWER_COLUMNS or ANSWER_COLUMNS[correct_letter[0]] >= len(row):
+            continue
 
-            # Get the text for the correct alternative
-            correct_text = row.iloc[correct_col]
+        # Get the text for the correct alternative
+        correct_text = row.iloc[ANSWER_COLUMNS[correct_letter[0]]]
 
-            # Generate the explanation for the correct answer
-            explanation = generate_explanation(question_text, correct_text)
-            
-            # For debugging or output purposes
-            st.subheader(f"Question {question_num}: {question_text}")
-            st.subheader(f"Correct Answer: {correct_text}")
-            st.markdown(f"Explanation: {explanation}\n")
-        
-        if explanation:
+        st.subheader(f"Question {question_num}: {question_text}")
+        st.subheader(f"Correct Answer: {correct_text}")
+        placeholders[question_num] = st.empty()
+        passages = tuple(passage for passage, _ in matches)
+        explanation = cache.get(explanation_key(question_text, correct_text, llm, passages))
+        if explanation is not None:
+            placeholders[question_num].markdown(f"Explanation: {explanation}\n")
             explanations[question_text] = explanation
-        if count > 10:
-            break
-        count += 1
-    my_bar.empty()
-    return explanations
+        else:
+            jobs.append((question_num, question_text, correct_text, passages))
 
-    
+    if jobs:
+        progress_text = "Explaining operation in progress. Please wait."
+        my_bar = st.progress(0, text=progress_text)
+        finished = []
+        def on_done(number, explanation):
+            finished.append(number)
+            my_bar.progress(len(finished) / len(jobs), text=progress_text)
+            if explanation:
+                _, question_text, correct_text, passages = next(job for job in jobs if job[0] == number)
+                explanations[question_text] = explanation
+                cache.put(explanation_key(question_text, correct_text, llm, passages), explanation)
 
-def get_correct_alternative_text(questions_info_df, correct_answers):
-    # Map letters to column offsets (0-based index adjustment)
-    answer_map = {'A': 2, 'B': 3, 'C': 4, 'D': 5, 'E': 6}
+        asyncio.run(_generate_all(jobs, llm, concurrency, placeholders, on_done))
+        my_bar.empty()
+    return explanations
 
+def get_correct_alternative_text(questions_info_df, correct_answers):
     # Initialize a dictionary to store each question's correct alternative text
     correct_alternatives = {}
 
@@ -86,9 +159,9 @@ def get_correct_alternative_text(questions_info_df, correct_answers):
         # Get the correct answer letter for this question
         correct_letter = correct_answers.get(question_num)
 
-        if correct_letter in answer_map:
+        if correct_letter in ANSWER_COLUMNS:
             # Find the correct column index based on the answer letter
-            correct_col = answer_map[correct_letter]
+            correct_col = ANSWER_COLUMNS[correct_letter]
             
             # Get the text for the correct alternative
             correct_text = row.iloc[correct_col]
@@ -96,4 +169,4 @@ def get_correct_alternative_text(questions_info_df, correct_answers):
             # Store it in the dictionary for later use
             correct_alternatives[question_num] = correct_text
     
-    return correct_alternatives
\ No newline at end of file
+    return correct_alternatives
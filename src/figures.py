@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+import streamlit as st
+from matplotlib.figure import Figure
+
+PLOTS = {}  # Registered drawing functions, called as draw(ax, *params)
+PROJECTIONS = {}  # Axes projection of the plots that are not cartesian (e.g., 'polar')
+
+def plot(name, projection=None):
+    """Register a drawing function under a name so render can rebuild the figure from its parameters."""
+    def register(draw):
+        PLOTS[name] = draw
+        PROJECTIONS[name] = projection
+        return draw
+    return register
+
+@lru_cache(maxsize=2048)
+def render(name, params, figsize=(8, 6), fmt='png', dpi=100):
+    """
+    Render a registered plot to PNG (or SVG) bytes.
+
+    The figure is built with the object-oriented Figure API, so it never touches the global
+    pyplot state and is freed as soon as it is rendered. params must be hashable (tuples of
+    numbers and strings); identical plots are served from the cache on every rerun.
+    """
+    fig = Figure(figsize=figsize)
+    ax = fig.add_subplot(projection=PROJECTIONS[name])
+    PLOTS[name](ax, *params)
+    buffer = BytesIO()
+    fig.savefig(buffer, format=fmt, dpi=dpi)
+    return buffer.getvalue()
+
+def render_many(jobs, max_workers=4):
+    """Render a list of (name, params) or (name, params, figsize) jobs in a thread pool, keeping their order."""
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda job: render(*job), jobs))
+
+def paginate(n_items, key, page_size=20):
+    """Show a page selector and return the range of items on the selected page."""
+    n_pages = max((n_items - 1) // page_size + 1, 1)
+    page = 1
+    if n_pages > 1:
+        page = st.number_input(f"Page (1-{n_pages})", min_value=1, max_value=n_pages, value=1, step=1, key=key)
+    return range((page - 1) * page_size, min(page * page_size, n_items))
+
+def as_tuple(values):
+    """Convert an array to a tuple of plain Python numbers, usable as render parameters."""
+    return tuple(np.asarray(values).tolist())
+
+@plot('icc')
+def draw_iccs(ax, title, curves):
+    """Item characteristic curves; curves holds (label, a, b, c) tuples."""
+    theta = np.linspace(-3, 3, 100)
+    for label, a, b, c in curves:
+        ax.plot(theta, c + (1 - c) / (1 + np.exp(-a * (theta - b))), label=label)
+    ax.set_title(title)
+    ax.set_xlabel('Theta')
+    ax.set_ylabel('Probability of Correct Response')
+    ax.legend()
+
+@plot('option_bars')
+def draw_option_bars(ax, title, options, counts, key_index, xlabel='Answer', ylabel='Number of Responses'):
+    """Bar chart of the number of students choosing each option, with the correct answer in red."""
+    colors = ['red' if i == key_index else 'tab:blue' for i in range(len(options))]
+    ax.bar(range(len(options)), counts, color=colors)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_xticks(range(len(options)))
+    ax.set_xticklabels(options)
+
+@plot('score_histogram')
+def draw_score_histogram(ax, title, scores, frequencies):
+    """Histogram of the students' scores from precomputed frequencies."""
+    ax.bar(scores, frequencies, color='skyblue', edgecolor='black', width=0.8)
+    ax.set_title(title)
+    ax.set_xlabel('Scores')
+    ax.set_ylabel('Frequency')
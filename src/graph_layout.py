@@ -0,0 +1,78 @@
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import shortest_path
+from cache import cached, content_hash
+
+SPRING_MAX_NODES = 300  # Larger graphs are laid out with pivot MDS
+N_PIVOTS = 50
+
+def graph_hash(adjacency):
+    """Content hash of a sparse adjacency matrix (structure and weights)."""
+    adjacency = sp.csr_matrix(adjacency)
+    adjacency.sort_indices()
+    return content_hash(repr(adjacency.shape).encode() + adjacency.indptr.tobytes() + adjacency.indices.tobytes()
+                        + adjacency.data.astype(np.float64).tobytes())
+
+def _maxmin_pivots(distances_from, n_nodes, n_pivots, rng):
+    """Pivots spread over the graph: each new pivot is the node farthest from the pivots chosen so far."""
+    pivots = [int(rng.integers(n_nodes))]
+    nearest = distances_from(pivots[-1])
+    while len(pivots) < n_pivots:
+        pivots.append(int(np.argmax(nearest)))
+        nearest = np.minimum(nearest, distances_from(pivots[-1]))
+    return pivots
+
+def pivot_mds(adjacency, n_pivots=N_PIVOTS, seed=42):
+    """
+    2D layout by pivot MDS (Brandes and Pich): classical MDS of the graph distances to a few pivots.
+
+    Edge weights are strengths, so the length of an edge is 1 / weight. Needs one shortest-path
+    search per pivot, O(pivots x edges log nodes), instead of the all-pairs distances of full MDS.
+    Nodes in different components are placed one unit beyond the largest distance.
+    """
+    adjacency = sp.csr_matrix(adjacency, dtype=np.float64)
+    n = adjacency.shape[0]
+    if n < 3:
+        return np.column_stack([np.arange(n, dtype=float), np.zeros(n)])
+    lengths = adjacency.copy()
+    lengths.data = 1 / lengths.data
+
+    def distances_from(node):
+        distances = shortest_path(lengths, directed=False, indices=node)
+        return np.where(np.isfinite(distances), distances, -1)
+
+    rng = np.random.default_rng(seed)
+    pivots = _maxmin_pivots(distances_from, n, min(n_pivots, n), rng)
+    distances = shortest_path(lengths, directed=False, indices=pivots).T  # nodes x pivots
+    finite = np.isfinite(distances)
+    distances[~finite] = (distances[finite].max() if finite.any() else 0) + 1
+
+    # Double-centred squared distances; the top singular vectors give the coordinates
+    squared = distances ** 2
+    centred = squared - squared.mean(axis=0) - squared.mean(axis=1, keepdims=True) + squared.mean()
+    u, s, _ = np.linalg.svd(-0.5 * centred, full_matrices=False)
+    positions = u[:, :2] * s[:2]
+    return _normalize(positions)
+
+def spring_layout(adjacency, seed=42):
+    """networkx spring layout of a small weighted graph, as an (nodes x 2) array."""
+    G = nx.from_scipy_sparse_array(sp.csr_matrix(adjacency))
+    pos = nx.spring_layout(G, seed=seed, weight='weight')
+    return _normalize(np.array([pos[i] for i in range(adjacency.shape[0])]).reshape(-1, 2))
+
+def _normalize(positions):
+    """Centre positions and scale them into [-1, 1]."""
+    positions = positions - positions.mean(axis=0)
+    scale = np.abs(positions).max()
+    return positions / scale if scale > 0 else positions
+
+def compute_layout(adjacency, seed=42):
+    """Spring layout for small graphs, pivot MDS for larger ones."""
+    if adjacency.shape[0] <= SPRING_MAX_NODES:
+        return spring_layout(adjacency, seed)
+    return pivot_mds(adjacency, seed=seed)
+
+def cached_layout(adjacency, seed=42):
+    """Layout of a graph, computed once per graph hash and kept in the disk cache."""
+    return cached('layout', (graph_hash(adjacency), SPRING_MAX_NODES, seed), lambda: compute_layout(adjacency, seed))
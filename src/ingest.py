@@ -0,0 +1,260 @@
+import csv
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv, ipc, parquet as pq
+from response_matrix import ResponseMatrix, MappedResponses, MISSING, BLOCK_ROWS, _save_metadata
+from cache import CACHE_DIR, TEMP_MAX_AGE
+
+PARQUET_SUFFIXES = ('.parquet', '.pq')
+ARROW_SUFFIXES = ('.arrow', '.feather', '.ipc')
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+UPLOAD_TYPES = ['csv', 'gz', 'zst', 'zstd', 'parquet', 'pq', 'arrow', 'feather']
+# Uploads larger than this are streamed to a memory-mapped matrix on disk instead of read into RAM
+MEMMAP_THRESHOLD_MB = float(os.getenv("MEMMAP_THRESHOLD_MB", "256"))
+RESPONSES_MAX_MB = float(os.getenv("RESPONSES_CACHE_MAX_MB", "4096"))  # Bound of the memory-mapped matrices kept on disk
+
+def _compression(name):
+    return next((codec for suffix, codec in COMPRESSION_SUFFIXES.items() if name.lower().endswith(suffix)), None)
+
+def _rewind(source):
+    if hasattr(source, 'seek'):
+        source.seek(0)
+
+def _csv_batches(source, name, block_size):
+    """Stream a (possibly gzip/zstd compressed) header-less CSV as record batches of string columns."""
+    # Count the columns from the first line, so every column is read as text instead of inferred
+    _rewind(source)
+    stream, head = pa.input_stream(source, compression=_compression(name)), b''
+    while b'\n' not in head:
+        data = stream.read(1 << 16)
+        if not data:
+            break
+        head += data
+    n_columns = len(next(csv.reader([head.split(b'\n', 1)[0].decode('utf-8')])))
+
+    _rewind(source)
+    reader = pa_csv.open_csv(
+        pa.input_stream(source, compression=_compression(name)),
+        read_options=pa_csv.ReadOptions(autogenerate_column_names=True, block_size=block_size),
+        convert_options=pa_csv.ConvertOptions(column_types={f'f{i}': pa.string() for i in range(n_columns)},
+                                              strings_can_be_null=True)
+    )
+    yield from reader
+
+def record_batches(source, name, block_size=1 << 24):
+    """Record batches of an answer sheet in CSV (optionally .gz/.zst), Parquet or Arrow IPC/Feather format."""
+    lower_name = name.lower()
+    if lower_name.endswith(PARQUET_SUFFIXES):
+        _rewind(source)
+        yield from pq.ParquetFile(source).iter_batches(batch_size=max(block_size // 64, 1024))
+    elif lower_name.endswith(ARROW_SUFFIXES):
+        _rewind(source)
+        reader = ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+    else:
+        yield from _csv_batches(source, name, block_size)
+
+def _encode_column(column, option_codes):
+    """Option codes (uint16, 0 for blanks) of one Arrow column, assigning new codes to unseen options."""
+    encoded = pc.dictionary_encode(pc.cast(column, pa.string()))
+    # Strings are only materialized once per distinct option, never per cell
+    lookup = np.array([option_codes.setdefault(option, len(option_codes) + 1) if option != '' else MISSING
+                       for option in encoded.dictionary.to_pylist()] + [MISSING], dtype=np.uint16)
+    indices = encoded.indices.fill_null(len(lookup) - 1).to_numpy(zero_copy_only=False)
+    return lookup[indices]
+
+def _encoded_batches(source, name, option_codes, block_size):
+    """Yield (student_ids, codes) per record batch, the answer key first as a batch of its own."""
+    skip, key_seen = 1, False  # The question numbers row is not encoded
+    for batch in record_batches(source, name, block_size):
+        drop = min(skip, batch.num_rows)
+        skip -= drop
+        batch = batch.slice(drop)
+        if batch.num_rows == 0:
+            continue
+
+        columns = [_encode_column(batch.column(i), option_codes) for i in range(1, batch.num_columns)]
+        if len(option_codes) > np.iinfo(np.uint8).max:
+            raise ValueError(f"Answer sheet has {len(option_codes)} distinct options, at most 255 are supported.")
+        codes = np.column_stack(columns).astype(np.uint8) if columns else np.zeros((batch.num_rows, 0), dtype=np.uint8)
+        ids = pc.cast(batch.column(0), pa.string()).to_numpy(zero_copy_only=False)
+
+        # The first encoded row is the answer key
+        if not key_seen:
+            key_seen = True
+            yield ids[:1], codes[:1]
+            ids, codes = ids[1:], codes[1:]
+        yield ids, codes
+
+def _sorted_options(option_codes):
+    """Sorted option labels and the lookup table renumbering first-seen codes in sorted order."""
+    option_labels = sorted(option_codes, key=str)
+    remap = np.zeros(len(option_codes) + 1, dtype=np.uint8)
+    remap[[option_codes[label] for label in option_labels]] = np.arange(1, len(option_labels) + 1)
+    return [str(label) for label in option_labels], remap
+
+def read_answer_sheet(source, name, blank_as_wrong=False, block_size=1 << 24):
+    """
+    Stream an answer sheet straight into a ResponseMatrix, one record batch at a time.
+
+    The layout is the one of the main CSV: the first column holds the student IDs, the first row
+    the question numbers, the second row the correct answers and the remaining rows the student
+    responses. CSV files may be gzip or zstd compressed (.csv.gz, .csv.zst); Parquet and Arrow
+    IPC/Feather tables with the same layout are read batch by batch into one uint8 buffer that
+    grows geometrically, so peak memory is about one byte per cell (up to twice that while the
+    buffer grows) plus one record batch.
+
+    Parameters:
+    - source: Path or binary file-like object (e.g., a Streamlit UploadedFile).
+    - name: File name, used to detect the format and compression.
+    - blank_as_wrong: Count blank answers as wrong instead of missing.
+    - block_size: Bytes of CSV parsed per batch.
+
+    Returns:
+    - A ResponseMatrix with option codes sorted like ResponseMatrix.from_answer_sheet.
+    """
+    option_codes = {}
+    batches = _encoded_batches(source, name, option_codes, block_size)
+    key = next(batches, (None, None))[1]
+    if key is None:
+        raise ValueError("The answer sheet needs a question number row and an answer key row.")
+    id_chunks, n_rows = [], 0
+    codes = np.zeros((0, key.shape[1]), dtype=np.uint8)
+    for ids, batch_codes in batches:
+        if n_rows + len(batch_codes) > len(codes):
+            grown = np.empty((max(2 * len(codes), n_rows + len(batch_codes)), key.shape[1]), dtype=np.uint8)
+            grown[:n_rows] = codes[:n_rows]
+            codes = grown
+        codes[n_rows:n_rows + len(batch_codes)] = batch_codes
+        n_rows += len(batch_codes)
+        id_chunks.append(ids)
+    # Shrinking in place keeps the buffer; only the unused tail rows are released
+    codes.resize((n_rows, key.shape[1]), refcheck=False)
+
+    # Renumber the options in sorted order, in place
+    option_labels, remap = _sorted_options(option_codes)
+    np.take(remap, codes, out=codes)
+
+    return ResponseMatrix(
+        codes=codes,
+        key=remap[key[0]],
+        option_labels=option_labels,
+        student_ids=np.concatenate(id_chunks) if id_chunks else np.array([], dtype=str),
+        item_labels=np.arange(1, codes.shape[1] + 1),
+        blank_as_wrong=blank_as_wrong,
+    )
+
+def stream_answer_sheet(source, name, path, block_size=1 << 24):
+    """
+    Stream an answer sheet into an on-disk response matrix for MappedResponses.open.
+
+    Same input formats as read_answer_sheet, but the codes of every batch are appended to a file
+    in the directory path, so the whole matrix never has to fit in memory.
+    """
+    os.makedirs(path, exist_ok=True)
+    raw_path = os.path.join(path, 'codes.raw')
+    option_codes, id_chunks, n_rows = {}, [], 0
+    batches = _encoded_batches(source, name, option_codes, block_size)
+    key = next(batches, (None, None))[1]
+    if key is None:
+        raise ValueError("The answer sheet needs a question number row and an answer key row.")
+    with open(raw_path, 'wb') as raw:
+        for ids, codes in batches:
+            raw.write(codes.tobytes())
+            id_chunks.append(ids)
+            n_rows += len(codes)
+
+    # Copy into the .npy file block by block, renumbering the options in sorted order
+    option_labels, remap = _sorted_options(option_codes)
+    n_items = key.shape[1]
+    unsorted_codes = np.memmap(raw_path, dtype=np.uint8, mode='r', shape=(n_rows, n_items)) if n_rows else np.zeros((0, n_items), dtype=np.uint8)
+    codes = np.lib.format.open_memmap(os.path.join(path, 'codes.npy'), mode='w+', dtype=np.uint8, shape=(n_rows, n_items))
+    for start in range(0, n_rows, BLOCK_ROWS):
+        codes[start:start + BLOCK_ROWS] = remap[unsorted_codes[start:start + BLOCK_ROWS]]
+    codes.flush()
+    del unsorted_codes, codes
+    os.remove(raw_path)
+
+    _save_metadata(path, remap[key[0]], option_labels, np.concatenate(id_chunks) if id_chunks else np.array([], dtype=str),
+                   np.arange(1, n_items + 1))
+    return MappedResponses.open(path)
+
+def open_answer_sheet(source, name, data_hash, size, blank_as_wrong=False, threshold_mb=MEMMAP_THRESHOLD_MB,
+                      max_mb=RESPONSES_MAX_MB):
+    """
+    Response matrix of an upload: in memory (read_answer_sheet) up to threshold_mb, memory-mapped beyond.
+
+    Large uploads are streamed once per content hash into CACHE_DIR/responses/<data_hash> and
+    opened as MappedResponses by every later session. The directory is written under a temporary
+    name and renamed into place, so concurrent sessions never open a partial matrix. Opening a
+    matrix marks it as recently used, and the least recently used ones are removed once they
+    take more than max_mb (see evict_responses).
+    """
+    if size <= threshold_mb * 1024 ** 2:
+        return read_answer_sheet(source, name, blank_as_wrong=blank_as_wrong)
+    directory = os.path.join(CACHE_DIR, 'responses')
+    path = os.path.join(directory, data_hash)
+    if not os.path.exists(os.path.join(path, 'metadata.npz')):
+        os.makedirs(directory, exist_ok=True)
+        temp_path = tempfile.mkdtemp(dir=directory, prefix=f'{data_hash}.')
+        try:
+            stream_answer_sheet(source, name, temp_path)
+            os.rename(temp_path, path)
+        except OSError:
+            shutil.rmtree(temp_path, ignore_errors=True)  # Another session stored it first
+            if not os.path.exists(os.path.join(path, 'metadata.npz')):
+                raise
+        except BaseException:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+    responses = MappedResponses.open(path, blank_as_wrong=blank_as_wrong)
+    try:
+        os.utime(path)  # Mark as recently used
+    except FileNotFoundError:
+        pass  # Evicted by another session meanwhile, the open memory map stays readable
+    evict_responses(directory, max_mb * 1024 ** 2, keep=path)
+    return responses
+
+def evict_responses(directory, max_bytes, keep=None):
+    """
+    Remove the least recently used memory-mapped response matrices of directory until they fit in max_bytes.
+
+    keep (the matrix just opened) is never removed. Sessions that still map a removed matrix keep
+    reading it, the files only disappear once it is closed. Temporary directories of writers that
+    died (older than TEMP_MAX_AGE) are removed too; matrices removed by another session meanwhile
+    are skipped.
+    """
+    entries, now = [], time.time()
+    for entry in os.scandir(directory):
+        try:
+            if not entry.is_dir() or entry.path == keep:
+                continue
+            if '.' in entry.name:
+                if now - entry.stat().st_mtime > TEMP_MAX_AGE:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        except FileNotFoundError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    if keep is not None and os.path.isdir(keep):
+        total += sum(f.stat().st_size for f in os.scandir(keep))
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def read_preview(source, name, n_rows=100):
+    """First rows of an answer sheet as a DataFrame indexed by the first column, for display."""
+    batch = next(record_batches(source, name, block_size=1 << 20))
+    preview_df = batch.slice(0, n_rows).to_pandas()
+    preview_df.columns = range(preview_df.shape[1])
+    return preview_df.set_index(0)
@@ -1,109 +1,368 @@
 import numpy as np
 import pandas as pd
+from dataclasses import dataclass
+from scipy.special import expit, logit
+import streamlit as st
+from figures import render_many, paginate
+
+MODELS = ('1PL', '2PL', '3PL')
+# Discriminations are kept positive; items stuck at the lower bound are likely miskeyed or discriminate negatively
+SLOPE_BOUNDS = (0.05, 8)
 
 def sigmoid(x, a, b, c):
     """Sigmoid function for estimating the item characteristic curve."""
     return c + (1 - c) / (1 + np.exp(-a * (x - b)))
 
-def calculate_difficulty(correct_answers, responses):
-    """Calculates the difficulty parameter for each item as the percentage of correct responses."""
-    difficulties = []
-    for i in range(len(correct_answers)):
-        # correct_count = sum(1 for response in responses if response[i] == correct_answers[i])
-        correct_count = 0
-        for response in responses:
-            is_correct = response[i] == correct_answers[i]
-            if is_correct:
-                correct_count += 1
-            # print(f"Response: {response[i]}, Correct Answer: {correct_answers[i]}, Is Correct: {is_correct}")
-        difficulty = correct_count / len(responses)
-        difficulties.append(difficulty)
-    return difficulties
-
-def calculate_discrimination(responses, correct_answers):
-    """Estimates discrimination for each item based on item-total correlation."""
-    scores = [sum(1 for i in range(len(correct_answers)) if resp[i] == correct_answers[i]) for resp in responses]
-    total_scores = np.array(scores)
-    discriminations = []
-    for i in range(len(correct_answers)):
-        item_scores = np.array([resp[i] == correct_answers[i] for resp in responses], dtype=int)
-        corr = np.corrcoef(item_scores, total_scores)[0, 1]
-        discriminations.append(corr if not np.isnan(corr) else 0)
-    return discriminations
-
-def calculate_guessing(correct_answers, responses):
+def calculate_difficulty(responses):
+    """Calculates the proportion of correct responses for each item (classical p-value, used as a starting value)."""
+    correct, valid = np.zeros(responses.n_items), np.zeros(responses.n_items)
+    for _, block_correct, block_valid in responses.blocks():
+        correct += block_correct.sum(axis=0)
+        valid += block_valid.sum(axis=0)
+    return correct / np.maximum(valid, 1)
+
+def calculate_discrimination(responses):
+    """Estimates discrimination for each item based on item-total correlation (used as a starting value)."""
+    total_scores = responses.proportion_correct
+
+    # Pearson correlation of every item with the total score, over the examinees who answered the item,
+    # from sums accumulated block by block
+    n, sum_x, sum_y, sum_y2, sum_xy = (np.zeros(responses.n_items) for _ in range(5))
+    for rows, correct, valid in responses.blocks():
+        y = total_scores[rows]
+        n += valid.sum(axis=0)
+        sum_x += correct.sum(axis=0)
+        sum_y += y @ valid
+        sum_y2 += y ** 2 @ valid
+        sum_xy += y @ correct
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x, mean_y = sum_x / n, sum_y / n
+        covariance = sum_xy / n - mean_x * mean_y
+        variance_y = sum_y2 / n - mean_y ** 2
+        discriminations = covariance / np.sqrt(mean_x * (1 - mean_x) * variance_y)
+    return np.nan_to_num(discriminations)
+
+def calculate_guessing(responses):
     """Estimate guessing parameter dynamically based on unique answer choices."""
-    guessing_params = []
-    for i in range(len(correct_answers)):
-        unique_options = set(response[i] for response in responses)
-        guessing_param = 1 / len(unique_options)
-        guessing_params.append(guessing_param)
-    return guessing_params
-
-def calculate_irt_metrics(correct_answers, responses):
-    """Generates a DataFrame of IRT metrics for each item."""
-    difficulty = calculate_difficulty(correct_answers, responses)
-    discrimination = calculate_discrimination(responses, correct_answers)
-    guessing = calculate_guessing(correct_answers, responses)
-
-    # Create a DataFrame with each metric as a column
-    irt_metrics_df = pd.DataFrame({
-        "Item": range(1, len(correct_answers) + 1),
-        "Difficulty": difficulty,
-        "Discrimination": discrimination,
-        "Guessing": guessing
+    unique_options = np.maximum((responses.option_counts()[:, 1:] > 0).sum(axis=1), 1)  # Blanks are not an option
+    return 1 / unique_options
+
+def quadrature_grid(n_points=41, bound=6.0):
+    """Fixed grid of ability points with normalized standard normal weights."""
+    theta = np.linspace(-bound, bound, n_points)
+    weights = np.exp(-0.5 * theta ** 2)
+    return theta, weights / weights.sum()
+
+def item_response_probabilities(theta, a, b, c):
+    """Probability of a correct response for every item (rows) at every ability in theta (columns)."""
+    with np.errstate(over='ignore'):
+        return sigmoid(np.asarray(theta)[None, :], np.asarray(a)[:, None], np.asarray(b)[:, None], np.asarray(c)[:, None])
+
+@dataclass
+class IRTCalibration:
+    """Item parameters estimated by calibrate, together with the quadrature and fit information."""
+    model: str
+    items: pd.DataFrame
+    theta: np.ndarray
+    weights: np.ndarray
+    log_likelihood: float
+    n_iter: int
+    converged: bool
+
+    @property
+    def a(self):
+        return self.items['Discrimination'].to_numpy()
+
+    @property
+    def b(self):
+        return self.items['Difficulty'].to_numpy()
+
+    @property
+    def c(self):
+        return self.items['Guessing'].to_numpy()
+
+    def flagged_items(self, tolerance=1e-3):
+        """Boolean mask of the items whose discrimination was held at the lower bound (no positive discrimination)."""
+        return self.a <= SLOPE_BOUNDS[0] + tolerance
+
+def _starting_values(responses, model, init):
+    """Slope, intercept and guessing starting values, from a previous calibration when one is given."""
+    if init is not None:
+        items = init.items if isinstance(init, IRTCalibration) else init
+        a = np.clip(items['Discrimination'].to_numpy(dtype=float), *SLOPE_BOUNDS)
+        d = -a * items['Difficulty'].to_numpy(dtype=float)
+        c = items['Guessing'].to_numpy(dtype=float).copy() if model == '3PL' else np.zeros(len(a))
+        if model == '1PL':
+            a = np.full(len(a), a.mean())
+        return a, d, c
+
+    c = np.clip(calculate_guessing(responses), 0.05, 0.35) if model == '3PL' else np.zeros(responses.n_items)
+    p = np.clip(calculate_difficulty(responses), 0.02, 0.98)
+    p = np.clip((p - c) / (1 - c), 0.02, 0.98)
+    a = np.ones(responses.n_items)
+    return a, logit(p) * 1.3, c
+
+def _posterior(correct, valid, counts, log_p, log_q, log_weights):
+    """E-step: posterior weight of every response pattern at every quadrature point, and the marginal log-likelihood."""
+    # log L(pattern | theta_q) = sum over answered items of x_i log P_iq + (1 - x_i) log Q_iq, as matrix products
+    answered_log_q = log_q.sum(axis=0) if valid is None else valid @ log_q.astype(valid.dtype)
+    log_lik = correct @ (log_p - log_q).astype(correct.dtype) + answered_log_q + log_weights
+    max_log_lik = log_lik.max(axis=1, keepdims=True)
+    # Flooring at exp(-60) keeps negligible weights out of the (very slow) denormal float range
+    posterior = np.exp(np.maximum(log_lik - max_log_lik, -60))
+    marginal = posterior.sum(axis=1, keepdims=True)
+    posterior *= counts[:, None] / marginal
+    log_likelihood = float((counts * (np.log(marginal[:, 0]) + max_log_lik[:, 0])).sum())
+    return posterior, log_likelihood
+
+def _expected_counts(correct, valid, counts, a, d, c, theta, log_weights):
+    """
+    E-step on collapsed patterns: expected number of correct answers and of answers per item and
+    quadrature point, expected number of examinees per point, and the marginal log-likelihood.
+    """
+    P = np.clip(c[:, None] + (1 - c[:, None]) * expit(a[:, None] * theta + d[:, None]), 1e-10, 1 - 1e-10)
+    posterior, log_likelihood = _posterior(correct, valid, counts, np.log(P), np.log1p(-P), log_weights)
+    posterior = posterior.astype(np.float32)
+    expected_correct = (correct.T @ posterior).astype(float)
+    examinees = posterior.sum(axis=0, dtype=float)
+    # Only examinees who answered an item contribute to its expected counts
+    if valid is None:
+        expected_total = np.broadcast_to(examinees, P.shape)
+    else:
+        expected_total = (valid.T @ posterior).astype(float)
+    return expected_correct, expected_total, examinees, log_likelihood
+
+def _maximize(theta, expected_correct, expected_total, a, d, c, model, guessing_prior, n_steps=5, fixed_slope=False):
+    """
+    M-step: Fisher scoring of every item at once on the expected counts of the E-step.
+
+    With fixed_slope the common 1PL slope is held at its current value.
+    """
+    for _ in range(n_steps):
+        psi = expit(a[:, None] * theta + d[:, None])
+        P = np.clip(c[:, None] + (1 - c[:, None]) * psi, 1e-10, 1 - 1e-10)
+        PQ = P * (1 - P)
+        residual = (expected_correct - expected_total * P) / PQ
+        dpsi = (1 - c[:, None]) * psi * (1 - psi)
+
+        # Derivatives of P with respect to each free parameter, stacked as (items x params x points)
+        derivatives = [dpsi] if model == '1PL' else [dpsi * theta, dpsi]
+        if model == '3PL':
+            derivatives.append(1 - psi)
+        D = np.stack(derivatives, axis=1)
+        gradient = np.einsum('ikq,iq->ik', D, residual)
+        information = np.einsum('ikq,ilq,iq->ikl', D, D, expected_total / PQ)
+
+        if model == '3PL' and guessing_prior is not None:
+            alpha, beta = guessing_prior
+            gradient[:, 2] += (alpha - 1) / c - (beta - 1) / (1 - c)
+            information[:, 2, 2] += (alpha - 1) / c ** 2 + (beta - 1) / (1 - c) ** 2
+
+        information += 1e-8 * np.eye(D.shape[1])
+        step = np.clip(np.linalg.solve(information, gradient[..., None])[..., 0], -1, 1)
+
+        if model == '1PL':
+            # Slope shared by all items: one scoring step on the pooled gradient and information
+            d = d + step[:, 0]
+            if not fixed_slope:
+                slope_derivative = dpsi * theta
+                a_step = (slope_derivative * residual).sum() / max((slope_derivative ** 2 * expected_total / PQ).sum(), 1e-8)
+                a = np.clip(a + np.clip(a_step, -0.5, 0.5), *SLOPE_BOUNDS)
+        else:
+            a = np.clip(a + step[:, 0], *SLOPE_BOUNDS)
+            d = d + step[:, 1]
+            if model == '3PL':
+                c = np.clip(c + np.clip(step[:, 2], -0.1, 0.1), 1e-4, 0.5)
+        if np.abs(step).max() < 1e-6:
+            break
+    return a, d, c
+
+def calibrate(responses, model='3PL', n_points=41, max_iter=500, tol=1e-4, init=None, guessing_prior=(5, 17)):
+    """
+    Marginal maximum likelihood calibration (Bock-Aitkin EM) of a 1PL, 2PL or 3PL model.
+
+    Every EM cycle is vectorized over all items, all distinct response patterns and a fixed
+    quadrature grid, so the cost per cycle is a couple of matrix products.
+
+    Parameters:
+    - responses: ResponseMatrix with the encoded student responses.
+    - model: '1PL', '2PL' or '3PL'.
+    - n_points: Number of points in the quadrature grid over a standard normal ability distribution.
+    - max_iter: Maximum number of EM cycles.
+    - tol: Convergence threshold on the largest parameter change between two cycles.
+    - init: Previous IRTCalibration (or its items DataFrame) used as a warm start.
+    - guessing_prior: Beta(alpha, beta) prior on the 3PL guessing parameter, None to disable it.
+
+    Returns:
+    - An IRTCalibration with the Discrimination, Difficulty and Guessing of each item.
+    """
+    if model not in MODELS:
+        raise ValueError(f"Unknown IRT model '{model}'. Choose one of {', '.join(MODELS)}.")
+
+    theta, weights = quadrature_grid(n_points)
+    log_weights = np.log(weights)
+
+    # Examinees with the same correctness pattern share the same posterior
+    first, _, counts = responses.unique_patterns()
+    # Single precision halves the cost of the large matrix products per cycle
+    patterns = responses.subset(first)
+    correct = patterns.correct.astype(np.float32)
+    valid = patterns.valid.astype(np.float32) if responses.has_missing else None
+    counts = counts.astype(float)
+
+    a, d, c = _starting_values(responses, model, init)
+    log_likelihood = -np.inf
+    converged = False
+    for n_iter in range(1, max_iter + 1):
+        # E-step: expected number of examinees and of correct answers at each quadrature point
+        expected_correct, expected_total, _, log_likelihood = _expected_counts(correct, valid, counts, a, d, c, theta, log_weights)
+
+        # M-step
+        new_a, new_d, new_c = _maximize(theta, expected_correct, expected_total, a, d, c, model, guessing_prior)
+        change = max(np.abs(new_a - a).max(), np.abs(new_d - d).max(), np.abs(new_c - c).max())
+        a, d, c = new_a, new_d, new_c
+        if change < tol:
+            converged = True
+            break
+
+    items = pd.DataFrame({
+        "Item": responses.item_labels,
+        "Difficulty": -d / a,
+        "Discrimination": a,
+        "Guessing": c
     })
-    
-    return irt_metrics_df
+    return IRTCalibration(model, items, theta, weights, log_likelihood, n_iter, converged)
 
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import streamlit as st
+@dataclass
+class GroupCalibration:
+    """Item parameters per group (groups x items) and group ability distributions estimated by calibrate_groups."""
+    model: str
+    a: np.ndarray
+    d: np.ndarray
+    c: np.ndarray
+    means: np.ndarray
+    sds: np.ndarray
+    log_likelihood: float
+    n_iter: int
+    converged: bool
 
-# Assuming calculate_irt_metrics is defined elsewhere
-def create_irt_report(df):
-    # Assuming the first row contains the correct answers
-    correct_answers = df.iloc[1].tolist()
-    students_answers_df = df.iloc[2:].reset_index(drop=True)
-    irt_metrics_df = calculate_irt_metrics(correct_answers, students_answers_df.values.tolist())
+def calibrate_groups(correct, valid, counts, groups, n_groups, constrained, model='2PL', n_points=41,
+                     max_iter=500, tol=1e-4, init=None, guessing_prior=(5, 17)):
+    """
+    Multiple-group EM calibration on collapsed response patterns.
 
-    # Convert to a list for report
-    report = []
+    Items flagged in constrained share their parameters across groups (anchors); the others are
+    estimated separately in every group. Group 0 is the reference group with a standard normal
+    ability distribution; the mean and SD of every other group are estimated.
 
-    # Generate an ICC plot for each question based on IRT metrics
-    for idx, row in irt_metrics_df.iterrows():
-        col1, col2 = st.columns(2)
-        item_name = f'Item {row["Item"]}'
+    Parameters:
+    - correct, valid: (patterns x items) float32 arrays; valid is None when nothing is missing.
+    - counts: Number of examinees sharing each pattern.
+    - groups: Group code (0 to n_groups - 1) of each pattern.
+    - constrained: Boolean array, True for items held equal across groups.
+    - init: GroupCalibration, or an IRTCalibration / items DataFrame shared by all groups, to start from.
 
-        # Plot the ICC (Item Characteristic Curve) in the left column
-        with col1:
-            fig, ax = plt.subplots(figsize=(8, 6))
-            
-            # Generate a range of theta values (latent trait levels)
-            theta = np.linspace(-3, 3, 100)
-            a = row['Discrimination']
-            b = row['Difficulty']
-            c = row['Guessing']
+    Returns:
+    - A GroupCalibration.
+    """
+    if model not in MODELS:
+        raise ValueError(f"Unknown IRT model '{model}'. Choose one of {', '.join(MODELS)}.")
+
+    theta, _ = quadrature_grid(n_points)
+    if isinstance(init, GroupCalibration):
+        a, d, c = init.a.copy(), init.d.copy(), init.c.copy()
+        means, sds = init.means.copy(), init.sds.copy()
+    else:
+        items = init.items if isinstance(init, IRTCalibration) else init
+        a = np.tile(items['Discrimination'].to_numpy(dtype=float), (n_groups, 1))
+        d = -a * items['Difficulty'].to_numpy(dtype=float)
+        c = np.tile(items['Guessing'].to_numpy(dtype=float), (n_groups, 1))
+        means, sds = np.zeros(n_groups), np.ones(n_groups)
+
+    rows = [np.flatnonzero(groups == g) for g in range(n_groups)]
+    free = ~constrained
+    log_likelihood = -np.inf
+    converged = False
+    for n_iter in range(1, max_iter + 1):
+        expected_correct = np.zeros((n_groups,) + a.shape[1:] + theta.shape)
+        expected_total = np.zeros_like(expected_correct)
+        log_likelihood = 0.0
+        new_means, new_sds = means.copy(), sds.copy()
+        for g in range(n_groups):
+            # Each group integrates over its own normal ability distribution on the shared grid
+            log_weights = -0.5 * ((theta - means[g]) / sds[g]) ** 2
+            log_weights -= np.log(np.exp(log_weights).sum())
+            group_valid = None if valid is None else valid[rows[g]]
+            expected_correct[g], expected_total[g], examinees, group_log_likelihood = _expected_counts(
+                correct[rows[g]], group_valid, counts[rows[g]], a[g], d[g], c[g], theta, log_weights)
+            log_likelihood += group_log_likelihood
+            if g > 0 and examinees.sum() > 0:
+                new_means[g] = examinees @ theta / examinees.sum()
+                new_sds[g] = np.sqrt(max(examinees @ (theta - new_means[g]) ** 2 / examinees.sum(), 1e-4))
+
+        # M-step: anchors on the counts pooled over groups, free items within each group
+        new_a, new_d, new_c = a.copy(), d.copy(), c.copy()
+        if constrained.any():
+            pooled = _maximize(theta, expected_correct[:, constrained].sum(axis=0), expected_total[:, constrained].sum(axis=0),
+                               a[0, constrained], d[0, constrained], c[0, constrained], model, guessing_prior, fixed_slope=True)
+            for parameter, value in zip((new_a, new_d, new_c), pooled):
+                parameter[:, constrained] = value
+        if free.any():
+            for g in range(n_groups):
+                separate = _maximize(theta, expected_correct[g, free], expected_total[g, free],
+                                     a[g, free], d[g, free], c[g, free], model, guessing_prior, fixed_slope=True)
+                for parameter, value in zip((new_a, new_d, new_c), separate):
+                    parameter[g, free] = value
+
+        change = max(np.abs(new_a - a).max(), np.abs(new_d - d).max(), np.abs(new_c - c).max(),
+                     np.abs(new_means - means).max(), np.abs(new_sds - sds).max())
+        a, d, c, means, sds = new_a, new_d, new_c, new_means, new_sds
+        if change < tol:
+            converged = True
+            break
+
+    return GroupCalibration(model, a, d, c, means, sds, log_likelihood, n_iter, converged)
 
-            # Calculate probabilities using the IRT 3PL model
-            probabilities = c + (1 - c) / (1 + np.exp(-a * (theta - b)))
+def calculate_irt_metrics(responses, model='3PL', init=None):
+    """Generates a DataFrame of calibrated IRT parameters for each item."""
+    return calibrate(responses, model=model, init=init).items
 
-            ax.plot(theta, probabilities, color='blue', label=f'{item_name} ICC')
-            ax.set_title(f'Item Characteristic Curve: {item_name}')
-            ax.set_xlabel('Theta')
-            ax.set_ylabel('Probability of Correct Response')
-            ax.legend()
+def create_irt_report(responses, model='3PL', init=None, calibration=None):
+    """Calibrate the items (unless a calibration is given) and show the ICC and parameters of every item, paginated."""
+    if calibration is None:
+        calibration = calibrate(responses, model=model, init=init)
+    irt_metrics_df = calibration.items
 
-            st.pyplot(fig)
+    if not calibration.converged:
+        st.warning(f"Calibration did not converge after {calibration.n_iter} EM cycles.")
+    flagged = irt_metrics_df.loc[calibration.flagged_items(), 'Item']
+    if len(flagged):
+        st.warning(f"Items {', '.join(map(str, flagged))} do not discriminate positively (discrimination at the "
+                   f"lower bound of {SLOPE_BOUNDS[0]}); check their answer key.")
+
+    # Render the ICC plots of the current page in parallel, cached by item parameters
+    page = paginate(len(irt_metrics_df), key='irt_page')
+    rows = irt_metrics_df.iloc[list(page)]
+    images = render_many([
+        ('icc', (f'Item Characteristic Curve: Item {row.Item}',
+                 ((f'Item {row.Item} ICC', row.Discrimination, row.Difficulty, row.Guessing),)))
+        for row in rows.itertuples()
+    ])
+
+    for (_, row), image in zip(rows.iterrows(), images):
+        col1, col2 = st.columns(2)
+        item_name = f'Item {row["Item"]}'
+
+        # Show the ICC (Item Characteristic Curve) in the left column
+        with col1:
+            st.image(image)
 
         # Display the IRT metrics in the right column
         with col2:
             st.subheader(f'IRT Metrics for {item_name}')
             st.table(pd.DataFrame({
                 'Metric': ['Difficulty', 'Discrimination', 'Guessing'],
-                'Value': [b, a, c]
+                'Value': [row['Difficulty'], row['Discrimination'], row['Guessing']]
             }))
 
-    return report
+    return calibration
@@ -0,0 +1,306 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, CancelledError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")  # 'openai' or 'stub'
+LLM_BASE_URL = os.getenv("LLM_BASE_URL")  # OpenAI-compatible endpoint, e.g. the MockLLMServer
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "90000"))
+LLM_MAX_COMPLETION_TOKENS = 256  # Completion size reserved for every request before its length is known
+
+class StubLLM:
+    """
+    Local stand-in for the LangChain OpenAI model, for tests and offline runs.
+
+    responder maps a prompt to the completion text (an empty string by default); every prompt
+    is recorded in calls. latency simulates the round-trip time of a real request.
+    """
+
+    model_name = 'stub'
+
+    def __init__(self, responder=None, latency=0.0):
+        self.responder = responder or (lambda prompt: '')
+        self.latency = latency
+        self.calls = []
+
+    def invoke(self, prompt):
+        self.calls.append(prompt)
+        time.sleep(self.latency)
+        return self.responder(prompt)
+
+    async def ainvoke(self, prompt):
+        self.calls.append(prompt)
+        await asyncio.sleep(self.latency)
+        return self.responder(prompt)
+
+    async def astream(self, prompt):
+        """Yield the completion word by word, like a streaming model."""
+        text = await self.ainvoke(prompt)
+        for i, word in enumerate(text.split(' ')):
+            yield (' ' if i else '') + word
+
+    def __call__(self, prompt):
+        return self.invoke(prompt)
+
+def create_llm():
+    """LangChain OpenAI model (against LLM_BASE_URL if set), or a StubLLM when LLM_BACKEND is 'stub'."""
+    if LLM_BACKEND == 'stub':
+        return StubLLM()
+    from langchain.llms import OpenAI
+    if LLM_BASE_URL:
+        return OpenAI(openai_api_key=os.getenv("OPENAI_API_KEY", "mock"), openai_api_base=LLM_BASE_URL)
+    return OpenAI(openai_api_key=os.getenv("OPENAI_API_KEY"))
+
+def model_name(llm):
+    """Name of the model behind an LLM object, part of every cache key of its completions."""
+    return getattr(llm, 'model_name', type(llm).__name__)
+
+def estimate_tokens(text):
+    """Rough token count of a text (about four characters per token)."""
+    return len(text) // 4 + 1
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at rate_per_minute, holding at most one minute of tokens.
+
+    reserve takes tokens right away and returns how long the caller has to wait before using
+    them, so the same bucket serves threads (time.sleep) and event loops (asyncio.sleep) alike.
+    The balance may go negative, which queues later callers behind earlier ones.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def settle(self, amount):
+        """Charge (or, when negative, refund) the difference between a reservation and the actual use, up to capacity."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+class LLMGateway:
+    """
+    Process-wide front of one LLM client, shared by every Streamlit session.
+
+    Every request first reserves a request and its estimated tokens from two token buckets
+    (requests/min and tokens/min) and waits until they are available; the completion tokens are
+    charged once the response arrived. Identical prompts in flight at the same time are sent
+    only once, and the other callers get the same completion (or send it themselves when the
+    request was cancelled before it finished). The gateway has the interface of
+    the LLM it wraps (invoke, ainvoke, astream), so callers do not need to know about it.
+    """
+
+    def __init__(self, llm, requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE):
+        self.llm = llm
+        self.model_name = model_name(llm)
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._in_flight = {}  # Prompt -> Future of its completion
+        self._lock = threading.Lock()
+        self._metrics = {'queued': 0, 'in_flight': 0, 'requests': 0, 'coalesced': 0, 'errors': 0, 'wait_seconds': 0.0}
+
+    def metrics(self):
+        """Queue depth (requests waiting for the rate limits), requests in flight and running totals."""
+        with self._lock:
+            return dict(self._metrics)
+
+    def _count(self, **changes):
+        with self._lock:
+            for name, change in changes.items():
+                self._metrics[name] += change
+
+    def _join(self, prompt):
+        """Future of an identical request in flight (and False), or a new Future this caller has to fulfil (and True)."""
+        with self._lock:
+            if prompt in self._in_flight:
+                self._metrics['coalesced'] += 1
+                return self._in_flight[prompt], False
+            future = self._in_flight[prompt] = Future()
+            return future, True
+
+    def _reserve(self, prompt):
+        return max(self.requests.reserve(1), self.tokens.reserve(estimate_tokens(prompt) + LLM_MAX_COMPLETION_TOKENS))
+
+    def _release(self, prompt):
+        """Give back the reservation of a request that never started."""
+        self.requests.settle(-1)
+        self.tokens.settle(-(estimate_tokens(prompt) + LLM_MAX_COMPLETION_TOKENS))
+
+    def _finish(self, prompt, future, text=None, error=None, started=True):
+        """
+        Resolve the Future of a request and release its prompt, on every exit path of the leader.
+
+        started is False when the request failed or was cancelled while still queued for the
+        rate limits; it then leaves the queue instead of the requests in flight.
+        """
+        with self._lock:
+            del self._in_flight[prompt]
+            if started:
+                self._metrics['in_flight'] -= 1
+                self._metrics['requests'] += 1
+                self._metrics['errors'] += error is not None
+            else:
+                self._metrics['queued'] -= 1
+        if error is None:
+            # Settle the reservation with the actual completion size
+            self.tokens.settle(estimate_tokens(text) - LLM_MAX_COMPLETION_TOKENS)
+            future.set_result(text)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            # Cancelled (or interrupted) leader: coalesced callers send the request themselves
+            future.cancel()
+
+    def _start(self, wait):
+        self._count(queued=-1, in_flight=1, wait_seconds=wait)
+
+    def invoke(self, prompt):
+        future, leader = self._join(prompt)
+        while not leader:
+            try:
+                return future.result()
+            except CancelledError:
+                future, leader = self._join(prompt)
+        self._count(queued=1)
+        reserved = started = False
+        try:
+            wait = self._reserve(prompt)
+            reserved = True
+            time.sleep(wait)
+            self._start(wait)
+            started = True
+            text = self.llm.invoke(prompt)
+        except BaseException as e:
+            if reserved and not started:
+                self._release(prompt)
+            self._finish(prompt, future, error=e, started=started)
+            raise
+        self._finish(prompt, future, text)
+        return text
+
+    async def ainvoke(self, prompt):
+        text = ''
+        async for chunk in self.astream(prompt):
+            text += chunk
+        return text
+
+    async def astream(self, prompt):
+        """Stream the completion; a caller coalesced with an identical request gets it as one chunk."""
+        future, leader = self._join(prompt)
+        while not leader:
+            try:
+                # Shielded, so cancelling this caller does not cancel the shared request
+                yield await asyncio.shield(asyncio.wrap_future(future))
+                return
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                future, leader = self._join(prompt)
+        self._count(queued=1)
+        reserved = started = False
+        text = ''
+        try:
+            wait = self._reserve(prompt)
+            reserved = True
+            await asyncio.sleep(wait)
+            self._start(wait)
+            started = True
+            async for chunk in self.llm.astream(prompt):
+                text += chunk
+                yield chunk
+        except BaseException as e:
+            if reserved and not started:
+                self._release(prompt)
+            self._finish(prompt, future, error=e, started=started)
+            raise
+        self._finish(prompt, future, text)
+
+    def __call__(self, prompt):
+        return self.invoke(prompt)
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+def get_gateway():
+    """The process-wide LLMGateway around create_llm(), created on first use."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway(create_llm())
+        return _gateway
+
+class MockLLMServer:
+    """
+    Local OpenAI-compatible completions endpoint for testing, with optional latency.
+
+    Serves POST /v1/completions (streamed or not) with the text of responder(prompt). Start it
+    and point the app at it with LLM_BASE_URL=http://127.0.0.1:<port>/v1.
+    """
+
+    def __init__(self, responder=None, port=0, latency=0.0):
+        responder = responder or (lambda prompt: f"Mock completion of a {len(prompt)} character prompt.")
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, so clients can reuse connections
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                prompt = body.get('prompt', '')
+                prompt = prompt[0] if isinstance(prompt, list) else prompt
+                time.sleep(latency)
+                text = responder(prompt)
+                if body.get('stream'):
+                    chunks = [{'choices': [{'text': (' ' if i else '') + word, 'index': 0, 'finish_reason': None}]}
+                              for i, word in enumerate(text.split(' '))]
+                    payload = b''.join(f"data: {json.dumps(chunk)}\n\n".encode() for chunk in chunks) + b"data: [DONE]\n\n"
+                    content_type = 'text/event-stream'
+                else:
+                    payload = json.dumps({
+                        'id': 'mock', 'object': 'text_completion', 'model': body.get('model', 'mock'),
+                        'choices': [{'text': text, 'index': 0, 'finish_reason': 'stop', 'logprobs': None}],
+                        'usage': {'prompt_tokens': estimate_tokens(prompt), 'completion_tokens': estimate_tokens(text),
+                                  'total_tokens': estimate_tokens(prompt) + estimate_tokens(text)},
+                    }).encode()
+                    content_type = 'application/json'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.port = self.server.server_address[1]
+        self.base_url = f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == '__main__':
+    server = MockLLMServer(port=int(os.getenv("MOCK_LLM_PORT", "8001")))
+    print(f"Mock LLM server on {server.base_url}")
+    server.server.serve_forever()
@@ -1,8 +1,16 @@
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import streamlit as st
 import networkx as nx
+import scipy.sparse as sp
+from matplotlib.collections import LineCollection
+from matplotlib import colormaps
+from matplotlib.colors import to_rgba
+from figures import plot, render, as_tuple
+from graph_layout import cached_layout
+from ctt import score_groups
+
+MAX_LABELS = 60  # Labels drawn per network, for the nodes of highest degree
 
 def generate_bipartite_graph(metrics_df):
     # Create a bipartite graph
@@ -40,24 +48,17 @@ def generate_bipartite_graph(metrics_df):
     return B
 
 def plot_bipartite_graph(B):
-    plt.figure(figsize=(12, 8))
-
-    # Get the positions for nodes in a bipartite layout
-    pos = nx.bipartite_layout(B, nodes=[n for n in B.nodes() if n in B.nodes() if isinstance(n, int)])  # Questions are integers
-
-    # Draw the bipartite graph
-    nx.draw_networkx_nodes(B, pos, nodelist=[n for n in B.nodes() if isinstance(n, int)], node_color='skyblue', label='Questions')
-    nx.draw_networkx_nodes(B, pos, nodelist=[n for n in B.nodes() if isinstance(n, str)], node_color='lightgreen', label='Topics')
-    nx.draw_networkx_edges(B, pos, width=2, alpha=0.5, edge_color='gray')
-    nx.draw_networkx_labels(B, pos, font_size=10)
-
-    plt.title("Bipartite Graph of Questions and Topics")
-    plt.axis('off')  # Turn off the axis
-    plt.legend()  # Add legend to differentiate questions and topics
-    
-    # Use Streamlit to display the plot
-    st.pyplot(plt)  # Display the figure in Streamlit
-    plt.clf()  # Clear the figure to avoid overlapping in future plots
+    """Draw the question-topic graph in a bipartite layout, questions (integer nodes) on one side."""
+    nodes = list(B.nodes())
+    questions = [n for n in nodes if isinstance(n, int)]
+    pos = nx.bipartite_layout(B, nodes=questions)
+    positions = np.array([pos[n] for n in nodes]).reshape(-1, 2)
+    index = {n: i for i, n in enumerate(nodes)}
+    edges = tuple((index[u], index[v]) for u, v in B.edges())
+    colors = tuple('skyblue' if isinstance(n, int) else 'lightgreen' for n in nodes)
+    params = ("Bipartite Graph of Questions and Topics", as_tuple(positions.ravel()), (300,) * len(nodes), colors,
+              edges, (0.5,) * len(edges), tuple((i, str(n)) for i, n in enumerate(nodes)))
+    st.image(render('network', params, figsize=(12, 8)))
 
 def generate_topic_graph(metrics_df):
     # Create a directed graph
@@ -85,22 +86,22 @@ def generate_topic_graph(metrics_df):
 
 
 def plot_topic_graph(G):
-    plt.figure(figsize=(12, 8))
-    pos = nx.spring_layout(G)  # Positions for all nodes
-
-    # Draw nodes and edges
-    nx.draw_networkx_nodes(G, pos, node_size=700, node_color='skyblue')
-    nx.draw_networkx_edges(G, pos, width=2, alpha=0.5, edge_color='gray')
-    nx.draw_networkx_labels(G, pos, font_size=12)
-
-    plt.title("Topic Relationship Graph")
-    plt.axis('off')  # Turn off the axis
-    
-    # Use Streamlit to display the plot
-    st.pyplot(plt)  # Display the figure in Streamlit
-    plt.clf()  # Clear the figure to avoid overlapping in future plots
-
-def create_network_report(metrics_df, questions_df, difficulty_col='difficulty-rate', question_col='question_number', topic_col='mapped_topics'):
+    # Positions for all nodes, computed once per graph
+    nodes = list(G.nodes())
+    adjacency = nx.to_scipy_sparse_array(G, nodelist=nodes, weight=None, format='csr')
+    positions = cached_layout(adjacency)
+    rows, columns = sp.triu(adjacency).nonzero()
+    labels = tuple((i, str(node)) for i, node in enumerate(nodes))
+    params = ("Topic Relationship Graph", as_tuple(positions.ravel()), (700,) * len(nodes), ('skyblue',) * len(nodes),
+              tuple(zip(rows.tolist(), columns.tolist())), (0.5,) * len(rows), labels)
+    st.image(render('network', params, figsize=(12, 8)))
+
+def merge_question_info(metrics_df, questions_df, question_col='question_number', topic_col='mapped_topics'):
+    """Merge the item metrics with the mapped topics of each question."""
+    # Metrics carry the item labels of the response matrix, which match the question numbers
+    return pd.merge(metrics_df, questions_df[[question_col, topic_col]], on=question_col)
+
+def create_network_report(metrics_df, questions_df, difficulty_col='difficulty-rate', question_col='question_number', topic_col='mapped_topics', merged_df=None):
     """
     Generate a network report visualizing the relationship between question difficulty and topics.
 
@@ -110,23 +111,13 @@ def create_network_report(metrics_df, questions_df, difficulty_col='difficulty-r
     - difficulty_col: Column name for difficulty metrics.
     - question_col: Column name for questions.
     - topic_col: Column name for mapped topics.
+    - merged_df: Result of merge_question_info, when already computed.
     """
-
-    # Merge the metrics DataFrame with the questions DataFrame on the question column
-    print(metrics_df)
-    print(questions_df)
-    # Adjust the question_number in metrics_df to match the range in questions_df
-    metrics_df['question_number'] += questions_df['question_number'].min()
-
-    # Merge after transformation
-    merged_df = pd.merge(metrics_df, questions_df[[question_col, topic_col]], on=question_col)
-
-    # merged_df = pd.merge(metrics_df, questions_df[[question_col, topic_col]], on=question_col)
+    if merged_df is None:
+        merged_df = merge_question_info(metrics_df, questions_df, question_col, topic_col)
 
     # Check if the merged DataFrame is not empty
     if not merged_df.empty:
-        plt.figure(figsize=(12, 6))
-        
         st.dataframe(merged_df)
         st.session_state.question_info_df = merged_df
         G = generate_bipartite_graph(merged_df)
@@ -138,73 +129,295 @@ def create_network_report(metrics_df, questions_df, difficulty_col='difficulty-r
     else:
         return "Error: Merged DataFrame is empty. Check your input data."
 
-def create_full_network(student_scores_df, question_info_df, student_dif_df):
+def _question_topics(mapped_topics):
+    """Clean list of the topics mapped to one question (a list or a comma-separated string)."""
+    if isinstance(mapped_topics, str):
+        mapped_topics = mapped_topics.split(",")
+    if not isinstance(mapped_topics, (list, tuple, np.ndarray)):
+        return []
+    return [topic.strip() for topic in mapped_topics]
 
-    # Sample data frame structure:
-    # student_scores_df: columns -> ['student_id', 'question_id', 'got_it_right', 'total_score']
-    # question_info_df: columns -> ['question_id', 'topic', 'difficulty']
-    # student_dif_df: columns -> ['student_id', 'class']
+def topic_incidence(question_info_df, question_numbers):
+    """
+    Sparse question x topic incidence matrix of the mapped topics, and the topic names.
 
-    # Initialize the graph
-    G = nx.Graph()
-    question_info_df['question_number'] -= question_info_df['question_number'].min()
-
-    # Step 1: Add student nodes with color by class and size by total score
-    student_classes_dict = student_dif_df.set_index('student_id')['TP_SEXO'].to_dict()
-    class_colors = {'M': 'red', 'F': 'blue'}  # Example colors for each class
-
-    # Set a size scaling factor for student nodes based on their total score
-    for _, row in student_scores_df[['student_id', 'Score']].drop_duplicates().iterrows():
-        student_id = row['student_id']
-        total_score = row['Score']
-        student_class = student_classes_dict.get(student_id, 'Unknown')
-        color = class_colors.get(student_class, 'gray')
-        size = 50 + 20 * total_score  # Adjust base size and scaling factor as needed
-        G.add_node(student_id, type='student', color=color, size=size)
-
-    # Step 2: Add question nodes with size by difficulty
-    difficulty_dict = question_info_df.set_index('question_number')['difficulty-rate'].to_dict()
-    for question_id, difficulty in difficulty_dict.items():
-        G.add_node(question_id, type='question', color='green', size=500 * difficulty)  # Scale the difficulty for visibility
-
-    # Step 3: Add topic nodes
-    topics = question_info_df['mapped_topics'].explode().unique()
-    for topic in topics:
-        G.add_node(topic, type='topic', color='orange')  # Color all topics the same for simplicity
-
-    for _, row in student_scores_df.iterrows():
-        student_id = row['student_id']
-        for question_number in student_scores_df.columns[1:]:  # Skip 'student_id' column
-            if row[question_number] == 1:  # Check if the student got the question right
-                G.add_edge(student_id, question_number)
-
-    # Step 5: Add edges between questions and their topics
-    for _, row in question_info_df.iterrows():
-        question = row['question_number']
-        topics = row['mapped_topics']
-        
-        # Check if topics is a list, then iterate to create an edge for each topic
-        if isinstance(topics, list):
-            for topic in topics:
-                G.add_edge(question, topic)
-        else:
-            G.add_edge(question, topics)  # if it's a single topic, directly add the edge
-
-    # Visualization
-    # Create a color and size map based on node attributes
-    node_colors = [G.nodes[node].get('color', 'gray') for node in G.nodes]
-    node_sizes = [G.nodes[node].get('size', 100) for node in G.nodes]  # Default size if 'size' attribute not set
-
-    # Draw the network
-    plt.figure(figsize=(12, 12))
-    pos = nx.spring_layout(G, seed=42)  # Use spring layout for better separation
-
-    nx.draw_networkx_nodes(G, pos, node_color=node_colors, node_size=node_sizes)
-    nx.draw_networkx_edges(G, pos, alpha=0.5)
-    nx.draw_networkx_labels(G, pos, font_size=8, font_color="black")
-
-    plt.title("Student-Question-Topic Network with Score-based Node Sizes")
-    plt.show()
-
-    st.pyplot(plt)  # Display the figure in Streamlit
-    plt.clf()  # Clear the figure to avoid overlapping in future plots
\ No newline at end of file
+    Rows follow question_numbers; questions without mapped topics (or missing from
+    question_info_df) have an empty row.
+    """
+    positions = pd.Index(question_info_df['question_number']).get_indexer(question_numbers)
+    question_topics = [_question_topics(question_info_df['mapped_topics'].iloc[position]) if position >= 0 else []
+                       for position in positions]
+    topics = sorted({topic for mapped_topics in question_topics for topic in mapped_topics})
+    topic_index = {topic: j for j, topic in enumerate(topics)}
+    rows = np.repeat(np.arange(len(question_topics)), [len(set(t)) for t in question_topics])
+    columns = np.array([topic_index[topic] for mapped_topics in question_topics for topic in dict.fromkeys(mapped_topics)], dtype=np.int64)
+    incidence = sp.csr_matrix((np.ones(len(columns), dtype=np.float32), (rows, columns)), shape=(len(question_topics), len(topics)))
+    return incidence, topics
+
+def _gram(matrix, block_rows=4096, dense_density=0.01):
+    """
+    Sparse MᵀM of a sparse matrix.
+
+    Answer matrices are rather dense (every student answers a large share of the questions
+    correctly), and so is their product; past dense_density it is accumulated with dense BLAS
+    products over row blocks, which is much faster than a sparse product with a dense result.
+    """
+    n_columns = matrix.shape[1]
+    density = matrix.nnz / max(matrix.shape[0] * n_columns, 1)
+    if density < dense_density or n_columns > 8192:
+        return (matrix.T @ matrix).tocsr()
+    gram = np.zeros((n_columns, n_columns), dtype=np.float32)
+    for start in range(0, matrix.shape[0], block_rows):
+        block = matrix[start:start + block_rows].toarray()
+        gram += block.T @ block
+    return sp.csr_matrix(gram)
+
+class StudentNetwork:
+    """
+    Student-question-topic network held as sparse biadjacency matrices.
+
+    answers links every student to the questions answered correctly (students x questions) and
+    incidence every question to its topics (questions x topics). Nodes are numbered students
+    first, then questions, then topics. Degrees, projections and neighbourhoods are sparse
+    matrix products; networkx graphs are only built for the small subsets that are drawn.
+    """
+
+    def __init__(self, student_ids, question_numbers, topics, answers, incidence, student_classes=None, scores=None, difficulty=None):
+        self.student_ids = np.asarray(student_ids)
+        self.question_numbers = np.asarray(question_numbers)
+        self.topics = np.asarray(topics, dtype=object)
+        self.answers = sp.csr_matrix(answers, dtype=np.float32)
+        self.incidence = sp.csr_matrix(incidence, dtype=np.float32)
+        self.student_classes = student_classes
+        self.scores = scores
+        self.difficulty = difficulty
+
+    @classmethod
+    def from_responses(cls, responses, question_info_df, student_info_df=None, class_column='TP_SEXO'):
+        """Network of a ResponseMatrix (or MappedResponses) and the questions with mapped topics."""
+        question_numbers = np.asarray(responses.item_labels)
+        student_ids = responses.student_ids.astype(str)
+        # Built block by block; only the correct answers are stored
+        answers = sp.vstack([sp.csr_matrix(correct, dtype=np.float32) for _, correct, _ in responses.blocks()]
+                            or [sp.csr_matrix((0, responses.n_items), dtype=np.float32)], format='csr')
+        incidence, topics = topic_incidence(question_info_df, question_numbers)
+
+        positions = pd.Index(question_info_df['question_number']).get_indexer(question_numbers)
+        difficulty = np.where(positions >= 0, question_info_df['difficulty-rate'].to_numpy()[positions], np.nan)
+        student_classes = None
+        if student_info_df is not None and class_column in student_info_df:
+            info = student_info_df.assign(student_id=student_info_df['student_id'].astype(str)).drop_duplicates('student_id')
+            student_classes = info.set_index('student_id')[class_column].reindex(student_ids).to_numpy()
+        return cls(student_ids, question_numbers, topics, answers, incidence, student_classes,
+                   responses.scores, difficulty)
+
+    @property
+    def n_students(self):
+        return self.answers.shape[0]
+
+    @property
+    def n_questions(self):
+        return self.answers.shape[1]
+
+    @property
+    def n_topics(self):
+        return self.incidence.shape[1]
+
+    @property
+    def labels(self):
+        """Label of every node, in node order."""
+        return np.concatenate([self.student_ids.astype(object), self.question_numbers.astype(object), self.topics])
+
+    @property
+    def node_types(self):
+        """'student', 'question' or 'topic' for every node, in node order."""
+        return np.repeat(np.array(['student', 'question', 'topic']), [self.n_students, self.n_questions, self.n_topics])
+
+    def adjacency(self):
+        """Symmetric adjacency matrix of the whole network, assembled from the two biadjacency blocks."""
+        return sp.bmat([[None, self.answers, None],
+                        [self.answers.T, None, self.incidence],
+                        [None, self.incidence.T, None]],
+                       format='csr', dtype=np.float32)
+
+    def degrees(self):
+        """Degree of every node, in node order."""
+        return np.concatenate([
+            np.asarray(self.answers.sum(axis=1)).ravel(),
+            np.asarray(self.answers.sum(axis=0)).ravel() + np.asarray(self.incidence.sum(axis=1)).ravel(),
+            np.asarray(self.incidence.sum(axis=0)).ravel(),
+        ]).astype(np.int64)
+
+    def degree_distribution(self, node_type=None):
+        """Number of nodes of each degree (index = degree), over all nodes or one node type."""
+        degrees = self.degrees()
+        if node_type is not None:
+            degrees = degrees[self.node_types == node_type]
+        return np.bincount(degrees)
+
+    def question_projection(self):
+        """Questions x questions matrix of the number of students answering both correctly."""
+        return _gram(self.answers)
+
+    def student_projection(self, students=None):
+        """Students x students matrix of the number of questions both answered correctly, optionally for a subset of rows."""
+        answers = self.answers if students is None else self.answers[students]
+        return _gram(answers.T.tocsr())
+
+    def topic_projection(self):
+        """Topics x topics matrix of the number of questions mapped to both topics."""
+        return (self.incidence.T @ self.incidence).tocsr()
+
+    def student_topic_counts(self):
+        """Students x topics matrix of the correct answers of each student in each topic."""
+        return (self.answers @ self.incidence).tocsr()
+
+    def neighbourhood(self, nodes, hops=1):
+        """Nodes within the given number of hops from the given node indices (included), as sorted indices."""
+        adjacency = self.adjacency()
+        reached = np.zeros(adjacency.shape[0], dtype=bool)
+        reached[np.asarray(nodes, dtype=np.int64)] = True
+        for _ in range(hops):
+            reached |= (adjacency @ reached.astype(np.float32)) > 0
+        return np.flatnonzero(reached)
+
+    def to_networkx(self, nodes=None):
+        """networkx graph of the subgraph induced by the given node indices (all nodes by default), with node attributes."""
+        nodes = np.arange(self.n_students + self.n_questions + self.n_topics) if nodes is None else np.asarray(nodes, dtype=np.int64)
+        G = nx.from_scipy_sparse_array(self.adjacency()[nodes][:, nodes])
+        labels, node_types = self.labels[nodes], self.node_types[nodes]
+        nx.set_node_attributes(G, {i: {'type': node_types[i], 'label': labels[i], 'index': int(nodes[i])} for i in range(len(nodes))})
+        return nx.relabel_nodes(G, {i: labels[i] for i in range(len(nodes))})
+
+    def aggregate_students(self, groups, n_groups):
+        """
+        Adjacency matrix of the network with the students collapsed into groups, and the group sizes.
+
+        Group g is linked to each question by the share of its students answering it correctly;
+        question-topic edges are kept. Nodes are numbered groups first, then questions, then topics.
+        """
+        membership = sp.csr_matrix((np.ones(self.n_students, dtype=np.float32), (groups, np.arange(self.n_students))),
+                                   shape=(n_groups, self.n_students))
+        group_sizes = np.asarray(membership.sum(axis=1)).ravel()
+        shares = sp.diags(1 / np.maximum(group_sizes, 1)) @ (membership @ self.answers)
+        adjacency = sp.bmat([[None, shares, None],
+                             [shares.T, None, self.incidence],
+                             [None, self.incidence.T, None]],
+                            format='csr', dtype=np.float32)
+        return adjacency, group_sizes
+
+@plot('network')
+def draw_network(ax, title, positions, sizes, colors, edges, edge_alphas, labels):
+    """
+    Nodes at precomputed positions with straight edges drawn as one LineCollection.
+
+    edges holds (source, target) node indices, edge_alphas the opacity of each edge and labels
+    (node index, text) pairs for the nodes to label.
+    """
+    positions = np.asarray(positions).reshape(-1, 2)
+    if edges:
+        edges = np.asarray(edges)
+        edge_colors = np.tile(to_rgba('gray'), (len(edges), 1))
+        edge_colors[:, 3] = edge_alphas
+        ax.add_collection(LineCollection(positions[edges], colors=edge_colors, linewidths=0.8, zorder=1))
+    ax.scatter(positions[:, 0], positions[:, 1], s=sizes, c=colors, zorder=2)
+    for node, text in labels:
+        ax.annotate(text, positions[node], fontsize=8, ha='center', va='center', zorder=3)
+    ax.set_title(title)
+    ax.axis('off')
+
+@plot('degree_distribution')
+def draw_degree_distribution(ax, title, series):
+    """Scatter of the number of nodes of each degree; series holds (label, degrees, frequencies) tuples."""
+    for label, degrees, frequencies in series:
+        ax.scatter(degrees, frequencies, edgecolor='black', alpha=0.75, label=label)
+    ax.set_title(title)
+    ax.set_xlabel('Degree')
+    ax.set_ylabel('Frequency')
+    ax.grid(alpha=0.5, linestyle='--')
+    ax.legend()
+
+def show_network_analytics(analytics, top=20):
+    """Show the degree distributions and the most central questions and topics of a NetworkAnalytics."""
+    series = []
+    for node_type in ('student', 'question'):
+        counts = analytics.degree_distributions[node_type]
+        degrees = np.flatnonzero(counts)
+        series.append((node_type.capitalize() + 's', tuple(degrees.tolist()), tuple(counts[degrees].tolist())))
+    st.image(render('degree_distribution', ('Degree Distribution', tuple(series)), figsize=(10, 6)))
+
+    st.subheader("Question Centrality")
+    st.write("Questions are linked by the number of students answering both correctly.")
+    st.dataframe(analytics.question_metrics.sort_values('pagerank', ascending=False).head(top), hide_index=True)
+    st.subheader("Topic Centrality")
+    st.write("Topics are linked by the number of questions mapped to both.")
+    st.dataframe(analytics.topic_metrics.sort_values('pagerank', ascending=False).head(top), hide_index=True)
+
+    st.subheader("Question Communities")
+    summary = analytics.question_metrics.groupby('community').agg(
+        questions=('question_number', 'count'),
+        members=('question_number', lambda numbers: ", ".join(map(str, numbers.iloc[:15])) + (" ..." if len(numbers) > 15 else "")),
+    ).reset_index()
+    st.dataframe(summary, hide_index=True)
+
+def _network_drawing(adjacency, sizes, colors, labels, title, max_labels=MAX_LABELS):
+    """Render parameters of a network: cached layout, edge opacity by weight and labels of the highest-degree nodes."""
+    positions = cached_layout(adjacency)
+    upper = sp.triu(adjacency).tocoo()
+    edge_alphas = 0.1 + 0.5 * upper.data / (upper.data.max() if upper.nnz else 1)
+    degree = np.diff(adjacency.tocsr().indptr)
+    labeled = np.sort(np.argsort(-degree, kind='stable')[:max_labels])
+    return (title, as_tuple(positions.ravel()), as_tuple(sizes), tuple(colors), tuple(zip(upper.row.tolist(), upper.col.tolist())),
+            as_tuple(edge_alphas), tuple((int(i), str(labels[i])) for i in labeled))
+
+def create_full_network(responses, question_info_df, student_dif_df, abilities_df=None, network=None,
+                        max_students=200, n_bins=10):
+    """
+    Draw the student-question-topic network.
+
+    Up to max_students students are drawn one by one; larger classes are collapsed into n_bins
+    score bins, linked to each question by the share of their students answering it correctly.
+    Layouts are cached per graph, so redrawing the same network skips the layout.
+
+    Parameters:
+    - responses: ResponseMatrix of the answer sheet.
+    - question_info_df: Item metrics with the mapped topics of each question.
+    - student_dif_df: Student information with a student_id and a TP_SEXO column.
+    - abilities_df: IRT abilities, used to size the student nodes when available.
+    - network: StudentNetwork of the inputs, when already built.
+    - max_students: Largest class drawn student by student.
+    - n_bins: Score bins of larger classes.
+    """
+    if network is None:
+        network = StudentNetwork.from_responses(responses, question_info_df, student_dif_df)
+
+    # Question and topic nodes: size by difficulty, one color per node type
+    question_sizes = 500 * np.nan_to_num(network.difficulty)  # Scale the difficulty for visibility
+    other_colors = ['green'] * network.n_questions + ['orange'] * network.n_topics
+    other_labels = list(network.question_numbers) + list(network.topics)
+
+    if network.n_students <= max_students:
+        # Student nodes: color by class, size by IRT ability when available, otherwise by total score
+        class_colors = {'M': 'red', 'F': 'blue'}  # Example colors for each class
+        sizes = 50 + 20 * network.scores.astype(float)
+        if abilities_df is not None:
+            theta = abilities_df.set_index(abilities_df['student_id'].astype(str))['Theta'].reindex(network.student_ids).to_numpy()
+            sizes = np.where(np.isnan(theta), sizes, 50 + 50 * (np.clip(theta, -3, 3) + 3))  # Map theta in [-3, 3] to [50, 350]
+        classes = network.student_classes if network.student_classes is not None else [None] * network.n_students
+        adjacency = network.adjacency()
+        node_sizes = np.concatenate([sizes, question_sizes, np.full(network.n_topics, 100)])
+        node_colors = [class_colors.get(student_class, 'gray') for student_class in classes] + other_colors
+        labels = list(network.student_ids) + other_labels
+        title = "Student-Question-Topic Network with Score-based Node Sizes"
+    else:
+        # Level of detail: one node per score bin, sized by its number of students
+        bins = score_groups(network.scores, n_bins)
+        adjacency, bin_sizes = network.aggregate_students(bins, n_bins)
+        node_sizes = np.concatenate([30 + 300 * bin_sizes / bin_sizes.max(), question_sizes, np.full(network.n_topics, 100)])
+        bin_colors = [tuple(c) for c in colormaps['Blues'](np.linspace(0.3, 1, n_bins))]
+        node_colors = bin_colors + other_colors
+        labels = [f"Bin {b + 1}" for b in range(n_bins)] + other_labels
+        title = f"Student-Question-Topic Network ({network.n_students} students in {n_bins} score bins)"
+        st.caption(f"{network.n_students} students are collapsed into {n_bins} score bins; edges show the share of each bin answering the question correctly.")
+
+    st.image(render('network', _network_drawing(adjacency, node_sizes, node_colors, labels, title), figsize=(12, 12)))
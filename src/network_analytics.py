@@ -0,0 +1,146 @@
+from dataclasses import dataclass
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+N_NEIGHBOURS = 10  # Strongest edges kept per node for community detection on dense projections
+
+@dataclass
+class NetworkAnalytics:
+    """Co-occurrence projections of a StudentNetwork with centrality and communities of their nodes."""
+    question_metrics: pd.DataFrame
+    topic_metrics: pd.DataFrame
+    question_projection: sp.csr_matrix
+    topic_projection: sp.csr_matrix
+    degree_distributions: dict
+
+def without_diagonal(matrix):
+    """Weighted adjacency matrix of a co-occurrence projection, dropping the self co-occurrences."""
+    matrix = sp.csr_matrix(matrix, dtype=np.float64)
+    matrix.setdiag(0)
+    matrix.eliminate_zeros()
+    return matrix
+
+def eigenvector_centrality(adjacency, max_iter=1000, tol=1e-8):
+    """
+    Eigenvector centrality of a weighted undirected graph by power iteration, scaled to unit length.
+
+    Iterates on A + I, which has the same leading eigenvector but converges on bipartite-like graphs too.
+    """
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    x = np.full(n, 1 / np.sqrt(n))
+    for _ in range(max_iter):
+        x_new = adjacency @ x + x
+        x_new /= np.linalg.norm(x_new) or 1
+        if np.abs(x_new - x).sum() < n * tol:
+            return x_new
+        x = x_new
+    return x
+
+def pagerank(adjacency, alpha=0.85, max_iter=200, tol=1e-10):
+    """PageRank of a weighted graph; the rank of nodes without edges is spread uniformly, as in networkx."""
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    out_weight = np.asarray(adjacency.sum(axis=1)).ravel()
+    dangling = out_weight == 0
+    transition = sp.diags(np.divide(1, out_weight, out=np.zeros(n), where=~dangling)) @ adjacency
+    transition_t = transition.T.tocsr()
+    x = np.full(n, 1 / n)
+    for _ in range(max_iter):
+        x_new = alpha * (transition_t @ x) + (alpha * x[dangling].sum() + 1 - alpha) / n
+        if np.abs(x_new - x).sum() < n * tol:
+            return x_new
+        x = x_new
+    return x
+
+def backbone(adjacency, n_neighbours=N_NEIGHBOURS):
+    """
+    Sparse backbone of a weighted graph: the n_neighbours edges of each node with the largest weight
+    above what the degrees of both ends predict (A_ij - k_i k_j / 2m), made symmetric.
+
+    Co-occurrence projections of large banks are nearly complete graphs; the backbone keeps the
+    edges that carry the community structure with O(nodes x n_neighbours) edges.
+    """
+    n = adjacency.shape[0]
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    total = degree.sum() or 1
+    rows, columns, weights = [], [], []
+    for start in range(0, n, 1024):
+        block = adjacency[start:start + 1024].toarray()
+        residual = block - np.outer(degree[start:start + 1024], degree) / total
+        residual[block == 0] = -np.inf
+        residual[np.arange(len(block)), np.arange(start, start + len(block))] = -np.inf
+        k = min(n_neighbours, n - 1)
+        if k <= 0:
+            break
+        top = np.argpartition(-residual, k - 1, axis=1)[:, :k]
+        keep = np.take_along_axis(residual, top, axis=1) > 0
+        block_rows = np.broadcast_to(np.arange(start, start + len(block))[:, None], top.shape)
+        rows.append(block_rows[keep])
+        columns.append(top[keep])
+        weights.append(np.take_along_axis(block, top, axis=1)[keep])
+    if not rows:
+        return sp.csr_matrix((n, n))
+    kept = sp.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(columns))), shape=(n, n))
+    return kept.maximum(kept.T).tocsr()
+
+def communities(adjacency, n_neighbours=N_NEIGHBOURS, seed=42):
+    """
+    Louvain community of every node of a weighted graph, numbered by decreasing community size.
+
+    Graphs with more than 4 x n_neighbours nodes are reduced to their backbone first.
+    """
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    if n > 4 * n_neighbours:
+        adjacency = backbone(adjacency, n_neighbours)
+    G = nx.from_scipy_sparse_array(adjacency)
+    found = sorted(nx.community.louvain_communities(G, weight='weight', seed=seed), key=len, reverse=True)
+    labels = np.zeros(n, dtype=np.int64)
+    for community, nodes in enumerate(found):
+        labels[list(nodes)] = community
+    return labels
+
+def _node_metrics(adjacency, seed):
+    """Weighted degree, eigenvector and PageRank centrality and community of every node of a projection."""
+    return {
+        'weighted-degree': np.asarray(adjacency.sum(axis=1)).ravel(),
+        'eigenvector-centrality': eigenvector_centrality(adjacency),
+        'pagerank': pagerank(adjacency),
+        'community': communities(adjacency, seed=seed),
+    }
+
+def analyze_network(network, seed=42):
+    """
+    Projections, degree distributions, centralities and communities of a StudentNetwork.
+
+    The question projection (AᵀA of the students x questions answers) weights each pair of
+    questions by the number of students answering both correctly; the topic projection (QᵀQ of
+    the questions x topics incidence) by the number of questions mapped to both topics.
+
+    Returns:
+    - A NetworkAnalytics with one metrics table per node type.
+    """
+    question_projection = without_diagonal(network.question_projection())
+    topic_projection = without_diagonal(network.topic_projection())
+    degrees = network.degrees()
+
+    question_metrics = pd.DataFrame({
+        'question_number': network.question_numbers,
+        'degree': degrees[network.n_students:network.n_students + network.n_questions],
+        'correct-answers': np.asarray(network.answers.sum(axis=0)).ravel().astype(np.int64),
+        **_node_metrics(question_projection, seed),
+    })
+    topic_metrics = pd.DataFrame({
+        'topic': network.topics,
+        'questions': np.asarray(network.incidence.sum(axis=0)).ravel().astype(np.int64),
+        **_node_metrics(topic_projection, seed),
+    })
+    degree_distributions = {node_type: network.degree_distribution(node_type) for node_type in ('student', 'question', 'topic')}
+    return NetworkAnalytics(question_metrics, topic_metrics, question_projection, topic_projection, degree_distributions)
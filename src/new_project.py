@@ -1,13 +1,18 @@
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
-from ctt import create_ctt_report, calculate_ctt_metrics
-from irt import create_irt_report
-from dif import create_dif_report
-from semantic import create_semantic_report, map_questions_to_topics, load_files
-from network import create_network_report, create_full_network
-from student_report import generate_student_report
-from explanation import create_explanations
+from ctt import create_ctt_report, calculate_ctt_metrics, calculate_distractor_metrics
+from irt import create_irt_report, calibrate
+from dif import run_dif_analysis, show_dif_report
+from semantic import map_questions_to_topics, load_questions, load_topics, display_question_mapping, plot_topic_distribution
+from network import create_network_report, create_full_network, merge_question_info, show_network_analytics, StudentNetwork
+from network_analytics import analyze_network
+from student_report import generate_student_report, export_student_reports, ClassReports, REPORT_FORMATS
+from explanation import create_explanations, build_explanation_index
+from ingest import open_answer_sheet, read_preview, UPLOAD_TYPES, MEMMAP_THRESHOLD_MB
+from scoring import score_theta, summed_score_table, score_from_table
+from figures import render, as_tuple
+from cache import cached, content_hash
+from pipeline import Pipeline
 
 import numpy as np
 from scipy.special import expit
@@ -16,11 +21,19 @@ from scipy.special import expit
 def reset_page():
     st.session_state.uploaded_file = None
     st.session_state.df = None
+    st.session_state.responses = None
+    st.session_state.calibration = None
+    st.session_state.abilities = None
+    st.session_state.ctt_report = False
+    st.session_state.dif_report = None
     st.session_state.home = True
     st.session_state.questions_file = None
     st.session_state.topics_file = None
     st.session_state.mapped_df = None
     st.session_state.info_file = None
+    st.session_state.pipeline_versions = {}
+    st.session_state.student_reports_ready = False
+    st.session_state.report_archive = None
 
 
 # Initialize session state
@@ -34,6 +47,16 @@ if 'info_file' not in st.session_state:
     st.session_state.info_file = None
 if 'df' not in st.session_state:
     st.session_state.df = None
+if 'responses' not in st.session_state:
+    st.session_state.responses = None
+if 'calibration' not in st.session_state:
+    st.session_state.calibration = None
+if 'abilities' not in st.session_state:
+    st.session_state.abilities = None
+if 'ctt_report' not in st.session_state:
+    st.session_state.ctt_report = False
+if 'dif_report' not in st.session_state:
+    st.session_state.dif_report = None
 if 'scores' not in st.session_state:
     st.session_state.scores = None
 if 'mapped_df' not in st.session_state:
@@ -96,70 +119,137 @@ def highlight_rows(row):
     else:
         return [''] * len(row)  # No color for other rows
 
-def calculate_scores(answer_sheet_df):
-    if answer_sheet_df.empty:
-        return None
-
-    answer_sheet_df.reset_index(inplace=True)
-    # Separate the correct answers and student responses
-    correct_answers = answer_sheet_df.iloc[1, 1:]  # Assumes second row has correct answers, ignoring first column
-    student_responses_df = answer_sheet_df.iloc[2:, 1:]  # Remaining rows are student responses
-
-    # Create a new DataFrame to store 1s and 0s for correct/incorrect answers
-    result_df = student_responses_df.apply(lambda row: row == correct_answers, axis=1).astype(int)
-    # Calculate and add the score for each student
-    result_df['Score'] = result_df.iloc[:].sum(axis=1)
-
-    # Add the student IDs back to the result DataFrame
-    result_df.insert(0, 'student_id', answer_sheet_df.iloc[2:, 0].values)
+def analysis_key():
+    """Cache key parts shared by every analysis of the current upload: its content hash and the blank handling."""
+    return (st.session_state.data_hash, st.session_state.blank_as_wrong)
 
-    result_df.reset_index(inplace=True, drop=True)
+def calculate_scores(responses):
+    if responses is None or responses.n_examinees == 0:
+        return None
 
-    return result_df
+    # Total scores are counted block by block from the encoded responses; no per-item columns are built
+    return responses.scores_frame()
 
 def plot_scores(scores):
-    plt.figure(figsize=(10, 6))
-    
-    # Determine the minimum and maximum scores for bin creation
-    min_score = scores["Score"].min()
-    max_score = scores["Score"].max()
-    
-    # Create bins for the histogram
-    bins = range(min_score, max_score + 2)  # +2 to include the maximum score
-    
-    plt.hist(scores["Score"], bins=bins, color='skyblue', edgecolor='black', width=0.8)
-    plt.title("Histogram of Scores")
-    plt.xlabel("Scores")
-    plt.ylabel("Frequency")
+    # Count the students with each score, from the minimum to the maximum score
+    min_score = int(scores["Score"].min())
+    frequencies = np.bincount(scores["Score"].to_numpy(dtype=int) - min_score)
+    score_values = tuple(range(min_score, min_score + len(frequencies)))
     
-    st.pyplot(plt)
+    st.image(render('score_histogram', ("Histogram of Scores", score_values, as_tuple(frequencies)), figsize=(10, 6)))
 
 # Function to generate a histogram for a selected item
-def plot_item_histogram(df, item_index):
-    # Select the item (column) and count the occurrences of each alternative
-    item_responses = df.iloc[1:, item_index]
-    counts = item_responses.value_counts(sort=False)
+def plot_item_histogram(responses, item_index):
+    # Count the occurrences of each alternative from the encoded responses
+    counts = responses.option_counts()[item_index, 1:]
+    chosen = np.flatnonzero(counts)
+    options = tuple(responses.option_labels[k] for k in chosen)
     
     # Plot the histogram
-    plt.figure(figsize=(10, 6))
-    counts.plot(kind='bar')
-    plt.title(f'Distribution of Responses for Item {item_index + 1}')
-    plt.xlabel('Alternatives')
-    plt.ylabel('Number of Students')
-    st.pyplot(plt)
+    title = f'Distribution of Responses for Item {item_index + 1}'
+    st.image(render('option_bars', (title, options, as_tuple(counts[chosen]), -1, 'Alternatives', 'Number of Students'), figsize=(10, 6)))
+
+# Analysis pipeline: parse -> score -> CTT -> IRT -> topics -> question_info -> reports.
+# Results live in st.session_state under the stage names and are recomputed only when an input changes.
+pipeline = Pipeline(st.session_state)
+
+@pipeline.stage('scores', ['responses'])
+def scores_stage(responses):
+    return calculate_scores(responses)
+
+@pipeline.stage('ctt_metrics', ['responses'])
+def ctt_metrics_stage(responses):
+    return cached('ctt', analysis_key(), lambda: calculate_ctt_metrics(responses))
+
+@pipeline.stage('distractor_metrics', ['responses'])
+def distractor_metrics_stage(responses):
+    return cached('distractors', analysis_key(), lambda: calculate_distractor_metrics(responses))
+
+@pipeline.stage('calibration', ['responses', 'irt_model'])
+def calibration_stage(responses, model):
+    # Warm-start from the previous calibration of the same model
+    previous = st.session_state.calibration
+    init = previous if previous is not None and previous.model == model else None
+    return cached('calibration', analysis_key() + (model,), lambda: calibrate(responses, model=model, init=init))
+
+@pipeline.stage('abilities', ['responses', 'calibration', 'estimator'])
+def abilities_stage(responses, calibration, estimator):
+    if estimator == "Summed score (EAP table)" and responses.has_missing:
+        # The table maps sums over every item; students who skipped items would get biased thetas
+        st.warning("The summed score table needs complete responses; abilities are estimated with EAP instead.")
+        estimator = "EAP"
+    if estimator == "Summed score (EAP table)":
+        # Score once per possible summed score, then look every student up by Score
+        table = summed_score_table(calibration)
+        abilities = score_from_table(calculate_scores(responses), table)
+        abilities.attrs['score_table'] = table
+        return abilities
+    return cached('abilities', analysis_key() + (calibration.model, estimator),
+                  lambda: score_theta(responses, calibration, method=estimator))
+
+@pipeline.stage('questions_df', ['questions_file'])
+def questions_stage(questions_file):
+    return load_questions(questions_file)
+
+@pipeline.stage('topics', ['topics_file'])
+def topics_stage(topics_file):
+    return load_topics(topics_file)
+
+@pipeline.stage('mapped_df', ['questions_df', 'topics'])
+def mapped_df_stage(questions_df, topics):
+    return map_questions_to_topics(questions_df.copy(), topics)
+
+@pipeline.stage('question_info_df', ['ctt_metrics', 'mapped_df'])
+def question_info_stage(ctt_metrics, mapped_df):
+    return merge_question_info(ctt_metrics, mapped_df)
+
+@pipeline.stage('student_network', ['responses', 'question_info_df', 'student_info'])
+def student_network_stage(responses, question_info_df, student_info):
+    return StudentNetwork.from_responses(responses, question_info_df, student_info)
+
+@pipeline.stage('network_analytics', ['responses', 'question_info_df'])
+def network_analytics_stage(responses, question_info_df):
+    # Cached per dataset and topic mapping, so reopening the Network tab is instant
+    topics_hash = content_hash(repr(question_info_df[['question_number', 'mapped_topics']].values.tolist()))
+    return cached('network_analytics', analysis_key() + (topics_hash,),
+                  lambda: analyze_network(StudentNetwork.from_responses(responses, question_info_df)))
+
+@pipeline.stage('class_reports', ['responses', 'question_info_df', 'student_info'])
+def class_reports_stage(responses, question_info_df, student_info):
+    # Every student's report figures in one batch; rendering a report is then a lookup
+    return ClassReports(responses, question_info_df, student_info)
 
 with tab1:
     st.header("Dataset")
     
     # Main dataset file upload
     
-    uploaded_file = st.file_uploader("Upload Main CSV (Required)", type=["csv"])
-    if uploaded_file is not None:
+    uploaded_file = st.file_uploader("Upload Main CSV (Required; also .csv.gz, .csv.zst, Parquet or Arrow)", type=UPLOAD_TYPES)
+    blank_as_wrong = st.checkbox("Treat blank answers as wrong (otherwise they are ignored as missing)")
+
+    # Stream the answer sheet into the encoded response matrix only once per upload;
+    # session state keeps the matrix and a preview of the first rows, never the raw table
+    new_upload = uploaded_file is not None and getattr(st.session_state.uploaded_file, 'file_id', None) != uploaded_file.file_id
+    if new_upload:
+        # Identical uploads (from any session) share every cached result through this hash
         st.session_state.uploaded_file = uploaded_file
-        st.session_state.df = pd.read_csv(uploaded_file, header=None)
-        st.session_state.df.set_index(st.session_state.df.columns[0], inplace=True)
+        st.session_state.data_hash = content_hash(uploaded_file.getvalue())
+        st.session_state.df = cached('answer_sheet_preview', (st.session_state.data_hash,), lambda: read_preview(uploaded_file, uploaded_file.name))
+    if new_upload or (st.session_state.df is not None and st.session_state.get('blank_as_wrong') != blank_as_wrong):
+        st.session_state.blank_as_wrong = blank_as_wrong
+        source = st.session_state.uploaded_file
+        if source.size > MEMMAP_THRESHOLD_MB * 1024 ** 2:
+            # Large uploads are memory-mapped from disk; pickling them into the cache would load them whole
+            st.session_state.responses = open_answer_sheet(source, source.name, st.session_state.data_hash, source.size, blank_as_wrong)
+        else:
+            st.session_state.responses = cached('responses', analysis_key(),
+                                                lambda: open_answer_sheet(source, source.name, st.session_state.data_hash, source.size, blank_as_wrong))
+        st.session_state.dif_report = None
+    if st.session_state.responses is not None:
+        pipeline.set_input('responses', st.session_state.responses, version=repr(analysis_key()))
     
     if st.session_state.df is not None:
+        st.caption(f"{st.session_state.responses.n_examinees} students and {st.session_state.responses.n_items} items loaded; showing the first rows.")
         styled_df = st.session_state.df.reset_index()
         st.dataframe(
             styled_df.style
@@ -172,9 +262,8 @@ with tab1:
 
         # Calculate scores button
         if st.button("Calculate Scores"):
-            scores = calculate_scores(st.session_state.df)
+            scores, = pipeline.run('scores')
             if scores is not None:
-                st.session_state.scores = scores
                 st.write("Scores for each student:")
                 st.dataframe(scores)
                 plot_scores(scores)
@@ -187,12 +276,12 @@ with tab1:
     # Optional questions CSV file
     questions_file = st.file_uploader("Upload Questions CSV (Optional)", type="csv")
     if questions_file:
-        st.session_state.questions_file = questions_file
+        pipeline.set_input('questions_file', questions_file, version=questions_file.file_id)
 
     # Optional topics TXT file
     topics_file = st.file_uploader("Upload Topics TXT (Optional)", type="txt")
     if topics_file:
-        st.session_state.topics_file = topics_file
+        pipeline.set_input('topics_file', topics_file, version=topics_file.file_id)
 
 
 # Tab 2: CTT Analysis
@@ -201,7 +290,11 @@ with tab2:
     if st.session_state.df is not None:
         # Create CTT Report
         if st.button("Create CTT Report"):
-            report = create_ctt_report(st.session_state.df)
+            st.session_state.ctt_report = True
+        # Keep the report on screen while the user pages through the items
+        if st.session_state.ctt_report:
+            ctt_metrics, distractor_metrics = pipeline.run('ctt_metrics', 'distractor_metrics')
+            report = create_ctt_report(st.session_state.responses, ctt_metrics=ctt_metrics, distractor_metrics=distractor_metrics)
             for img in report:
                 st.markdown(img, unsafe_allow_html=True)
         
@@ -212,7 +305,7 @@ with tab2:
         if st.button("Show Item Analysis"):
             for item in items_selected:
                 st.write(f"Item {item}:")
-                plot_item_histogram(st.session_state.df, item - 1)
+                plot_item_histogram(st.session_state.responses, item - 1)
                 st.write("---")  # Add a separator between histograms
     else:
         st.write("No data uploaded.")
@@ -239,11 +332,26 @@ def calculate_icc(theta, a, b, c=0):
 with tab3:
     st.header("IRT Analysis Dashboard")
     if st.session_state.df is not None:
+        model = st.selectbox("IRT model:", ["3PL", "2PL", "1PL"])
+        estimators = ["EAP", "MAP", "ML"]
+        if not st.session_state.responses.has_missing:
+            estimators.append("Summed score (EAP table)")  # Only valid when every student answered every item
+        estimator = st.selectbox("Ability estimator:", estimators)
+
         # Create IRT Report
         if st.button("Create IRT Report"):
-            report = create_irt_report(st.session_state.df)
-            for img in report:
-                st.markdown(img, unsafe_allow_html=True)
+            pipeline.set_input('irt_model', model)
+            pipeline.set_input('estimator', estimator)
+            pipeline.run('calibration', 'abilities')
+
+        if pipeline.is_fresh('calibration'):
+            create_irt_report(st.session_state.responses, calibration=st.session_state.calibration)
+        if pipeline.is_fresh('abilities') and 'score_table' in st.session_state.abilities.attrs:
+            st.subheader("Summed Score Conversion Table")
+            st.dataframe(st.session_state.abilities.attrs['score_table'])
+        if pipeline.is_fresh('abilities'):
+            st.subheader("Student Abilities")
+            st.dataframe(st.session_state.abilities)
     else:
         st.write("No data uploaded.")
 
@@ -264,19 +372,38 @@ with tab4:
     if st.session_state.df is not None:
         df = st.session_state.df
         info_file = st.file_uploader("Upload Students Info CSV", type="csv")
+        group_columns = []
         if info_file:
-            st.session_state.info_file = pd.read_csv(info_file)
-            # Allow the user to select a column for grouping
-            group_column = st.selectbox("Select the column for group analysis:", options=st.session_state.info_file.columns)
-        
+            st.session_state.info_hash = content_hash(info_file.getvalue())
+            st.session_state.info_file = cached('student_info', (st.session_state.info_hash,), lambda: pd.read_csv(info_file))
+            pipeline.set_input('student_info', st.session_state.info_file, version=st.session_state.info_hash)
+            # Allow the user to select any number of columns for grouping
+            candidate_columns = [col for col in st.session_state.info_file.columns if col != 'student_id']
+            group_columns = st.multiselect("Select the columns for group analysis:", options=candidate_columns, default=candidate_columns[:1])
+
+        matching_options = {"Rest score": "rest", "Total score": "total"}
+        if pipeline.is_fresh('abilities'):
+            matching_options["Ability (theta)"] = "theta"
+        matching = st.selectbox("Match students on:", options=list(matching_options))
+        irt_lr = st.checkbox("Also run IRT likelihood-ratio DIF (one model refit per item)")
+
         # Create DIF Report if a column is selected and button is clicked
         if st.button("Create DIF Report"):
-            if group_column:
-                report = create_dif_report(st.session_state.df, st.session_state.info_file, group_column)
-                for img in report:
-                    st.markdown(img, unsafe_allow_html=True)
+            if group_columns:
+                abilities = None
+                if matching_options[matching] == "theta":
+                    abilities = st.session_state.abilities['Theta'].to_numpy()
+                dif_model = st.session_state.calibration.model if pipeline.is_fresh('calibration') else '2PL'
+                parts = analysis_key() + (st.session_state.info_hash, tuple(group_columns), matching_options[matching],
+                                          None if abilities is None else content_hash(abilities.tobytes()), irt_lr, dif_model)
+                st.session_state.dif_report = cached('dif', parts, lambda: run_dif_analysis(
+                    st.session_state.responses, st.session_state.info_file, group_columns, matching=matching_options[matching],
+                    abilities=abilities, irt_lr=irt_lr, model=dif_model))
+                show_dif_report(st.session_state.dif_report)
             else:
                 st.write("Please select a valid column for group analysis.")
+        elif st.session_state.dif_report is not None:
+            show_dif_report(st.session_state.dif_report)
     else:
         st.write("No data uploaded.")
 
@@ -286,32 +413,68 @@ with tab5:  # Tab 5: Semantic Analysis
     # Check if optional files for semantic analysis are available
     if st.session_state.questions_file is not None and st.session_state.topics_file is not None:
         if st.button("Create Semantic Report"):
-            create_semantic_report(st.session_state.questions_file, st.session_state.topics_file)
+            mapped_df, = pipeline.run('mapped_df')
+            # Display the question-topic mapping and topic distribution chart
+            display_question_mapping(mapped_df)
+            plot_topic_distribution(mapped_df)
     else:
         st.write("Upload the Questions CSV and Topics TXT files in Tab 1 to enable Semantic Analysis.")
 
 with tab6:
     if st.session_state.df is not None and st.session_state.questions_file is not None and st.session_state.topics_file is not None:
         if st.button("Create Network Report"):
-            questions_df, topics = load_files(st.session_state.questions_file, st.session_state.topics_file)
-            mapped_df = map_questions_to_topics(questions_df, topics)
-            ctt_metrics = calculate_ctt_metrics(st.session_state.df)
-
-            st.session_state.mapped_df = mapped_df
-            st.session_state.question_info_df = create_network_report(ctt_metrics, mapped_df)
-            st.dataframe(st.session_state.question_info_df)
-            create_full_network(st.session_state.scores, st.session_state.question_info_df, st.session_state.info_file)
+            # CTT metrics and the LLM topic mapping are independent and run concurrently
+            ctt_metrics, mapped_df, question_info_df = pipeline.run('ctt_metrics', 'mapped_df', 'question_info_df')
+            create_network_report(ctt_metrics, mapped_df, merged_df=question_info_df)
+            abilities = st.session_state.abilities if pipeline.is_fresh('abilities') else None
+            if st.session_state.info_file is not None:
+                network, = pipeline.run('student_network')
+            else:
+                network = StudentNetwork.from_responses(st.session_state.responses, question_info_df)
+            create_full_network(st.session_state.responses, question_info_df, st.session_state.info_file, abilities, network=network)
+            analytics, = pipeline.run('network_analytics')
+            show_network_analytics(analytics)
     else:
         st.write("Metrics or questions data is not available.")
 
 with tab7:
-    if st.button("Generate Student Report"):
-        student_ids = st.session_state.df.reset_index().iloc[2:, 0]  # Extract IDs from row 3 onward in the first column
-        for student_id in student_ids:
-            st.markdown(f"## Report for {student_id}")
-            generate_student_report(student_id,st.session_state.scores, st.session_state.question_info_df, st.session_state.info_file)
+    if st.session_state.df is None or st.session_state.info_file is None:
+        st.write("Upload the Main CSV and the Students Info CSV (DIF Analysis tab) to generate student reports.")
+    elif st.session_state.questions_file is None or st.session_state.topics_file is None:
+        st.write("Upload the Questions CSV and Topics TXT files in Tab 1 to generate student reports.")
+    elif st.button("Generate Student Report") or st.session_state.get('student_reports_ready'):
+        st.session_state.student_reports_ready = True
+        class_reports, question_info_df = pipeline.run('class_reports', 'question_info_df')
+        abilities = st.session_state.abilities if pipeline.is_fresh('abilities') else None
+        class_reports = class_reports.with_abilities(abilities)
+
+        # Show the report of one student at a time
+        student_id = st.selectbox("Student", st.session_state.responses.student_ids)
+        st.markdown(f"## Report for {student_id}")
+        generate_student_report(student_id, class_reports, question_info_df)
+
+        # Export the reports of the whole class as a zip of HTML/PDF files
+        st.subheader("Export All Reports")
+        formats = st.multiselect("Formats", list(REPORT_FORMATS), default=['html'])
+        export_key = (pipeline.versions.get('class_reports'), pipeline.versions.get('abilities') if abilities is not None else None, tuple(formats))
+        if st.button("Export Reports") and formats:
+            progress_text = "Exporting student reports. Please wait."
+            export_bar = st.progress(0, text=progress_text)
+            archive = export_student_reports(class_reports, question_info_df, formats=formats,
+                                             on_progress=lambda done, total: export_bar.progress(done / total, text=progress_text))
+            export_bar.empty()
+            st.session_state.report_archive = (export_key, archive)
+        report_archive = st.session_state.get('report_archive')
+        if report_archive is not None and report_archive[0] == export_key:
+            st.download_button("Download Reports (zip)", report_archive[1], file_name="student_reports.zip", mime="application/zip")
 
 with tab8:
-    if st.button("Generate Explanation"):
-        questions_file = pd.read_csv(st.session_state.questions_file)
-        explanations = create_explanations(questions_file,st.session_state.df)
\ No newline at end of file
+    if st.session_state.df is not None and st.session_state.questions_file is not None:
+        reference_file = st.file_uploader("Upload Reference Material (optional)", type=['txt', 'md'])
+        if st.button("Generate Explanation"):
+            questions_df, = pipeline.run('questions_df')
+            reference_text = reference_file.getvalue().decode('utf-8') if reference_file is not None else None
+            index, scope = build_explanation_index(questions_df, reference_text)
+            explanations = create_explanations(questions_df, st.session_state.responses, index=index, scope=scope)
+    else:
+        st.write("Upload the Main CSV and the Questions CSV in Tab 1 to generate explanations.")
@@ -0,0 +1,278 @@
+import argparse
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+import pandas as pd
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+OPTION_LABELS = 'abcde'
+MULTIPLE_MARKS = '*'  # Answer of a question with more than one filled bubble, scored as wrong
+SCAN_ROOT = os.getenv("SCAN_ROOT")  # Only folder the app may scan from the server; folder scanning is off without it
+
+def read_bubbles(image, threshold=150, outline_threshold=200, min_size=10, max_size=200):
+    """
+    Bounding boxes (x, y, w, h) and fill ratios of the answer bubbles of a grayscale scan.
+
+    Bubbles are the connected components of the image thresholded at outline_threshold (light
+    enough to keep the printed outlines) with a roughly square bounding box between min_size and
+    max_size pixels. The fill ratio of every box is its share of pixels darker than threshold,
+    from one integral image instead of a Python loop over bubbles.
+    """
+    _, outlines = cv2.threshold(image, outline_threshold, 255, cv2.THRESH_BINARY_INV)
+    _, thresh = cv2.threshold(image, threshold, 255, cv2.THRESH_BINARY_INV)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(outlines, connectivity=8)
+    boxes = stats[1:, :4]  # Component 0 is the background
+    w, h = boxes[:, 2], boxes[:, 3]
+    boxes = boxes[(w >= min_size) & (h >= min_size) & (w <= max_size) & (h <= max_size) & (np.abs(w - h) <= 0.4 * np.maximum(w, h))]
+    # Bubbles share one size; smaller or larger marks (printed digits, logos) are dropped
+    area = boxes[:, 2] * boxes[:, 3]
+    boxes = boxes[(area >= 0.5 * np.median(area)) & (area <= 2 * np.median(area))] if len(boxes) else boxes
+
+    integral = cv2.integral(thresh // 255)
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+    dark = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+    return boxes, dark / (boxes[:, 2] * boxes[:, 3])
+
+def _clusters(centers, gap):
+    """Cluster index of each 1D coordinate, starting a new cluster wherever sorted coordinates jump by more than gap."""
+    order = np.argsort(centers, kind='stable')
+    starts = np.concatenate([[0], np.diff(centers[order]) > gap]).cumsum()
+    clusters = np.empty(len(centers), dtype=np.int64)
+    clusters[order] = starts
+    return clusters
+
+def bubble_grid(boxes, fill):
+    """
+    Fill ratios arranged in the grid of bubble rows and columns (NaN where no bubble was found).
+
+    Rows and columns are found by clustering the bubble centres along y and x, with gaps of half
+    the median bubble size. Rows and columns with less than half the bubbles of the fullest one
+    are stray marks and dropped.
+    """
+    if len(boxes) == 0:
+        return np.zeros((0, 0))
+    size = np.median(boxes[:, 2:4])
+    rows = _clusters(boxes[:, 1] + boxes[:, 3] / 2, size / 2)
+    columns = _clusters(boxes[:, 0] + boxes[:, 2] / 2, size / 2)
+    grid = np.full((rows.max() + 1, columns.max() + 1), np.nan)
+    grid[rows, columns] = fill
+    found = ~np.isnan(grid)
+    grid = grid[found.sum(axis=1) >= 0.5 * found.sum(axis=1).max()]
+    found = ~np.isnan(grid)
+    return grid[:, found.sum(axis=0) >= 0.5 * found.sum(axis=0).max()]
+
+def grid_answers(grid, n_options, orientation='columns', fill_threshold=0.3, option_labels=OPTION_LABELS):
+    """
+    Answer of every question of a bubble grid.
+
+    With orientation 'columns' every grid column is a question and its n_options rows are the
+    options, top to bottom (as in data/example-sheet.png); with 'rows' every question is a run
+    of n_options bubbles in a grid row, and blocks of questions side by side are read block by
+    block. Unfilled questions are blank ('') and questions with several filled bubbles are
+    MULTIPLE_MARKS.
+    """
+    if orientation == 'columns':
+        n_blocks = grid.shape[0] // n_options
+        options = grid[:n_blocks * n_options].reshape(n_blocks, n_options, grid.shape[1]).transpose(0, 2, 1).reshape(-1, n_options)
+    else:
+        n_blocks = grid.shape[1] // n_options
+        options = grid[:, :n_blocks * n_options].reshape(grid.shape[0], n_blocks, n_options).transpose(1, 0, 2).reshape(-1, n_options)
+    filled = np.nan_to_num(options) > fill_threshold
+    n_filled = filled.sum(axis=1)
+    labels = np.asarray(list(option_labels[:n_options]), dtype=object)
+    answers = np.where(n_filled == 1, labels[filled.argmax(axis=1)], np.where(n_filled > 1, MULTIPLE_MARKS, ''))
+    return answers.tolist()
+
+def scan_sheet(data, n_options=4, orientation='columns', threshold=150, fill_threshold=0.3, option_labels=OPTION_LABELS):
+    """Answers read from the bytes of one scanned answer sheet."""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError("Not a readable image.")
+    boxes, fill = read_bubbles(image, threshold)
+    grid = bubble_grid(boxes, fill)
+    if grid.shape[0 if orientation == 'columns' else 1] < n_options:
+        raise ValueError(f"No grid of answer bubbles found ({len(boxes)} bubbles).")
+    return grid_answers(grid, n_options, orientation, fill_threshold, option_labels)
+
+def list_scans(source):
+    """(name, path, member) of every image in a folder or zip archive on disk, sorted by name; member is None in folders."""
+    if os.path.isdir(source):
+        scans = [(name, os.path.join(source, name), None) for name in os.listdir(source) if name.lower().endswith(IMAGE_SUFFIXES)]
+    else:
+        with zipfile.ZipFile(source) as archive:
+            scans = [(member, source, member) for member in archive.namelist()
+                     if member.lower().endswith(IMAGE_SUFFIXES) and not member.startswith('__MACOSX')]
+    return sorted(scans)
+
+def parse_key(text, n_options=4, option_labels=OPTION_LABELS):
+    """
+    Answer key typed as option letters, run together ('cbaad') or separated by commas, semicolons or spaces ('C, B, A').
+
+    Returns the lower-case answers; raises ValueError for answers that are not one of the first
+    n_options option labels.
+    """
+    answers = [token.lower() for token in re.split(r'[\s,;]+', text.strip()) if token]
+    if len(answers) == 1:
+        answers = list(answers[0])
+    invalid = sorted({answer for answer in answers if answer not in option_labels[:n_options]})
+    if invalid:
+        raise ValueError(f"Invalid answers in the key: {', '.join(invalid)}. Use the options {', '.join(option_labels[:n_options])}.")
+    return answers
+
+def scan_folder(path, root=SCAN_ROOT):
+    """
+    Folder of scans requested from the app, resolved inside root.
+
+    Relative paths are taken from root; paths that resolve outside it (absolute paths, '..' or
+    symbolic links) are rejected, and so is every path when no root is configured.
+    """
+    if not root:
+        raise ValueError("Scanning folders on the server is disabled; set SCAN_ROOT to enable it.")
+    root = os.path.realpath(root)
+    folder = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, folder]) != root:
+        raise ValueError(f"'{path}' is outside the scan folder.")
+    if not os.path.isdir(folder):
+        raise ValueError(f"No folder '{path}' in the scan folder.")
+    return folder
+
+def student_id(name):
+    """Student ID of a scan: its file name without folders and suffix."""
+    return os.path.splitext(os.path.basename(name))[0]
+
+def _scan_chunk(chunk, options):
+    """Scan a chunk of (name, path, member) sheets in a worker process, opening a zip archive once per chunk."""
+    results, archive = [], None
+    try:
+        for name, path, member in chunk:
+            try:
+                if member is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                else:
+                    archive = archive or zipfile.ZipFile(path)
+                    data = archive.read(member)
+                results.append((name, scan_sheet(data, **options), None))
+            except Exception as e:
+                results.append((name, None, str(e)))
+    finally:
+        if archive is not None:
+            archive.close()
+    return results
+
+def scan_batch(source, key=None, key_name='key', n_options=4, orientation='columns', threshold=150, fill_threshold=0.3,
+               option_labels=OPTION_LABELS, max_workers=None, chunk_size=32, on_progress=None):
+    """
+    Scan a folder or zip archive of answer sheets into an answer sheet table.
+
+    Sheets are scanned in a spawn process pool, chunk_size sheets per task; workers read sheets
+    from folders and zip files on disk themselves, so only file names cross process boundaries
+    (an uploaded zip file object is spooled to a temporary file first). The student ID of every
+    sheet is its file name without folders and suffix. Sheets sharing an ID, sheets without a
+    bubble grid and sheets with another number of questions than the key are not scored but
+    reported in the errors.
+
+    Parameters:
+    - source: Folder or zip archive (path or binary file-like object) of scans.
+    - key: Correct answers, one per question; by default read from the scan named key_name.
+    - n_options, orientation, threshold, fill_threshold, option_labels: Sheet layout, see scan_sheet.
+    - max_workers: Worker processes (os.cpu_count() by default).
+    - on_progress: Called as on_progress(done, total) whenever a chunk of sheets is finished.
+
+    Returns:
+    - A DataFrame in the layout of the main CSV (first column the student IDs, first row the
+      question numbers, second row the answer key, then one row per student), with
+      attrs['errors'] mapping the names of the scans that were not scored to the reason.
+    """
+    spooled = None
+    if not isinstance(source, (str, os.PathLike)):
+        # Workers open the archive themselves, so an uploaded file object is written to disk once
+        spooled = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+        with spooled:
+            source.seek(0)
+            shutil.copyfileobj(source, spooled)
+        source = spooled.name
+    try:
+        scans = list_scans(source)
+        options = dict(n_options=n_options, orientation=orientation, threshold=threshold,
+                       fill_threshold=fill_threshold, option_labels=option_labels)
+        sheets, errors, done = {}, {}, 0
+        chunks = [scans[i:i + chunk_size] for i in range(0, len(scans), chunk_size)]
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = {pool.submit(_scan_chunk, chunk, options): len(chunk) for chunk in chunks}
+            for future in as_completed(futures):
+                for name, sheet_answers, error in future.result():
+                    if error is None:
+                        sheets[name] = sheet_answers
+                    else:
+                        errors[name] = error
+                done += futures[future]
+                if on_progress is not None:
+                    on_progress(done, len(scans))
+    finally:
+        if spooled is not None:
+            os.remove(spooled.name)
+
+    # Scans of different folders with the same file name would overwrite each other
+    id_counts = Counter(student_id(name) for name, _, _ in scans)
+    answers = {}
+    for name, sheet_answers in sheets.items():
+        if id_counts[student_id(name)] > 1:
+            errors[name] = f"Student ID '{student_id(name)}' is shared by {id_counts[student_id(name)]} scans."
+        else:
+            answers[student_id(name)] = (name, sheet_answers)
+
+    if key is None:
+        if key_name not in answers:
+            raise ValueError(f"No answer key: pass key or include one readable scan named '{key_name}'.")
+        key = answers.pop(key_name)[1]
+    for sid, (name, sheet_answers) in list(answers.items()):
+        if len(sheet_answers) != len(key):
+            errors[name] = f"Found {len(sheet_answers)} questions, the answer key has {len(key)}."
+            del answers[sid]
+
+    sheet_df = pd.DataFrame([['question_number'] + [str(q) for q in range(1, len(key) + 1)], ['true_answers'] + list(key)]
+                            + [[sid] + list(answers[sid][1]) for sid in sorted(answers)])
+    sheet_df.attrs['errors'] = errors
+    return sheet_df
+
+def write_answer_sheet(sheet_df, target, fmt=None):
+    """
+    Write an answer sheet table as a header-less CSV (optionally .csv.gz) or as Parquet.
+
+    target is a path or a binary buffer; fmt ('csv' or 'parquet') defaults to the suffix of the path.
+    """
+    if fmt is None:
+        fmt = 'parquet' if str(target).lower().endswith(('.parquet', '.pq')) else 'csv'
+    if fmt == 'parquet':
+        sheet_df.set_axis([str(column) for column in sheet_df.columns], axis=1).astype(str).to_parquet(target, index=False)
+    else:
+        sheet_df.to_csv(target, header=False, index=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scan a folder or zip archive of answer sheets into an answer sheet CSV/Parquet.")
+    parser.add_argument('source', help="Folder or zip archive of scans")
+    parser.add_argument('output', help="Output .csv, .csv.gz or .parquet file")
+    parser.add_argument('--key', help="Correct answers, e.g. 'cabd...' or 'c,a,b,d' (default: the scan named --key-name)")
+    parser.add_argument('--key-name', default='key')
+    parser.add_argument('--options', type=int, default=4)
+    parser.add_argument('--orientation', choices=['columns', 'rows'], default='columns')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    sheet_df = scan_batch(args.source, key=parse_key(args.key, args.options) if args.key else None, key_name=args.key_name, n_options=args.options,
+                          orientation=args.orientation, max_workers=args.workers,
+                          on_progress=lambda done, total: print(f"\r{done}/{total} sheets", end='', flush=True))
+    write_answer_sheet(sheet_df, args.output)
+    print(f"\nWrote {len(sheet_df) - 2} students to {args.output}")
+    for name, error in sheet_df.attrs['errors'].items():
+        print(f"Could not scan {name}: {error}")
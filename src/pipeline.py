@@ -0,0 +1,98 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from cache import content_hash
+
+@dataclass
+class Stage:
+    name: str
+    inputs: tuple
+    compute: object
+
+class Pipeline:
+    """
+    Dependency graph of the analysis stages, memoized in st.session_state.
+
+    Inputs (the uploaded data and user choices) are set with a version that identifies their
+    content. Every stage result is stored in state under the stage name, together with the
+    versions of the inputs it was computed from; a stage is recomputed only when one of its
+    upstream inputs changed. run computes the stale stages level by level, and stages of the
+    same level, which do not depend on each other, run concurrently.
+    """
+
+    def __init__(self, state, max_workers=4):
+        self.state = state
+        self.stages = {}
+        self.max_workers = max_workers
+        if 'pipeline_versions' not in state:
+            state['pipeline_versions'] = {}
+        self.versions = state['pipeline_versions']
+
+    def stage(self, name, inputs):
+        """Register the decorated function as the stage computing name from the given inputs (passed in order)."""
+        def register(compute):
+            self.stages[name] = Stage(name, tuple(inputs), compute)
+            return compute
+        return register
+
+    def set_input(self, name, value, version=None):
+        """Set an input of the graph; downstream stages become stale when its version changes."""
+        version = repr(value) if version is None else version
+        if self.versions.get(name) != version or name not in self.state:
+            self.state[name] = value
+            self.versions[name] = version
+
+    def _expected_version(self, name, memo):
+        """Version a node has once it is up to date, derived from the versions of the inputs upstream of it."""
+        if name not in memo:
+            if name in self.stages:
+                upstream = tuple(self._expected_version(dep, memo) for dep in self.stages[name].inputs)
+                memo[name] = None if None in upstream else content_hash(repr((name, upstream)))
+            else:
+                memo[name] = self.versions.get(name)
+        return memo[name]
+
+    def is_fresh(self, name):
+        """True if the stored result of name is up to date with its inputs."""
+        version = self._expected_version(name, {})
+        return version is not None and self.versions.get(name) == version and self.state.get(name) is not None
+
+    def _stale_stages(self, names, memo):
+        """Stale stages needed for names, in dependency order."""
+        order, seen = [], set()
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            if name not in self.stages:
+                if self.versions.get(name) is None or self.state.get(name) is None:
+                    raise ValueError(f"Pipeline input '{name}' has not been provided.")
+                return
+            for dep in self.stages[name].inputs:
+                visit(dep)
+            # A result cleared from state (e.g. by a page reset) is recomputed as well
+            if self.versions.get(name) != self._expected_version(name, memo) or self.state.get(name) is None:
+                order.append(name)
+        for name in names:
+            visit(name)
+        return order
+
+    def run(self, *names):
+        """Bring the given stages up to date and return their results."""
+        memo = {}
+        pending = self._stale_stages(names, memo)
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as pool:
+            while pending:
+                # Every stage whose stale dependencies are computed forms the next level
+                level = [name for name in pending if not set(self.stages[name].inputs) & set(pending)]
+                futures = {name: pool.submit(self.stages[name].compute, *(self.state[dep] for dep in self.stages[name].inputs))
+                           for name in level}
+                for name, future in futures.items():
+                    self.state[name] = future.result()
+                    self.versions[name] = self._expected_version(name, memo)
+                pending = [name for name in pending if name not in futures]
+        return [self.state[name] for name in names]
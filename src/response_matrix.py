@@ -0,0 +1,249 @@
+import os
+import numpy as np
+import pandas as pd
+
+MISSING = 0  # Option code reserved for blank / unanswered cells
+BLOCK_ROWS = 65536  # Examinees processed per block by the out-of-core statistics
+
+
+class ResponseMatrix:
+    """
+    Compact, encoded view of an uploaded answer sheet, built once and shared by every analysis.
+
+    Attributes:
+    - codes: uint8 array (examinees x items) of option codes, 0 meaning blank.
+    - key: uint8 array with the option code of the correct answer for each item.
+    - correct: boolean array (examinees x items), True where the response matches the key.
+    - valid: boolean array (examinees x items), True where a response was given. Blank, omitted and
+      not-administered cells are False and are left out of every statistic instead of counting as wrong.
+      With blank_as_wrong every cell of an item with a key is valid.
+    Only codes is stored; correct and valid are derived from it on access (use blocks() to bound
+    memory), and the per-examinee counts and packed bit matrices are cached on first use.
+    - option_labels: list of original answer strings, option code k maps to option_labels[k - 1].
+    - student_ids: array with the ID of each examinee (row order of codes).
+    - item_labels: array with the label of each item (column order of codes).
+    """
+
+    def __init__(self, codes, key, option_labels, student_ids, item_labels, blank_as_wrong=False):
+        self.codes = codes
+        self.key = key
+        self.option_labels = list(option_labels)
+        self.student_ids = np.asarray(student_ids)
+        self.item_labels = np.asarray(item_labels)
+        self.blank_as_wrong = blank_as_wrong
+        self.student_index = pd.Index(self.student_ids.astype(str))
+        self._scores = None
+        self._n_answered = None
+        self._packed = None
+        self._packed_valid = None
+
+    @classmethod
+    def from_answer_sheet(cls, answer_sheet_df, blank_as_wrong=False):
+        """
+        Encode the answer sheet DataFrame loaded by new_project.py.
+
+        The first row holds the question numbers, the second row the correct answers and the
+        remaining rows the student responses. The index holds the student IDs. Blank cells are
+        treated as missing unless blank_as_wrong is True.
+        """
+        key_row = answer_sheet_df.iloc[1]
+        students_df = answer_sheet_df.iloc[2:]
+
+        # Factorize key and responses together so both share the same option codes
+        values = np.vstack([key_row.to_numpy(dtype=object)[None, :], students_df.to_numpy(dtype=object)])
+        codes, option_labels = pd.factorize(values.ravel(), sort=True)
+        if len(option_labels) > np.iinfo(np.uint8).max:
+            raise ValueError(f"Answer sheet has {len(option_labels)} distinct options, at most 255 are supported.")
+        codes = (codes + 1).astype(np.uint8).reshape(values.shape)  # -1 (NaN) becomes 0 (blank)
+
+        return cls(
+            codes=np.ascontiguousarray(codes[1:]),
+            key=codes[0].copy(),
+            option_labels=[str(label) for label in option_labels],
+            student_ids=students_df.index.to_numpy(),
+            item_labels=answer_sheet_df.columns.to_numpy(),
+            blank_as_wrong=blank_as_wrong,
+        )
+
+    @classmethod
+    def from_long_format(cls, long_df, key, student_col='student_id', item_col='item', response_col='response'):
+        """
+        Encode long-format responses (one row per administered item), e.g. from matrix-sampled or adaptive forms.
+
+        key maps every item label to its correct answer. Items a student never saw stay missing.
+        """
+        key = pd.Series(key)
+        item_labels = key.index.to_numpy()
+        student_ids, student_rows = np.unique(long_df[student_col].to_numpy(), return_inverse=True)
+        item_columns = pd.Index(item_labels).get_indexer(long_df[item_col])
+        if (item_columns < 0).any():
+            raise ValueError("Long-format responses reference items that are not in the answer key.")
+
+        option_codes, option_labels = pd.factorize(np.concatenate([key.to_numpy(dtype=object), long_df[response_col].to_numpy(dtype=object)]), sort=True)
+        if len(option_labels) > np.iinfo(np.uint8).max:
+            raise ValueError(f"Responses have {len(option_labels)} distinct options, at most 255 are supported.")
+        option_codes = (option_codes + 1).astype(np.uint8)
+
+        codes = np.zeros((len(student_ids), len(item_labels)), dtype=np.uint8)
+        codes[student_rows.ravel(), item_columns] = option_codes[len(key):]
+        return cls(codes, option_codes[:len(key)], [str(label) for label in option_labels], student_ids, item_labels)
+
+    @property
+    def n_examinees(self):
+        return self.codes.shape[0]
+
+    @property
+    def n_items(self):
+        return self.codes.shape[1]
+
+    @property
+    def n_options(self):
+        return len(self.option_labels)
+
+    @property
+    def key_labels(self):
+        """Correct answer of each item as the original answer string."""
+        return np.array([''] + self.option_labels, dtype=object)[self.key]
+
+    @property
+    def correct(self):
+        """Boolean correctness matrix, derived from the codes on every access."""
+        return _correct(self.codes, self.key)
+
+    @property
+    def valid(self):
+        """Boolean validity mask, derived from the codes on every access."""
+        return _valid(self.codes, self.key, self.blank_as_wrong)
+
+    def _count_scores(self):
+        self._scores = np.zeros(self.n_examinees, dtype=np.int64)
+        self._n_answered = np.zeros(self.n_examinees, dtype=np.int64)
+        for rows, correct, valid in self.blocks():
+            self._scores[rows] = correct.sum(axis=1)
+            self._n_answered[rows] = valid.sum(axis=1)
+
+    @property
+    def has_missing(self):
+        return bool((self.n_answered < self.n_items).any())
+
+    @property
+    def scores(self):
+        """Number of correct answers of each examinee, counted block by block on first use."""
+        if self._scores is None:
+            self._count_scores()
+        return self._scores
+
+    @property
+    def n_answered(self):
+        """Number of valid (non-missing) responses of each examinee."""
+        if self._n_answered is None:
+            self._count_scores()
+        return self._n_answered
+
+    @property
+    def proportion_correct(self):
+        """Share of correct answers among the items each examinee answered (0 when none was answered)."""
+        return self.scores / np.maximum(self.n_answered, 1)
+
+    @property
+    def packed(self):
+        """Bit-packed correctness matrix (8 items per byte), computed on first use."""
+        if self._packed is None:
+            self._packed = np.vstack([np.packbits(correct, axis=1) for _, correct, _ in self.blocks()] or
+                                     [np.zeros((0, (self.n_items + 7) // 8), dtype=np.uint8)])
+        return self._packed
+
+    @property
+    def packed_valid(self):
+        """Bit-packed validity mask, stored next to the packed correctness matrix."""
+        if self._packed_valid is None:
+            self._packed_valid = np.vstack([np.packbits(valid, axis=1) for _, _, valid in self.blocks()] or
+                                           [np.zeros((0, (self.n_items + 7) // 8), dtype=np.uint8)])
+        return self._packed_valid
+
+    def unique_patterns(self):
+        """
+        Collapse identical correctness patterns so each one is processed only once.
+
+        Returns the row of one examinee per distinct pattern, the pattern index of every
+        examinee and the number of examinees sharing each pattern.
+        """
+        # Two examinees share a pattern only if they answered the same items with the same correctness
+        packed = np.ascontiguousarray(np.hstack([self.packed, self.packed_valid]))
+        pattern_keys = packed.view(np.dtype((np.void, packed.shape[1])))[:, 0]
+        _, first, inverse, counts = np.unique(pattern_keys, return_index=True, return_inverse=True, return_counts=True)
+        return first, inverse.ravel(), counts
+
+    def positions(self, student_ids):
+        """Row position of each student ID, -1 for IDs that are not in the answer sheet."""
+        return self.student_index.get_indexer(pd.Index(student_ids).astype(str))
+
+    def subset(self, rows):
+        """ResponseMatrix restricted to the given examinee rows (boolean mask or positions)."""
+        return ResponseMatrix(self.codes[rows], self.key, self.option_labels, self.student_ids[rows], self.item_labels, self.blank_as_wrong)
+
+    def option_counts(self):
+        """Count of each option code per item, as an (items x n_options + 1) array. Column 0 counts blanks."""
+        width = self.n_options + 1
+        offsets = np.arange(self.n_items, dtype=np.int64) * width
+        counts = np.zeros(self.n_items * width, dtype=np.int64)
+        for start in range(0, self.n_examinees, BLOCK_ROWS):
+            counts += np.bincount((self.codes[start:start + BLOCK_ROWS] + offsets).ravel(), minlength=len(counts))
+        return counts.reshape(self.n_items, width)
+
+    def blocks(self, block_rows=BLOCK_ROWS):
+        """Yield (rows, correct, valid) for consecutive blocks of examinees."""
+        for start in range(0, self.n_examinees, block_rows):
+            rows = slice(start, min(start + block_rows, self.n_examinees))
+            codes = self.codes[rows]
+            yield rows, _correct(codes, self.key), _valid(codes, self.key, self.blank_as_wrong)
+
+    def scores_frame(self):
+        """Total score of every examinee, from the block-wise counts (no per-item columns)."""
+        return pd.DataFrame({'student_id': self.student_ids, 'Score': self.scores})
+
+    def save(self, path):
+        """Store the response matrix in a directory that MappedResponses.open can memory-map."""
+        os.makedirs(path, exist_ok=True)
+        codes = np.lib.format.open_memmap(os.path.join(path, 'codes.npy'), mode='w+', dtype=np.uint8, shape=self.codes.shape)
+        codes[:] = self.codes
+        codes.flush()
+        _save_metadata(path, self.key, self.option_labels, self.student_ids, self.item_labels)
+
+
+def _correct(codes, key):
+    # A blank key never matches, otherwise blank responses would count as correct
+    return (codes == key) & (key != MISSING)
+
+def _valid(codes, key, blank_as_wrong):
+    if blank_as_wrong:
+        return np.broadcast_to(key != MISSING, codes.shape)
+    return (codes != MISSING) & (key != MISSING)
+
+def _save_metadata(path, key, option_labels, student_ids, item_labels):
+    np.savez(os.path.join(path, 'metadata.npz'), key=key, option_labels=np.asarray(option_labels, dtype=str),
+             student_ids=np.asarray(student_ids).astype(str), item_labels=np.asarray(item_labels))
+
+
+class MappedResponses(ResponseMatrix):
+    """
+    Response matrix kept on disk and memory-mapped, for administrations that do not fit in RAM.
+
+    Only the uint8 option codes live on disk; like ResponseMatrix, correctness and validity are
+    derived block by block, so every statistic is accumulated over row blocks with bounded memory.
+    Only the per-examinee counts and the packed bit matrices (one bit per cell) are kept in memory.
+    """
+
+    @classmethod
+    def open(cls, path, blank_as_wrong=False):
+        """Memory-map a response matrix stored with ResponseMatrix.save or ingest.stream_answer_sheet."""
+        metadata = np.load(os.path.join(path, 'metadata.npz'))
+        return cls(np.load(os.path.join(path, 'codes.npy'), mmap_mode='r'), metadata['key'], metadata['option_labels'],
+                   metadata['student_ids'], metadata['item_labels'], blank_as_wrong=blank_as_wrong)
+
+    def blocks(self, block_rows=BLOCK_ROWS):
+        """Yield (rows, correct, valid) for consecutive blocks of examinees, read from disk."""
+        for start in range(0, self.n_examinees, block_rows):
+            rows = slice(start, min(start + block_rows, self.n_examinees))
+            codes = np.asarray(self.codes[rows])
+            yield rows, _correct(codes, self.key), _valid(codes, self.key, self.blank_as_wrong)
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+from irt import IRTCalibration, quadrature_grid, item_response_probabilities
+
+ESTIMATORS = ('EAP', 'MAP', 'ML')
+
+def get_item_parameters(calibration):
+    """Discrimination, difficulty and guessing arrays from an IRTCalibration or its items DataFrame."""
+    items = calibration.items if isinstance(calibration, IRTCalibration) else calibration
+    return (items['Discrimination'].to_numpy(dtype=float),
+            items['Difficulty'].to_numpy(dtype=float),
+            items['Guessing'].to_numpy(dtype=float))
+
+def estimate_eap(correct, valid, a, b, c, prior_sd=1.0, n_points=61):
+    """Expected a posteriori ability and posterior SD of every row of a 0/1 correctness matrix with a validity mask."""
+    theta, weights = quadrature_grid(n_points)
+    theta = theta * prior_sd
+    P = np.clip(item_response_probabilities(theta, a, b, c), 1e-10, 1 - 1e-10)
+    log_p, log_q = np.log(P), np.log1p(-P)
+
+    # Log-likelihood of every pattern at every quadrature point, over the answered items only
+    log_lik = correct @ (log_p - log_q) + valid @ log_q + np.log(weights)
+    posterior = np.exp(log_lik - log_lik.max(axis=1, keepdims=True))
+    posterior /= posterior.sum(axis=1, keepdims=True)
+
+    eap = posterior @ theta
+    se = np.sqrt(np.maximum(posterior @ theta ** 2 - eap ** 2, 0))
+    return eap, se
+
+def estimate_newton(correct, valid, a, b, c, start, prior_sd=None, max_iter=50, tol=1e-4, bound=6.0):
+    """
+    Fisher scoring of every pattern at once, for ML (prior_sd=None) or MAP with a normal prior.
+
+    Returns the ability estimates and their standard errors from the test information.
+    """
+    theta = start.copy()
+    information = np.zeros_like(theta)
+    active = np.arange(len(theta))
+    for _ in range(max_iter):
+        P = np.clip(item_response_probabilities(theta[active], a, b, c).T, 1e-10, 1 - 1e-10)
+        # dP/dtheta = a (P - c)(1 - P) / (1 - c)
+        slope = a * (P - c) / (1 - c) * valid[active]
+        gradient = ((correct[active] - P) * slope / P).sum(axis=1)
+        information[active] = (slope ** 2 * (1 - P) / P).sum(axis=1)
+        if prior_sd is not None:
+            gradient -= theta[active] / prior_sd ** 2
+            information[active] += 1 / prior_sd ** 2
+        step = np.clip(gradient / np.maximum(information[active], 1e-10), -1, 1)
+        theta[active] = np.clip(theta[active] + step, -bound, bound)
+
+        # Patterns that converged, or whose ML estimate diverges (all right / all wrong), stop here
+        done = (np.abs(step) < tol) | (np.abs(theta[active]) >= bound)
+        active = active[~done]
+        if len(active) == 0:
+            break
+    return theta, 1 / np.sqrt(np.maximum(information, 1e-10))
+
+def score_theta(responses, calibration, method='EAP', prior_sd=1.0, n_points=61):
+    """
+    Estimate the ability (theta) of every examinee from calibrated item parameters.
+
+    Identical correctness patterns are scored once and the results broadcast back to every
+    examinee sharing them. Missing responses are left out of each examinee's likelihood.
+
+    Parameters:
+    - responses: ResponseMatrix with the encoded student responses.
+    - calibration: IRTCalibration (or its items DataFrame) returned by irt.calibrate.
+    - method: 'EAP', 'MAP' or 'ML'.
+    - prior_sd: Standard deviation of the normal ability prior used by EAP and MAP.
+    - n_points: Number of quadrature points for EAP.
+
+    Returns:
+    - A DataFrame with the student_id, Theta and SE of every examinee.
+    """
+    if method not in ESTIMATORS:
+        raise ValueError(f"Unknown ability estimator '{method}'. Choose one of {', '.join(ESTIMATORS)}.")
+
+    a, b, c = get_item_parameters(calibration)
+    first, inverse, _ = responses.unique_patterns()
+    patterns = responses.subset(first)
+    correct = patterns.correct.astype(float)
+    valid = patterns.valid.astype(float)
+
+    # EAP is also the starting point of MAP and ML
+    theta, se = estimate_eap(correct, valid, a, b, c, prior_sd=prior_sd, n_points=n_points)
+    if method == 'MAP':
+        theta, se = estimate_newton(correct, valid, a, b, c, theta, prior_sd=prior_sd)
+    elif method == 'ML':
+        theta, se = estimate_newton(correct, valid, a, b, c, theta)
+
+    return pd.DataFrame({
+        'student_id': responses.student_ids,
+        'Theta': theta[inverse],
+        'SE': se[inverse]
+    })
+
+def summed_score_likelihoods(P):
+    """
+    Lord-Wingersky recursion: likelihood of every summed score at every quadrature point.
+
+    P holds the probability of a correct answer per item (rows) and quadrature point (columns).
+    Returns an array (items + 1 x points) whose row s is P(summed score = s | theta).
+    """
+    n_items, n_points = P.shape
+    likelihoods = np.zeros((n_items + 1, n_points))
+    likelihoods[0] = 1
+    for i in range(n_items):
+        # Adding item i: a score s either stays (item wrong) or comes from s - 1 (item right)
+        previous = likelihoods[:i + 1].copy()
+        likelihoods[:i + 1] = previous * (1 - P[i])
+        likelihoods[1:i + 2] += previous * P[i]
+    return likelihoods
+
+def summed_score_table(calibration, prior_sd=1.0, n_points=61):
+    """
+    Build the summed score to EAP conversion table of a calibrated form.
+
+    Parameters:
+    - calibration: IRTCalibration (or its items DataFrame) returned by irt.calibrate.
+    - prior_sd: Standard deviation of the normal ability prior.
+    - n_points: Number of quadrature points.
+
+    Returns:
+    - A DataFrame with one row per summed score: Score, Theta (EAP), SE and the expected
+      proportion of examinees obtaining that score.
+    """
+    a, b, c = get_item_parameters(calibration)
+    theta, weights = quadrature_grid(n_points)
+    theta = theta * prior_sd
+
+    posterior = summed_score_likelihoods(item_response_probabilities(theta, a, b, c)) * weights
+    marginal = posterior.sum(axis=1)
+    eap = posterior @ theta / marginal
+    se = np.sqrt(np.maximum(posterior @ theta ** 2 / marginal - eap ** 2, 0))
+
+    return pd.DataFrame({
+        'Score': np.arange(len(a) + 1),
+        'Theta': eap,
+        'SE': se,
+        'Expected Proportion': marginal
+    })
+
+def score_from_table(scores_df, table):
+    """
+    Convert the Score column produced by calculate_scores to EAP abilities with a table lookup.
+
+    The table assumes every item was answered; use score_theta for forms with missing responses.
+    """
+    score_index = scores_df['Score'].to_numpy(dtype=int)
+    return pd.DataFrame({
+        'student_id': scores_df['student_id'].to_numpy(),
+        'Score': score_index,
+        'Theta': table['Theta'].to_numpy()[score_index],
+        'SE': table['SE'].to_numpy()[score_index]
+    })
@@ -1,56 +1,219 @@
+import asyncio
+import json
 import os
+import re
+import numpy as np
 import pandas as pd
+from scipy import sparse
 import streamlit as st
 import matplotlib.pyplot as plt
 import seaborn as sns
-from langchain.llms import OpenAI
-from dotenv import load_dotenv
+from sklearn.feature_extraction.text import TfidfVectorizer
+from cache import get_cache, cache_key, content_hash
+from llm import get_gateway, model_name, LLM_CONCURRENCY
 
-# Load API key from .env file
-load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
+TOPIC_BATCH_SIZE = 20  # Questions classified per LLM request
+TOPIC_MAPPING = os.getenv("TOPIC_MAPPING", "hybrid")  # 'hybrid', 'local' or 'llm'
+LOCAL_CONFIDENCE = 0.25  # Minimum similarity for the local classifier to skip the LLM
+LOCAL_MIN_EXAMPLES = 30  # Labeled questions needed before hybrid mode trusts the local classifier over the LLM
+LOCAL_MIN_ACCURACY = 0.8  # Leave-one-out accuracy the local classifier must reach on them
+OFFLINE_CONFIDENCE = 0.1  # Minimum similarity of a local label when the LLM is not used or not reachable
+TOPIC_EMBEDDING_MODEL = os.getenv("TOPIC_EMBEDDING_MODEL")  # Optional sentence-transformers model
 
-# Initialize LangChain model
-llm = OpenAI(openai_api_key=openai_api_key)
+# Process-wide LLM gateway shared by every session (a StubLLM behind it when LLM_BACKEND=stub)
+default_llm = get_gateway()
+
+def load_questions(questions_file):
+    """Load the questions CSV from an UploadedFile object, which may have been read before."""
+    questions_file.seek(0)
+    return pd.read_csv(questions_file)
+
+def load_topics(topics_file):
+    """Load the comma-separated topics from an UploadedFile object."""
+    return [topic.strip() for topic in topics_file.getvalue().decode("utf-8").split(',')]
 
 def load_files(questions_file, topics_file):
     """Load the questions and topics files from UploadedFile objects."""
-    questions_df = pd.read_csv(questions_file)
-    topics = [topic.strip() for topic in topics_file.read().decode("utf-8").split(',')]
-    return questions_df, topics
+    return load_questions(questions_file), load_topics(topics_file)
+
+def question_text(row):
+    """Statement followed by the alternatives of a row of the questions CSV."""
+    return str(row.iloc[1]) + " " + " ".join(row.iloc[2:].dropna().astype(str))
 
-def map_questions_to_topics(questions_df, topics):
-    """Map each question to one or more topics using LangChain for intent classification."""
-    # Prepare mapping for each question
+def build_topic_prompt(topics, batch):
+    """One prompt classifying a batch of (question number, text) pairs, answered as a JSON object."""
+    questions = "\n".join(f"{number}: {text}" for number, text in batch)
+    return (
+        f"Given the following topics: {', '.join(topics)}\n\n"
+        f"Classify each of the following questions into its relevant topics, using only topics from the list.\n"
+        f"Return only a JSON object that maps every question number to a list of topics, with nothing else.\n"
+        f'Format: {{"1": ["Topic1", "Topic2"], "2": ["Topic3"]}}\n\n'
+        f"Questions:\n{questions}"
+    )
+
+def parse_topic_response(response, numbers, topics):
+    """Topics of every question number from a JSON answer; unknown topics and unparsable answers are dropped."""
+    known = {topic.lower(): topic for topic in topics}
+    match = re.search(r"\{.*\}", response or "", re.DOTALL)
+    try:
+        answer = json.loads(match.group(0)) if match else {}
+    except json.JSONDecodeError:
+        answer = {}
+    answer = answer if isinstance(answer, dict) else {}
     mapping = {}
-    progress_text = "Mapping operation in progress. Please wait."
-    my_bar = st.progress(0, text=progress_text)
-    percent_complete = 0
-    total_len = len(questions_df)
-    pace = 1/total_len
-    for idx, row in questions_df.iterrows():
-        my_bar.progress(percent_complete + pace, text=progress_text)
-        percent_complete += pace
-
-        question_text = str(row.iloc[1]) + " " + " ".join(row.iloc[2:].dropna().astype(str))
-        
-        # Create a prompt for topic classification
-        prompt = (
-            f"Given the following topics: {', '.join(topics)}\n\n"
-            f"Classify the following question into relevant topics. "
-            f"Return only the relevant topics in a comma-separated list with no extra spaces or punctuation:\n\n"
-            f"Do not return anything besides that."
-            f"Question: {question_text}\n\n"
-            f"Format: Topic1, Topic2, Topic3"
-        )
-        
-        # Get topics from the LLM
-        response = llm(prompt)
-        identified_topics = response.strip().split(', ')  # Assumes model returns comma-separated topics
-        mapping[row['question_number']] = identified_topics
-
-    my_bar.empty()
+    for number in numbers:
+        labels = answer.get(str(number), [])
+        labels = labels.split(',') if isinstance(labels, str) else labels if isinstance(labels, list) else []
+        mapping[number] = [known[label.strip().lower()] for label in labels if isinstance(label, str) and label.strip().lower() in known]
+    return mapping
+
+async def _classify_batches(batches, topics, llm, concurrency, on_done=None):
+    """Send every batch prompt concurrently, at most concurrency requests at a time."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def classify(batch):
+        async with semaphore:
+            response = await llm.ainvoke(build_topic_prompt(topics, batch))
+        if on_done is not None:
+            on_done(len(batch))
+        return parse_topic_response(response, [number for number, _ in batch], topics)
+
+    results = await asyncio.gather(*(classify(batch) for batch in batches))
+    return {number: labels for result in results for number, labels in result.items()}
+
+def vectorize_texts(texts):
+    """
+    Vectors of a list of texts for the local classifier, L2-normalized.
+
+    Uses the sentence-transformers model named in TOPIC_EMBEDDING_MODEL when that optional
+    package is installed, otherwise TF-IDF over character n-grams (so related word forms
+    still match) as a sparse matrix.
+    """
+    if TOPIC_EMBEDDING_MODEL:
+        try:
+            from sentence_transformers import SentenceTransformer
+            return SentenceTransformer(TOPIC_EMBEDDING_MODEL).encode(texts, normalize_embeddings=True)
+        except ImportError:
+            pass
+    vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(3, 5), sublinear_tf=True, lowercase=True)
+    return vectorizer.fit_transform(texts)
+
+def classify_topics_locally(texts, topics, labeled=None, max_topics=2, relative_cutoff=0.8):
+    """
+    Offline nearest-prototype topic classifier, seeded with the topic names and refined with labeled questions.
+
+    Questions and topic names are vectorized together. The prototype of a topic is the vector of
+    its name plus the vectors of the questions labeled with it (labeled maps a text index to its
+    topics, e.g. from cached LLM answers), so it works on a new bank without any label and gets
+    closer to the bank's wording as labels accumulate. Every labeled question is scored against
+    prototypes without itself, which gives the leave-one-out accuracy of the classifier from the
+    same matrix product.
+
+    Returns:
+    - The topics of every text (those within relative_cutoff of the best match, at most
+      max_topics), the similarity of the best match, used as the confidence, and the share of
+      labeled questions whose best match is one of their topics (NaN without labeled questions).
+    """
+    labeled = labeled or {}
+    vectors = vectorize_texts(list(texts) + list(topics))
+    question_vectors, name_vectors = vectors[:len(texts)], vectors[len(texts):]
+    topic_index = {topic: t for t, topic in enumerate(topics)}
+    pairs = [(i, topic_index[label]) for i, labels in labeled.items() for label in set(labels) if label in topic_index]
+    rows, columns = zip(*pairs) if pairs else ((), ())
+    indicator = sparse.csr_matrix((np.ones(len(pairs)), (rows, columns)), shape=(len(texts), len(topics)))
+
+    # Dot products with the prototypes, minus each labeled question's own (unit-length) vector
+    prototypes = name_vectors + indicator.T @ question_vectors
+    dots = question_vectors @ prototypes.T
+    dots = dots.toarray() if sparse.issparse(dots) else np.asarray(dots)
+    norms = np.asarray(prototypes.multiply(prototypes).sum(axis=1) if sparse.issparse(prototypes)
+                       else (prototypes ** 2).sum(axis=1)).ravel()
+    own = indicator.toarray()
+    loo_norms = norms - 2 * own * dots + own
+    dots = dots - own
+    similarity = np.where(loo_norms > 1e-9, dots / np.sqrt(np.maximum(loo_norms, 1e-9)), 0)
+
+    confidence = similarity.max(axis=1, initial=0)
+    ranked = np.argsort(-similarity, axis=1)[:, :max_topics]
+    labels = [[topics[t] for t in row if similarity[i, t] > 0 and similarity[i, t] >= relative_cutoff * confidence[i]]
+              for i, row in enumerate(ranked)]
+    hits = [bool(labels[i]) and labels[i][0] in labeled[i] for i in labeled]
+    accuracy = float(np.mean(hits)) if hits else np.nan
+    return labels, confidence, accuracy
+
+def map_questions_to_topics(questions_df, topics, llm=None, batch_size=TOPIC_BATCH_SIZE, concurrency=LLM_CONCURRENCY,
+                            method=TOPIC_MAPPING, min_confidence=LOCAL_CONFIDENCE):
+    """
+    Map each question to one or more topics using LangChain for intent classification.
+
+    The local classifier matches questions to the topic names, refined with the cached answers of
+    the other questions (see classify_topics_locally). With method 'hybrid' it labels the questions
+    it is confident about (similarity of at least min_confidence) and the rest go to the LLM; it is
+    only trusted once LOCAL_MIN_EXAMPLES questions are labeled and it reaches LOCAL_MIN_ACCURACY on
+    them, and otherwise only labels the questions of failed LLM requests. 'local' never calls the
+    LLM and 'llm' sends every question. Without the LLM, local labels need a similarity of at least
+    OFFLINE_CONFIDENCE; questions below it are left unmapped, with topic_source 'unmapped'. LLM questions are packed batch_size per prompt with a JSON answer format and
+    the prompts are sent concurrently (at most concurrency at a time). Every LLM answer is memoized
+    in the disk cache under the hash of the question text, the topic set and the model, so only new
+    questions reach the LLM.
+    """
+    llm = llm or default_llm
+    topic_set = tuple(sorted(topics))
+    texts = {row['question_number']: question_text(row) for _, row in questions_df.iterrows()}
+    keys = {number: cache_key('topic_mapping', content_hash(text), topic_set, model_name(llm)) for number, text in texts.items()}
+
+    cache = get_cache()
+    mapping = {number: cache.get(key) for number, key in keys.items()}
+    sources = {number: 'cache' for number, labels in mapping.items() if labels is not None}
+    pending = [(number, texts[number]) for number, labels in mapping.items() if labels is None]
+
+    local_labels = {}
+    if pending and method in ('hybrid', 'local'):
+        numbers = list(texts)
+        labeled = {i: mapping[number] for i, number in enumerate(numbers) if mapping[number]}
+        labels, confidence, accuracy = classify_topics_locally(list(texts.values()), list(topics), labeled)
+        # Hybrid mode skips the LLM only once enough labeled questions show the classifier is accurate
+        trusted = len(labeled) >= LOCAL_MIN_EXAMPLES and accuracy >= LOCAL_MIN_ACCURACY
+        threshold = min_confidence if method == 'hybrid' and trusted else OFFLINE_CONFIDENCE
+        local_labels = {number: labels[i] for i, number in enumerate(numbers) if labels[i] and confidence[i] >= threshold}
+        if method == 'local' or trusted:
+            for number, _ in pending:
+                if number in local_labels:
+                    mapping[number], sources[number] = local_labels[number], 'local'
+            pending = [(number, text) for number, text in pending if sources.get(number) != 'local']
+    if pending and method == 'local':
+        st.warning(f"{len(pending)} questions match no topic closely enough and are left unmapped.")
+        for number, _ in pending:
+            mapping[number], sources[number] = [], 'unmapped'
+        pending = []
+
+    if pending:
+        progress_text = "Mapping operation in progress. Please wait."
+        my_bar = st.progress(0, text=progress_text)
+        done = [0]
+        def on_done(n_questions):
+            done[0] += n_questions
+            my_bar.progress(done[0] / len(pending), text=progress_text)
+
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        try:
+            for number, labels in asyncio.run(_classify_batches(batches, topics, llm, concurrency, on_done)).items():
+                mapping[number], sources[number] = labels, 'llm'
+                # Empty or unparsable answers are not cached, so the question is asked again next time
+                if labels:
+                    cache.put(keys[number], labels)
+        except Exception as e:
+            if method != 'hybrid':
+                raise
+            # Without the LLM (e.g., no network) the local classifier labels the questions it matches closely enough
+            st.warning(f"Topic mapping failed, {len(pending)} questions are mapped offline or left unmapped: {e}")
+            for number, _ in pending:
+                mapping[number] = local_labels.get(number, [])
+                sources[number] = 'local' if number in local_labels else 'unmapped'
+        my_bar.empty()
+
     questions_df['mapped_topics'] = questions_df['question_number'].map(mapping)
+    questions_df['topic_source'] = questions_df['question_number'].map(sources)
     return questions_df
 
 def plot_topic_distribution(mapped_df):
@@ -1,74 +1,125 @@
+import base64
+import copy
+import html
+import multiprocessing
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO
 import pandas as pd
 import streamlit as st
-import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.figure import Figure
+from figures import plot, render, PLOTS, PROJECTIONS
+from network import topic_incidence
+from cache import content_hash
 
-def generate_student_report(student_id, student_scores_df, question_info_df, class_info_df):
-    report = {}
-    # 1. Basic Information
-    student_data = student_scores_df[student_scores_df['student_id'] == student_id]
-    if student_data.empty:
+DIFFICULTY_THRESHOLD = 0.5  # Arbitrary split between high and low difficulty questions
+
+class ClassReports:
+    """
+    Report figures of every student of a class, computed in one batch.
+
+    Built from the correctness matrix of the response matrix and the question x topic incidence
+    matrix, so topic mastery, difficulty hit lists, percentiles and class averages cost a few
+    matrix operations for the whole class, accumulated over row blocks. report(student_id) is
+    then a lookup.
+
+    Parameters:
+    - responses: ResponseMatrix (or MappedResponses) of the class.
+    - question_info_df: CTT metrics with mapped topics, as from merge_question_info.
+    - class_info_df: Student information with a student_id column and the class column.
+    - class_column: Column of class_info_df that identifies the class of each student.
+    """
+
+    def __init__(self, responses, question_info_df, class_info_df, class_column='TP_SEXO'):
+        self.question_numbers = np.asarray(responses.item_labels)
+        self.student_index = pd.Index(responses.student_ids.astype(str))
+        total_score = responses.scores
+        incidence, self.topics = topic_incidence(question_info_df, self.question_numbers)
+        positions = pd.Index(question_info_df['question_number']).get_indexer(self.question_numbers)
+        difficulty = np.where(positions >= 0, question_info_df['difficulty-rate'].to_numpy()[positions], np.nan)
+
+        topic_total = np.zeros((responses.n_examinees, len(self.topics)), dtype=np.float32)
+        topic_correct = np.zeros_like(topic_total)
+        self.high_difficulty_correct = np.zeros((responses.n_examinees, responses.n_items), dtype=bool)
+        self.low_difficulty_incorrect = np.zeros_like(self.high_difficulty_correct)
+        for rows, correct, answered in responses.blocks():
+            # Topic mastery: correct and answered questions per topic for every student at once
+            topic_total[rows] = answered.astype(np.float32) @ incidence
+            topic_correct[rows] = correct.astype(np.float32) @ incidence
+            # Difficulty analysis; unanswered questions count as not answered correctly
+            self.high_difficulty_correct[rows] = correct & (difficulty > DIFFICULTY_THRESHOLD)
+            self.low_difficulty_incorrect[rows] = ~correct & (difficulty <= DIFFICULTY_THRESHOLD)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.topic_mastery = np.where(topic_total > 0, topic_correct / topic_total * 100, np.nan)
+
+        # Class and class average score
+        info = class_info_df.assign(student_id=class_info_df['student_id'].astype(str)).drop_duplicates('student_id')
+        classes = info.set_index('student_id')[class_column].reindex(self.student_index)
+        class_average = pd.Series(total_score, index=self.student_index).groupby(classes.to_numpy()).mean()
+
+        self.summary = pd.DataFrame({
+            'Class': classes.to_numpy(),
+            'Total Score': total_score,
+            'Correct Answer Percentage': total_score / max(len(self.question_numbers), 1) * 100,
+            'Class Average Score': classes.map(class_average).to_numpy(),
+            'Percentile Ranking': percentile_ranks(total_score),
+        }, index=self.student_index)
+
+    def with_abilities(self, abilities_df):
+        """Copy whose percentiles are on the IRT ability scale, for the students with an ability estimate."""
+        reports = copy.copy(self)
+        reports.summary = self.summary.copy()
+        if abilities_df is not None:
+            abilities = abilities_df.set_index(abilities_df['student_id'].astype(str))
+            theta = abilities['Theta'].reindex(self.student_index)
+            reports.summary['Theta'] = theta.to_numpy()
+            reports.summary['SE'] = abilities['SE'].reindex(self.student_index).to_numpy()
+            has_theta = theta.notna().to_numpy()
+            percentiles = percentile_ranks(theta.to_numpy()[has_theta], abilities['Theta'].to_numpy())
+            reports.summary.loc[has_theta, 'Percentile Ranking'] = percentiles
+        return reports
+
+    def report(self, student_id):
+        """Report of one student in the format of the report page, or None for an unknown student ID."""
+        row = self.student_index.get_indexer([str(student_id)])[0]
+        if row < 0:
+            return None
+        summary = self.summary.iloc[row]
+        mastery = self.topic_mastery[row]
+        report = {
+            'Student ID': student_id,
+            'Class': summary['Class'],
+            'Total Score': summary['Total Score'],
+            'Correct Answer Percentage': f"{summary['Correct Answer Percentage']:.2f}%",
+            'Class Average Score': summary['Class Average Score'],
+            'Topic Mastery': {topic: f"{mastery[j]:.2f}%" for j, topic in enumerate(self.topics) if not np.isnan(mastery[j])},
+            'High-Difficulty Questions Answered Correctly': self.question_numbers[self.high_difficulty_correct[row]].tolist(),
+            'Low-Difficulty Questions Answered Incorrectly': self.question_numbers[self.low_difficulty_incorrect[row]].tolist(),
+            'Percentile Ranking': f"{summary['Percentile Ranking']:.2f}%",
+        }
+        if 'Theta' in summary and not pd.isna(summary['Theta']):
+            report['Ability (Theta)'] = f"{summary['Theta']:.2f} ± {summary['SE']:.2f}"
+        return report
+
+def percentile_ranks(values, population=None):
+    """Percentage of the population (values by default) strictly below each value, via sorted search."""
+    population = np.sort(values if population is None else population)
+    return np.searchsorted(population, values, side='left') / max(len(population), 1) * 100
+
+def generate_student_report(student_id, class_reports, question_info_df):
+    report = class_reports.report(student_id)
+    if report is None:
         return f"Student ID {student_id} not found."
-    
-    student_class = class_info_df[class_info_df['student_id'] == student_id]['TP_SEXO'].values[0]
-    total_score = student_data['Score'].values[0]
-    total_questions = len(student_data.columns) - 2
-    correct_percentage = (total_score / total_questions) * 100
-    
-    report['Student ID'] = student_id
-    report['Class'] = student_class
-    report['Total Score'] = total_score
-    report['Correct Answer Percentage'] = f"{correct_percentage:.2f}%"
-
-    # Class average comparison
-    class_avg_score = student_scores_df[student_scores_df['student_id'].isin(class_info_df[class_info_df['TP_SEXO'] == student_class]['student_id'])].iloc[:, 1:].sum(axis=1).mean()
-    report['Class Average Score'] = class_avg_score
-
-    # 2. Topic Mastery
-    topic_correct_counts = {}
-    topic_total_counts = {}
-    for question in student_data.columns[1:]:
-        # Get the topic(s) mapped to the question if it exists in question_info_df
-        question_topics = question_info_df[question_info_df['question_number'] == question]['mapped_topics']
-
-        if not question_topics.empty:
-            question_topics = question_topics.values[0]
-        else:
-            question_topics = "Topic not found"  # or set to None, or handle it as needed
-        correct = student_data[question].values[0] == 1
-        for topic in question_topics:
-            topic_total_counts[topic] = topic_total_counts.get(topic, 0) + 1
-            if correct:
-                topic_correct_counts[topic] = topic_correct_counts.get(topic, 0) + 1
-
-    topic_mastery = {topic: (topic_correct_counts.get(topic, 0) / total) * 100
-                     for topic, total in topic_total_counts.items()}
-    report['Topic Mastery'] = {k: f"{v:.2f}%" for k, v in topic_mastery.items()}
-
-    # 3. Difficulty Analysis
-    high_diff_correct = []
-    low_diff_incorrect = []
-    for question in student_data.columns[1:-1]:
-        correct = student_data[question].values[0] == 1
-        difficulty = question_info_df[question_info_df['question_number'] == question]['difficulty-rate'].values[0]
-        if correct and difficulty > 0.5:  # Arbitrary high difficulty threshold
-            high_diff_correct.append(question)
-        elif not correct and difficulty <= 0.5:  # Arbitrary low difficulty threshold
-            low_diff_incorrect.append(question)
-
-    report['High-Difficulty Questions Answered Correctly'] = high_diff_correct
-    report['Low-Difficulty Questions Answered Incorrectly'] = low_diff_incorrect
-
-    # 4. Class Standing and Percentile
-    scores = student_scores_df.iloc[:, 1:].sum(axis=1).values
-    percentile_rank = (scores < total_score).sum() / len(scores) * 100
-    report['Percentile Ranking'] = f"{percentile_rank:.2f}%"
 
     st.write(f"### Report for Student ID: {report['Student ID']}")
     st.write(f"Class: {report['Class']}")
     st.write(f"Total Score: {report['Total Score']}")
     st.write(f"Correct Answer Percentage: {report['Correct Answer Percentage']}")
     st.write(f"Class Average Score: {report['Class Average Score']}")
+    if 'Ability (Theta)' in report:
+        st.write(f"Ability (Theta): {report['Ability (Theta)']}")
     st.write(f"Percentile Ranking: {report['Percentile Ranking']}")
 
     # Call visualization functions
@@ -79,27 +130,47 @@ def generate_student_report(student_id, student_scores_df, question_info_df, cla
     generate_study_plan(report, question_info_df)
     return
 
+def report_figures(report):
+    """Render jobs (name, params, figsize) of the charts of one report, for figures.render."""
+    topic_mastery = {k: float(v.replace('%', '')) for k, v in report['Topic Mastery'].items() if float(v.replace('%', '')) > 0}
+    class_average = report['Class Average Score']
+    return [
+        ('topic_mastery', (str(report['Student ID']), tuple(topic_mastery), tuple(topic_mastery.values())), (10, 5)),
+        ('score_comparison', (float(report['Total Score']), float(class_average) if not pd.isna(class_average) else 0.0), (8, 2)),
+        ('low_difficulty_incorrect', (tuple(report['Low-Difficulty Questions Answered Incorrectly']),), (8, 5)),
+        ('performance_radar', (float(report['Correct Answer Percentage'].replace('%', '')),
+                               float(report['Percentile Ranking'].replace('%', ''))), (6, 6)),
+    ]
+
 def plot_topic_mastery(report_df):
-    # Extract and clean topic mastery data
-    topic_mastery = report_df['Topic Mastery']
-    filtered_topic_mastery = {k: float(v.replace('%', '')) for k, v in topic_mastery.items() if float(v.replace('%', '')) > 0}
-    
-    # Plotting
-    fig, ax = plt.subplots(figsize=(10, 5))
-    ax.bar(filtered_topic_mastery.keys(), filtered_topic_mastery.values(), color='skyblue')
-    ax.set_xlabel('Topics')
-    ax.set_ylabel('Mastery (%)')
-    ax.set_title(f"Topic Mastery for Student {report_df['Student ID']}")
-    plt.xticks(rotation=45, ha='right')
-    st.pyplot(fig)
+    name, params, figsize = report_figures(report_df)[0]
+    st.image(render(name, params, figsize))
 
 def plot_score_comparison(report_df):
-    total_score = report_df['Total Score']
-    class_average_score = report_df['Class Average Score']
-    max_score = max(total_score, class_average_score) * 1.2  # Scale slightly higher than max for display
+    name, params, figsize = report_figures(report_df)[1]
+    st.image(render(name, params, figsize))
+
+def plot_low_difficulty_incorrect(report_df):
+    name, params, figsize = report_figures(report_df)[2]
+    st.image(render(name, params, figsize))
+
+def plot_performance_radar(report_df):
+    name, params, figsize = report_figures(report_df)[3]
+    st.image(render(name, params, figsize))
+
+@plot('topic_mastery')
+def draw_topic_mastery(ax, student_id, topics, mastery):
+    ax.bar(topics, mastery, color='skyblue')
+    ax.set_xlabel('Topics')
+    ax.set_ylabel('Mastery (%)')
+    ax.set_title(f"Topic Mastery for Student {student_id}")
+    ax.tick_params(axis='x', labelrotation=45)
+    for label in ax.get_xticklabels():
+        label.set_horizontalalignment('right')
 
-    # Plotting
-    fig, ax = plt.subplots(figsize=(8, 2))
+@plot('score_comparison')
+def draw_score_comparison(ax, total_score, class_average_score):
+    max_score = max(total_score, class_average_score) * 1.2 or 1  # Scale slightly higher than max for display
     ax.barh(0, total_score, color='blue', alpha=0.7, height=0.3, label='Student Score')
     ax.barh(0, class_average_score, color='green', alpha=0.7, height=0.3, label='Class Average')
     ax.set_xlim(0, max_score)
@@ -107,44 +178,35 @@ def plot_score_comparison(report_df):
     ax.set_xticks([0, max_score / 2, max_score])
     ax.legend()
     ax.set_title(f"Score Comparison: Student vs Class Average")
-    st.pyplot(fig)
 
-def plot_low_difficulty_incorrect(report_df):
-    low_difficulty_incorrect = report_df['Low-Difficulty Questions Answered Incorrectly']
-    
-    # Plotting
-    fig, ax = plt.subplots(figsize=(8, 5))
+@plot('low_difficulty_incorrect')
+def draw_low_difficulty_incorrect(ax, low_difficulty_incorrect):
     ax.barh(range(len(low_difficulty_incorrect)), [1] * len(low_difficulty_incorrect), color='lightcoral')
     ax.set_yticks(range(len(low_difficulty_incorrect)))
     ax.set_yticklabels([f"Question {q}" for q in low_difficulty_incorrect])
     ax.set_title("Low-Difficulty Questions Answered Incorrectly")
     ax.set_xlabel("Incorrect Answer")
     ax.set_xlim(0, 1)
-    st.pyplot(fig)
 
-
-
-def plot_performance_radar(report_df):
+@plot('performance_radar', projection='polar')
+def draw_performance_radar(ax, correct_percentage, percentile_ranking):
     categories = ['Correct Answer Percentage', 'Percentile Ranking']
-    values = [float(report_df['Correct Answer Percentage'].replace('%', '')),
-              float(report_df['Percentile Ranking'].replace('%', ''))]
-    
+    values = [correct_percentage, percentile_ranking]
+
     # Radar chart data
     values += values[:1]  # Repeat the first value at the end for circular graph
     angles = np.linspace(0, 2 * np.pi, len(categories), endpoint=False).tolist()
     angles += angles[:1]
-    
-    fig, ax = plt.subplots(figsize=(6, 6), subplot_kw=dict(polar=True))
+
     ax.fill(angles, values, color='skyblue', alpha=0.4)
     ax.plot(angles, values, color='skyblue', linewidth=2)
     ax.set_yticklabels([])
     ax.set_xticks(angles[:-1])
     ax.set_xticklabels(categories)
     ax.set_title("Performance Radar")
-    st.pyplot(fig)
 
-
-def generate_study_plan(report_df, question_info_df):
+def study_plan(report_df, question_info_df):
+    """Topics of the low-difficulty questions answered incorrectly, ranked by average difficulty and count."""
     # Extract low-difficulty questions answered incorrectly from the report
     low_difficulty_incorrect = report_df['Low-Difficulty Questions Answered Incorrectly']
     
@@ -165,20 +227,132 @@ def generate_study_plan(report_df, question_info_df):
         )
         .sort_values(by=['avg_difficulty', 'question_count'], ascending=[True, False])
     ).reset_index()
-    
-    # Display study plan in a table
-    st.write("### Study Plan")
-    st.write("This plan ranks topics by priority, focusing on those with low-difficulty questions that were answered incorrectly.")
-    st.table(topic_difficulty.rename(columns={
+    return topic_difficulty.rename(columns={
         'mapped_topics': 'Topic',
         'question_count': 'Questions Incorrectly Answered',
         'avg_difficulty': 'Average Difficulty'
-    }))
+    })
+
+STUDY_PLAN_INTRO = "This plan ranks topics by priority, focusing on those with low-difficulty questions that were answered incorrectly."
+STUDY_PLAN_ADVICE = [
+    "**Focus on mastering topics with the lowest average difficulty** where mistakes occurred.",
+    "These are foundational topics and should be prioritized for review.",
+    "**Topics with more incorrect answers** indicate areas of particular weakness and should be reviewed thoroughly.",
+]
+
+def generate_study_plan(report_df, question_info_df):
+    # Display study plan in a table
+    st.write("### Study Plan")
+    st.write(STUDY_PLAN_INTRO)
+    st.table(study_plan(report_df, question_info_df))
     
     # Additional explanation to guide the student
-    st.write("""
-    - **Focus on mastering topics with the lowest average difficulty** where mistakes occurred.
-    - These are foundational topics and should be prioritized for review.
-    - **Topics with more incorrect answers** indicate areas of particular weakness and should be reviewed thoroughly.
-    """)
+    st.write("\n".join(f"- {advice}" for advice in STUDY_PLAN_ADVICE))
+
+def _report_lines(report):
+    lines = [f"Class: {report['Class']}", f"Total Score: {report['Total Score']}",
+             f"Correct Answer Percentage: {report['Correct Answer Percentage']}",
+             f"Class Average Score: {report['Class Average Score']}"]
+    if 'Ability (Theta)' in report:
+        lines.append(f"Ability (Theta): {report['Ability (Theta)']}")
+    lines.append(f"Percentile Ranking: {report['Percentile Ranking']}")
+    return lines
+
+def report_html(report, plan_df):
+    """Self-contained HTML page of one report, with the charts embedded as PNG images."""
+    images = "".join(f'<img src="data:image/png;base64,{base64.b64encode(render(*job)).decode()}" style="max-width:100%">'
+                     for job in report_figures(report))
+    advice = "".join(f"<li>{html.escape(text).replace('**', '')}</li>" for text in STUDY_PLAN_ADVICE)
+    return (
+        f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Report for {html.escape(str(report['Student ID']))}</title></head><body>"
+        f"<h1>Report for Student ID: {html.escape(str(report['Student ID']))}</h1>"
+        + "".join(f"<p>{html.escape(line)}</p>" for line in _report_lines(report))
+        + images
+        + f"<h2>Study Plan</h2><p>{html.escape(STUDY_PLAN_INTRO)}</p>{plan_df.to_html(index=False)}<ul>{advice}</ul>"
+        "</body></html>"
+    )
+
+def report_pdf(report, plan_df):
+    """One-page A4 PDF of one report: summary, the four charts and the study plan table."""
+    fig = Figure(figsize=(8.27, 11.69))
+    grid = fig.add_gridspec(4, 2, height_ratios=[0.9, 2.2, 2.2, 1.6], hspace=0.6, wspace=0.35)
+    header = fig.add_subplot(grid[0, :])
+    header.axis('off')
+    header.text(0, 1, f"Report for Student ID: {report['Student ID']}\n" + "\n".join(_report_lines(report)),
+                va='top', fontsize=10)
+    positions = [grid[1, 0], grid[1, 1], grid[2, 0], grid[2, 1]]
+    for (name, params, _), position in zip(report_figures(report), positions):
+        PLOTS[name](fig.add_subplot(position, projection=PROJECTIONS[name]), *params)
+    table_ax = fig.add_subplot(grid[3, :])
+    table_ax.axis('off')
+    table_ax.set_title("Study Plan")
+    if not plan_df.empty:
+        table_ax.table(cellText=plan_df.round(3).astype(str).values, colLabels=list(plan_df.columns), loc='upper center')
+    buffer = BytesIO()
+    fig.savefig(buffer, format='pdf')
+    return buffer.getvalue()
+
+REPORT_FORMATS = {'html': report_html, 'pdf': report_pdf}
+_WORKER_REPORTS = {}  # ClassReports and question info of a worker process, set once by the initializer
+
+def _set_worker_reports(class_reports, question_info_df):
+    """Process pool initializer: keep the class reports in the worker instead of sending them with every task."""
+    _WORKER_REPORTS['class_reports'] = class_reports
+    _WORKER_REPORTS['question_info_df'] = question_info_df
+
+def report_file_names(student_ids):
+    """
+    File name (without suffix) of the report of every student ID, unique within the archive.
+
+    Characters other than letters, digits, '.', '-' and '_' become '_'. IDs whose names would then
+    collide (also when only their case differs, for case-insensitive file systems) get a short
+    hash of the ID appended.
+    """
+    names = {student_id: re.sub(r'[^\w.-]', '_', str(student_id)) for student_id in student_ids}
+    counts = pd.Series([name.lower() for name in names.values()]).value_counts()
+    return {student_id: name if counts[name.lower()] == 1 else f"{name}-{content_hash(str(student_id))[:8]}"
+            for student_id, name in names.items()}
+
+def _export_reports(students, formats):
+    """Render the report files of a chunk of (student ID, file name) pairs in a worker process."""
+    files = []
+    for student_id, file_name in students:
+        report = _WORKER_REPORTS['class_reports'].report(student_id)
+        if report is None:
+            continue
+        plan_df = study_plan(report, _WORKER_REPORTS['question_info_df'])
+        files.extend((f"{file_name}.{fmt}", REPORT_FORMATS[fmt](report, plan_df)) for fmt in formats)
+    return files
+
+def export_student_reports(class_reports, question_info_df, student_ids=None, formats=('html',), max_workers=None,
+                           chunk_size=20, on_progress=None):
+    """
+    Render the report of every student to HTML and/or PDF files in worker processes, collected in a zip.
+
+    Parameters:
+    - class_reports: ClassReports of the class (with abilities, if any).
+    - question_info_df: CTT metrics with mapped topics, for the study plans.
+    - student_ids: Students to export, all students of class_reports by default.
+    - formats: Any of 'html' and 'pdf'.
+    - max_workers: Worker processes (os.cpu_count() by default).
+    - chunk_size: Students rendered per task.
+    - on_progress: Called as on_progress(done, total) whenever a chunk of students is finished.
 
+    Returns:
+    - The zip archive as bytes, one file per student and format (named by report_file_names).
+    """
+    student_ids = list(dict.fromkeys(class_reports.student_index if student_ids is None else student_ids))
+    students = list(report_file_names(student_ids).items())
+    chunks = [students[i:i + chunk_size] for i in range(0, len(students), chunk_size)]
+    buffer, done = BytesIO(), 0
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive, \
+            ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_set_worker_reports, initargs=(class_reports, question_info_df)) as pool:
+        futures = {pool.submit(_export_reports, chunk, tuple(formats)): len(chunk) for chunk in chunks}
+        for future in as_completed(futures):
+            for file_name, content in future.result():
+                archive.writestr(file_name, content)
+            done += futures[future]
+            if on_progress is not None:
+                on_progress(done, len(student_ids))
+    return buffer.getvalue()
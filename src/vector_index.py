@@ -0,0 +1,159 @@
+import json
+import os
+from contextlib import contextmanager
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from cache import CACHE_DIR, content_hash
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are not serialized across processes
+    fcntl = None
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")  # Optional sentence-transformers model, hashed n-grams otherwise
+HASHING_DIMENSIONS = 1024
+PASSAGE_CHARS = 800  # Target length of the passages cut from reference material
+
+def embed_texts(texts):
+    """
+    L2-normalized float32 embeddings of a list of texts, and the name of the embedding model.
+
+    Without EMBEDDING_MODEL (or the optional sentence-transformers package) texts are embedded
+    with signed feature hashing of character n-grams. It needs no fitting, so vectors of passages
+    added at different times stay comparable.
+    """
+    if EMBEDDING_MODEL:
+        try:
+            from sentence_transformers import SentenceTransformer
+            vectors = SentenceTransformer(EMBEDDING_MODEL).encode(list(texts), normalize_embeddings=True)
+            return np.asarray(vectors, dtype=np.float32), EMBEDDING_MODEL
+        except ImportError:
+            pass
+    vectorizer = HashingVectorizer(analyzer='char_wb', ngram_range=(3, 5), n_features=HASHING_DIMENSIONS,
+                                   alternate_sign=True, norm='l2')
+    return vectorizer.transform(list(texts)).toarray().astype(np.float32), f'hashing-{HASHING_DIMENSIONS}'
+
+def split_passages(text, max_chars=PASSAGE_CHARS):
+    """Cut reference material into passages of whole paragraphs, up to about max_chars each."""
+    passages, current = [], ''
+    for paragraph in (p.strip() for p in text.split('\n\n')):
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) > max_chars:
+            passages.append(current)
+            current = ''
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(current)
+    return passages
+
+class VectorIndex:
+    """
+    Local vector index of passages (question bank entries and reference material) for retrieval.
+
+    Embeddings are appended to a float32 file that is memory-mapped for search, and the passages
+    are kept in a JSON file next to it. add only embeds passages whose text was not indexed yet,
+    so uploading a new question bank updates the index incrementally.
+
+    The passage list defines how many embedding rows are valid: writers hold a lock file, reload
+    the passages, cut the embedding file back to that many rows (dropping rows of an interrupted
+    write), append and only then replace the passage list atomically.
+    """
+
+    def __init__(self, name='questions', directory=None):
+        self.name = name
+        self.directory = directory or os.path.join(CACHE_DIR, 'vector_index', name)
+        os.makedirs(self.directory, exist_ok=True)
+        self.embeddings_path = os.path.join(self.directory, 'embeddings.f32')
+        self.metadata_path = os.path.join(self.directory, 'passages.json')
+        self.lock_path = os.path.join(self.directory, 'lock')
+        self._load()
+
+    def _load(self):
+        self.metadata = {'model': None, 'dimensions': 0, 'passages': []}
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path) as f:
+                self.metadata = json.load(f)
+        self._hashes = {passage['hash'] for passage in self.metadata['passages']}
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock of the index directory, across threads and processes."""
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __len__(self):
+        return len(self.metadata['passages'])
+
+    @property
+    def embeddings(self):
+        """Memory-mapped (passages x dimensions) embedding matrix."""
+        if len(self) == 0:
+            return np.zeros((0, self.metadata['dimensions']), dtype=np.float32)
+        return np.memmap(self.embeddings_path, dtype=np.float32, mode='r', shape=(len(self), self.metadata['dimensions']))
+
+    def add(self, texts, source='questions'):
+        """Embed and append the texts that are not indexed yet. Returns the number of new passages."""
+        with self._locked():
+            self._load()  # Passages added by other instances since this one was opened
+            new = {}
+            for text in texts:
+                text_hash = content_hash(text)
+                if text_hash not in self._hashes:
+                    new[text_hash] = text
+            if not new:
+                return 0
+
+            vectors, model = embed_texts(list(new.values()))
+            if self.metadata['model'] not in (None, model):
+                raise ValueError(f"Index was built with '{self.metadata['model']}', not '{model}'. Use a new index directory.")
+            with open(self.embeddings_path, 'ab') as f:
+                f.truncate(len(self) * self.metadata['dimensions'] * vectors.itemsize)
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            metadata = dict(self.metadata, model=model, dimensions=vectors.shape[1],
+                            passages=self.metadata['passages'] + [{'hash': h, 'text': text, 'source': source} for h, text in new.items()])
+            # Written last and atomically: until the rename, readers see the previous rows only
+            temp_path = self.metadata_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(metadata, f)
+            os.replace(temp_path, self.metadata_path)
+            self.metadata = metadata
+            self._hashes.update(new)
+            return len(new)
+
+    def search(self, queries, k=3, exclude_self=True, within=None):
+        """
+        Top-k passages of every query by cosine similarity.
+
+        Returns one list of (passage text, similarity) per query. With exclude_self a passage
+        identical to its query (e.g., the question itself) is skipped. within restricts the
+        search to the passages with the given content hashes (e.g., those of one question bank).
+        """
+        passages = self.metadata['passages']
+        rows = np.arange(len(passages)) if within is None else \
+            np.array([i for i, passage in enumerate(passages) if passage['hash'] in within], dtype=np.int64)
+        if len(rows) == 0:
+            return [[] for _ in queries]
+        query_vectors, _ = embed_texts(queries)
+        embeddings = self.embeddings if within is None else self.embeddings[rows]
+        query_hashes = [content_hash(query) for query in queries]
+        results = []
+        for start in range(0, len(queries), 256):
+            similarity = query_vectors[start:start + 256] @ embeddings.T
+            n_top = min(k + exclude_self, similarity.shape[1])
+            top = np.argpartition(-similarity, n_top - 1, axis=1)[:, :n_top]
+            for row, candidates in enumerate(top):
+                ranked = candidates[np.argsort(-similarity[row, candidates])]
+                matches = [(passages[rows[i]]['text'], float(similarity[row, i])) for i in ranked
+                           if not (exclude_self and passages[rows[i]]['hash'] == query_hashes[start + row])]
+                results.append(matches[:k])
+        return results
@@ -0,0 +1,36 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+
+# The modules read these at import time: no real LLM client and a throwaway disk cache
+os.environ.setdefault('LLM_BACKEND', 'stub')
+os.environ.setdefault('ANALYSIS_CACHE_DIR', tempfile.mkdtemp(prefix='irtify-tests-'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+from response_matrix import ResponseMatrix
+
+
+def simulate_responses(a, b, c=None, n_examinees=4000, seed=0, theta=None, missing=0.0):
+    """
+    ResponseMatrix of simulated 3PL answers to items with options 'a'..'d', the key being 'a'.
+
+    Wrong answers pick one of the three distractors at random; a share missing of the cells is left blank.
+    """
+    rng = np.random.default_rng(seed)
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    c = np.zeros(len(a)) if c is None else np.asarray(c, dtype=float)
+    theta = rng.normal(size=n_examinees) if theta is None else theta
+    p = c + (1 - c) / (1 + np.exp(-a * (theta[:, None] - b)))
+    correct = rng.random(p.shape) < p
+    codes = np.where(correct, 1, rng.integers(2, 5, size=p.shape)).astype(np.uint8)
+    codes[rng.random(p.shape) < missing] = 0
+    return ResponseMatrix(codes, np.ones(len(a), dtype=np.uint8), ['a', 'b', 'c', 'd'],
+                          np.array([f's{i}' for i in range(len(theta))]), np.arange(1, len(a) + 1))
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(42)
@@ -0,0 +1,85 @@
+import os
+
+import cache as cache_module
+from cache import DiskCache, cache_key
+
+
+def test_cached_none_is_a_hit(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    calls = []
+    compute = lambda: calls.append(1)  # Returns None
+
+    assert cache.get_or_compute('key', compute) is None
+    assert cache.get_or_compute('key', compute) is None
+    assert len(calls) == 1
+
+
+def test_unreadable_entries_are_evicted(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.put('truncated', list(range(100)))
+    path = cache._path('truncated')
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    # A pickle of a class that no longer exists
+    cache.put('moved', None)
+    with open(cache._path('moved'), 'wb') as f:
+        f.write(b'\x80\x04cno_such_module\nNoSuchClass\n.')
+
+    for key in ['truncated', 'moved']:
+        assert cache.get(key, 'missing') == 'missing'
+        assert not os.path.exists(cache._path(key))
+    assert cache.get_or_compute('truncated', lambda: 'recomputed') == 'recomputed'
+
+
+def test_cache_key_depends_on_every_part():
+    assert cache_key('a', 1) == cache_key('a', 1)
+    assert cache_key('a', 1) != cache_key('a', 2)
+    assert cache_key('a', None) != cache_key('a', 'None')
+
+
+def test_cache_key_changes_with_the_cache_version(monkeypatch):
+    key = cache_key('a', 1)
+    monkeypatch.setattr(cache_module, 'CACHE_VERSION', cache_module.CACHE_VERSION + 1)
+    assert cache_key('a', 1) != key
+
+
+def test_failed_writes_leave_no_temporary_file(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    try:
+        cache.put('key', lambda: None)  # Lambdas cannot be pickled
+    except Exception:
+        pass
+    else:
+        raise AssertionError('put stored an unpicklable value')
+    assert os.listdir(tmp_path) == []
+
+
+def test_eviction_skips_entries_removed_meanwhile(tmp_path, monkeypatch):
+    cache = DiskCache(str(tmp_path), max_bytes=0)
+    for key in ['a', 'b']:
+        with open(cache._path(key), 'wb') as f:
+            f.write(b'x' * 10)
+    real_scandir = os.scandir
+
+    def racing_scandir(path):
+        entries = list(real_scandir(path))
+        os.remove(cache._path('a'))  # Another session evicts an entry between listing and stat
+        return iter(entries)
+
+    monkeypatch.setattr(os, 'scandir', racing_scandir)
+    cache.evict()
+    assert os.listdir(tmp_path) == []
+
+
+def test_eviction_removes_stale_temporary_files(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    stale, fresh = tmp_path / 'stale.tmp', tmp_path / 'fresh.tmp'
+    stale.write_bytes(b'partial')
+    fresh.write_bytes(b'partial')
+    old = os.path.getmtime(stale) - cache_module.TEMP_MAX_AGE - 1
+    os.utime(stale, (old, old))
+    cache.evict()
+
+    assert not stale.exists() and fresh.exists()
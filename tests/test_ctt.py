@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+from conftest import simulate_responses
+from ctt import calculate_ctt_metrics, calculate_distractor_metrics, accumulate_ctt_statistics
+from response_matrix import MappedResponses
+
+
+def brute_force_ctt(X):
+    """Textbook CTT metrics of a complete 0/1 score matrix, one item at a time."""
+    n_items = X.shape[1]
+    total = X.sum(axis=1)
+    alpha = n_items / (n_items - 1) * (1 - X.var(axis=0, ddof=1).sum() / total.var(ddof=1))
+    rows = []
+    for i in range(n_items):
+        rest = total - X[:, i]
+        rest_items = np.delete(X, i, axis=1)
+        alpha_deleted = (n_items - 1) / (n_items - 2) * (1 - rest_items.var(axis=0, ddof=1).sum() / rest.var(ddof=1))
+        rows.append((X[:, i].mean(), np.corrcoef(X[:, i], total)[0, 1], np.corrcoef(X[:, i], rest)[0, 1], alpha_deleted))
+    return alpha, pd.DataFrame(rows, columns=['difficulty-rate', 'point-biserial', 'item-rest-correlation', 'alpha-if-deleted'])
+
+
+def test_ctt_metrics_match_brute_force(rng):
+    responses = simulate_responses(rng.uniform(0.5, 2, 12), rng.uniform(-1, 1, 12), n_examinees=1500)
+    metrics = calculate_ctt_metrics(responses)
+    alpha, expected = brute_force_ctt(responses.correct.astype(float))
+
+    assert np.isclose(metrics.attrs['cronbachs-alpha'], alpha)
+    for column in expected:
+        assert np.allclose(metrics[column], expected[column]), column
+    assert metrics.attrs['score-distribution'].sum() == responses.n_examinees
+
+
+def test_discrimination_rate_is_the_median_split_difference(rng):
+    responses = simulate_responses(rng.uniform(0.5, 2, 8), rng.uniform(-1, 1, 8), n_examinees=800)
+    X = responses.correct.astype(float)
+    scores = X.sum(axis=1)
+    upper = scores >= np.median(scores)
+    expected = X[upper].mean(axis=0) - X[~upper].mean(axis=0)
+
+    assert np.allclose(calculate_ctt_metrics(responses)['discrimination-rate'], expected)
+
+
+def test_block_accumulation_does_not_depend_on_block_size(rng):
+    responses = simulate_responses(rng.uniform(0.5, 2, 10), rng.uniform(-1, 1, 10), n_examinees=1000, missing=0.1)
+    whole = accumulate_ctt_statistics(responses, block_rows=10 ** 6)
+    blocked = accumulate_ctt_statistics(responses, block_rows=97)
+
+    for name in whole:
+        assert np.allclose(whole[name], blocked[name]), name
+
+
+def test_memory_mapped_responses_give_the_same_metrics(rng, tmp_path):
+    responses = simulate_responses(rng.uniform(0.5, 2, 10), rng.uniform(-1, 1, 10), n_examinees=1000, missing=0.05)
+    responses.save(tmp_path)
+    mapped = MappedResponses.open(tmp_path)
+
+    pd.testing.assert_frame_equal(calculate_ctt_metrics(mapped), calculate_ctt_metrics(responses))
+    pd.testing.assert_frame_equal(calculate_distractor_metrics(mapped), calculate_distractor_metrics(responses))
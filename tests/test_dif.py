@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+from response_matrix import ResponseMatrix
+from conftest import simulate_responses
+from dif import dif_sweep, align_groups, irt_lr_dif
+
+PLANTED = 0  # Item made one logit harder for the focal group
+
+
+def planted_dif(rng, n_items=10, n_per_group=3000, shift=1.0):
+    """Responses of a reference and a focal group of equal ability, with DIF planted on one item."""
+    a, b = rng.uniform(0.8, 1.8, n_items), rng.uniform(-1, 1, n_items)
+    focal_b = b.copy()
+    focal_b[PLANTED] += shift
+    reference = simulate_responses(a, b, n_examinees=n_per_group, seed=1)
+    focal = simulate_responses(a, focal_b, n_examinees=n_per_group, seed=2)
+    student_ids = np.array([f's{i}' for i in range(2 * n_per_group)])
+    responses = ResponseMatrix(np.vstack([reference.codes, focal.codes]), reference.key, reference.option_labels,
+                               student_ids, reference.item_labels)
+    info_df = pd.DataFrame({'student_id': student_ids, 'g': ['ref'] * n_per_group + ['focal'] * n_per_group})
+    return responses, info_df
+
+
+def test_align_groups_orders_groups_by_size():
+    responses = simulate_responses([1, 1], [0, 0], n_examinees=5)
+    info_df = pd.DataFrame({'student_id': ['s4', 's0', 's1', 's9', 's2'], 'g': ['x', 'y', 'y', 'x', 'y']})
+    group_codes, labels = align_groups(responses, info_df, 'g')
+
+    assert labels == ['y', 'x']
+    assert group_codes.tolist() == [0, 0, 0, -1, 1]
+
+
+def test_mantel_haenszel_and_logistic_regression_detect_planted_dif(rng):
+    responses, info_df = planted_dif(rng)
+    sweep_df = dif_sweep(responses, info_df, ['g']).set_index('Item')
+
+    assert (sweep_df['Focal'] == 'focal').all()
+    assert sweep_df.loc[PLANTED + 1, 'ETS Class'] == 'C'
+    assert sweep_df.loc[PLANTED + 1, 'MH D-DIF'] < -1.5  # Negative: the item favours the reference group
+    assert sweep_df.loc[PLANTED + 1, 'LR p-value'] < 1e-6
+    assert sweep_df.loc[PLANTED + 1, 'LR Class'] != 'A'
+
+    # The clean items may pick up a little contamination from the matching score, but no large DIF
+    clean = sweep_df.drop(index=PLANTED + 1)
+    assert (clean['ETS Class'] != 'C').all()
+    assert (clean['LR Class'] == 'A').all()
+
+
+def test_dif_sweep_skips_columns_with_a_single_group():
+    responses = simulate_responses([1, 1, 1], [0, 0, 0], n_examinees=50)
+    info_df = pd.DataFrame({'student_id': responses.student_ids, 'g': 'only'})
+
+    assert dif_sweep(responses, info_df, ['g']).empty
+
+
+def test_irt_likelihood_ratio_detects_planted_dif(rng):
+    responses, info_df = planted_dif(rng, n_items=6, n_per_group=1500)
+    group_codes, labels = align_groups(responses, info_df, 'g')
+    lr_df = irt_lr_dif(responses, group_codes, labels, model='2PL', max_workers=2).set_index('Item')
+
+    assert not lr_df.loc[PLANTED + 1, 'Anchor']
+    assert lr_df.loc[PLANTED + 1, 'DIF Detected']
+    assert lr_df.loc[PLANTED + 1, 'Difficulty focal'] - lr_df.loc[PLANTED + 1, 'Difficulty ref'] > 0.5
+    assert (lr_df['df'] == 2).all()
+    assert lr_df.drop(index=PLANTED + 1)['p-value'].min() > 0.001
@@ -0,0 +1,144 @@
+import gzip
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from pyarrow import parquet as pq
+
+import ingest
+from response_matrix import ResponseMatrix, MappedResponses
+from ingest import read_answer_sheet, stream_answer_sheet, open_answer_sheet, read_preview
+
+ANSWER_DATA = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'answer-data.csv')
+
+
+def write_sheet(sheet_df, path):
+    """Write a header-less answer sheet table (IDs in the first column) as CSV, gzip CSV or Parquet."""
+    if path.endswith('.parquet'):
+        table = pa.table({str(i): sheet_df[column].astype(object).where(sheet_df[column].notna(), None)
+                          for i, column in enumerate(sheet_df.columns)})
+        pq.write_table(table, path, row_group_size=7)
+    else:
+        with (gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')) as f:
+            sheet_df.to_csv(f, header=False, index=False)
+
+
+def random_sheet(rng, n_students=50, n_items=9):
+    """Answer sheet with blanks and an option ('e') that only appears in the responses."""
+    answers = rng.choice(np.array(['a', 'b', 'c', 'd', 'e', None], dtype=object), size=(n_students, n_items),
+                         p=[0.3, 0.2, 0.2, 0.15, 0.05, 0.1])
+    rows = [['question_number'] + [str(i) for i in range(1, n_items + 1)],
+            ['true_answers'] + list(rng.choice(['a', 'b', 'c', 'd'], size=n_items))]
+    rows += [[f'r{i}'] + list(row) for i, row in enumerate(answers)]
+    return pd.DataFrame(rows)
+
+
+def expected_responses(path, blank_as_wrong=False):
+    """The answer sheet encoded the way the DataFrame upload path used to do it."""
+    return ResponseMatrix.from_answer_sheet(pd.read_csv(path, header=None, index_col=0, dtype=str), blank_as_wrong)
+
+
+def assert_same_responses(responses, expected):
+    assert np.array_equal(np.asarray(responses.codes), expected.codes)
+    assert np.array_equal(responses.key, expected.key)
+    assert list(responses.option_labels) == expected.option_labels
+    assert np.array_equal(responses.student_ids.astype(str), expected.student_ids.astype(str))
+    assert np.array_equal(responses.scores, expected.scores)
+    assert np.array_equal(responses.n_answered, expected.n_answered)
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.csv.gz', '.parquet'])
+def test_read_answer_sheet_matches_the_dataframe_encoding(rng, tmp_path, suffix):
+    path = str(tmp_path / f'sheet{suffix}')
+    sheet_df = random_sheet(rng)
+    write_sheet(sheet_df, path)
+    write_sheet(sheet_df, str(tmp_path / 'sheet.txt'))
+    expected = expected_responses(str(tmp_path / 'sheet.txt'))
+
+    # Small blocks force several record batches and buffer growths
+    assert_same_responses(read_answer_sheet(path, os.path.basename(path), block_size=256), expected)
+    with open(path, 'rb') as f:
+        assert_same_responses(read_answer_sheet(f, os.path.basename(path)), expected)
+
+
+def test_read_answer_sheet_on_the_example_data():
+    responses = read_answer_sheet(ANSWER_DATA, 'answer-data.csv')
+    assert_same_responses(responses, expected_responses(ANSWER_DATA))
+    assert responses.key_labels.tolist() == list('ccaacbbabcdcbcd')
+
+
+def test_blank_as_wrong_counts_blanks_as_answered(rng, tmp_path):
+    path = str(tmp_path / 'sheet.csv')
+    write_sheet(random_sheet(rng), path)
+    missing = read_answer_sheet(path, 'sheet.csv')
+    wrong = read_answer_sheet(path, 'sheet.csv', blank_as_wrong=True)
+
+    assert missing.has_missing and not wrong.has_missing
+    assert np.array_equal(wrong.scores, missing.scores)
+    assert (wrong.n_answered == wrong.n_items).all()
+    assert_same_responses(wrong, expected_responses(path, blank_as_wrong=True))
+
+
+def test_stream_answer_sheet_matches_read_answer_sheet(rng, tmp_path):
+    path = str(tmp_path / 'sheet.csv.gz')
+    write_sheet(random_sheet(rng, n_students=200), path)
+    mapped = stream_answer_sheet(path, 'sheet.csv.gz', str(tmp_path / 'mapped'), block_size=256)
+
+    assert isinstance(mapped, MappedResponses)
+    assert not os.path.exists(tmp_path / 'mapped' / 'codes.raw')
+    assert_same_responses(mapped, read_answer_sheet(path, 'sheet.csv.gz'))
+
+
+def test_open_answer_sheet_memory_maps_large_uploads_once(rng, tmp_path):
+    path = str(tmp_path / 'sheet.csv')
+    write_sheet(random_sheet(rng), path)
+    size = os.path.getsize(path)
+
+    in_memory = open_answer_sheet(path, 'sheet.csv', 'hash', size)
+    assert not isinstance(in_memory, MappedResponses)
+
+    mapped = open_answer_sheet(path, 'sheet.csv', 'test-open-answer-sheet', size, blank_as_wrong=True, threshold_mb=0)
+    assert isinstance(mapped, MappedResponses) and mapped.blank_as_wrong
+    assert_same_responses(mapped, read_answer_sheet(path, 'sheet.csv', blank_as_wrong=True))
+
+    # A later session opens the stored matrix without reading the upload again
+    reopened = open_answer_sheet(str(tmp_path / 'missing.csv'), 'sheet.csv', 'test-open-answer-sheet', size, threshold_mb=0)
+    assert_same_responses(reopened, in_memory)
+
+
+def test_answer_sheet_without_a_key_row_is_rejected(tmp_path):
+    path = tmp_path / 'sheet.csv'
+    path.write_text('question_number,1,2\n')
+    with pytest.raises(ValueError):
+        read_answer_sheet(str(path), 'sheet.csv')
+
+
+def test_read_preview_is_indexed_by_the_first_column():
+    preview_df = read_preview(ANSWER_DATA, 'answer-data.csv', n_rows=4)
+    assert preview_df.index.tolist() == ['question_number', 'true_answers', 'r1', 'r2']
+    assert preview_df.shape[1] == 15
+
+
+def test_memory_mapped_matrices_are_evicted_least_recently_used_first(rng, tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, 'CACHE_DIR', str(tmp_path / 'cache'))
+    path = str(tmp_path / 'sheet.csv')
+    write_sheet(random_sheet(rng, n_students=500), path)
+    size = os.path.getsize(path)
+    directory = tmp_path / 'cache' / 'responses'
+
+    first = open_answer_sheet(path, 'sheet.csv', 'first', size, threshold_mb=0)
+    matrix_mb = sum(f.stat().st_size for f in os.scandir(directory / 'first')) / 1024 ** 2
+    open_answer_sheet(path, 'sheet.csv', 'second', size, threshold_mb=0)
+    os.utime(directory / 'first', (1, 1))  # Least recently used
+    (directory / 'third.partial').mkdir()  # Temporary directory of a writer that died
+    os.utime(directory / 'third.partial', (1, 1))
+
+    third = open_answer_sheet(path, 'sheet.csv', 'third', size, threshold_mb=0, max_mb=2.5 * matrix_mb)
+    assert sorted(os.listdir(directory)) == ['second', 'third']
+    # A matrix removed from disk stays readable while it is open
+    assert_same_responses(first, third)
+
+    open_answer_sheet(path, 'sheet.csv', 'third', size, threshold_mb=0, max_mb=0)
+    assert os.listdir(directory) == ['third']  # The matrix being opened is never removed
@@ -0,0 +1,43 @@
+import numpy as np
+
+from conftest import simulate_responses
+from irt import calibrate, SLOPE_BOUNDS
+
+
+def test_2pl_recovers_generating_parameters(rng):
+    a = rng.uniform(0.7, 2.0, 20)
+    b = rng.uniform(-1.5, 1.5, 20)
+    calibration = calibrate(simulate_responses(a, b, n_examinees=5000), model='2PL')
+
+    assert calibration.converged
+    assert np.corrcoef(calibration.a, a)[0, 1] > 0.9
+    assert np.sqrt(np.mean((calibration.b - b) ** 2)) < 0.15
+    assert np.abs(calibration.a - a).mean() < 0.15
+
+
+def test_1pl_recovers_difficulties_with_missing_responses(rng):
+    b = rng.uniform(-1.5, 1.5, 15)
+    calibration = calibrate(simulate_responses(np.ones(15), b, n_examinees=4000, missing=0.1), model='1PL')
+
+    assert np.allclose(calibration.a, calibration.a[0])  # One common slope
+    assert abs(calibration.a[0] - 1) < 0.1
+    assert np.sqrt(np.mean((calibration.b - b) ** 2)) < 0.15
+
+
+def test_negative_discrimination_is_clipped_and_flagged(rng):
+    a = np.append(rng.uniform(0.8, 2.0, 9), -1.2)  # Last item discriminates negatively, e.g. miskeyed
+    b = rng.uniform(-1, 1, 10)
+    calibration = calibrate(simulate_responses(a, b, n_examinees=3000), model='2PL')
+
+    assert (calibration.a >= SLOPE_BOUNDS[0]).all()
+    assert calibration.flagged_items().tolist() == [False] * 9 + [True]
+
+
+def test_warm_start_reaches_the_same_solution(rng):
+    a, b = rng.uniform(0.7, 2.0, 10), rng.uniform(-1, 1, 10)
+    responses = simulate_responses(a, b, n_examinees=2000)
+    cold = calibrate(responses, model='2PL')
+    warm = calibrate(responses, model='2PL', init=cold)
+
+    assert warm.n_iter < cold.n_iter
+    assert np.allclose(warm.items[['Difficulty', 'Discrimination']], cold.items[['Difficulty', 'Discrimination']], atol=1e-2)
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from llm import StubLLM, TokenBucket, LLMGateway, MockLLMServer, LLM_MAX_COMPLETION_TOKENS, estimate_tokens
+
+
+def invoke_together(gateway, prompts):
+    """Invoke the gateway from one thread per prompt, all released at once; returns the completions."""
+    barrier = threading.Barrier(len(prompts))
+    results = [None] * len(prompts)
+
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = gateway.invoke(prompts[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(prompts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_identical_prompts_in_flight_are_sent_once():
+    llm = StubLLM(lambda prompt: prompt.upper(), latency=0.3)
+    gateway = LLMGateway(llm)
+    results = invoke_together(gateway, ['explain item 1'] * 8 + ['explain item 2'] * 4)
+
+    assert sorted(llm.calls) == ['explain item 1', 'explain item 2']
+    assert results == ['EXPLAIN ITEM 1'] * 8 + ['EXPLAIN ITEM 2'] * 4
+    metrics = gateway.metrics()
+    assert metrics['requests'] == 2 and metrics['coalesced'] == 10
+    assert metrics['queued'] == 0 and metrics['in_flight'] == 0
+
+
+def test_identical_prompts_are_sent_again_once_answered():
+    llm = StubLLM(lambda prompt: 'done')
+    gateway = LLMGateway(llm)
+    gateway.invoke('prompt')
+    gateway.invoke('prompt')
+
+    assert len(llm.calls) == 2 and gateway.metrics()['coalesced'] == 0
+
+
+def test_coalesced_callers_get_the_error_of_the_request():
+    def fail(prompt):
+        raise RuntimeError('rate limited upstream')
+
+    gateway = LLMGateway(StubLLM(fail, latency=0.3))
+    results = invoke_together(gateway, ['prompt'] * 4)
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert gateway.metrics()['errors'] == 1
+    assert gateway.metrics()['in_flight'] == 0
+
+
+def test_streamed_requests_are_coalesced():
+    llm = StubLLM(lambda prompt: 'one two three', latency=0.2)
+    gateway = LLMGateway(llm)
+
+    async def run():
+        return await asyncio.gather(*[gateway.ainvoke('prompt') for _ in range(5)])
+
+    assert asyncio.run(run()) == ['one two three'] * 5
+    assert len(llm.calls) == 1 and gateway.metrics()['coalesced'] == 4
+
+
+def test_token_bucket_queues_reservations_beyond_its_capacity():
+    bucket = TokenBucket(60)  # One token per second, at most 60 banked
+
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(1) == pytest.approx(1, abs=0.05)
+    assert bucket.reserve(2) == pytest.approx(3, abs=0.05)  # Queued behind the previous reservation
+
+
+def test_token_bucket_settlement_is_clamped_to_capacity():
+    bucket = TokenBucket(60)
+    bucket.reserve(10)
+    bucket.settle(-1000)  # A refund larger than the reservation
+
+    assert bucket.tokens == 60
+    assert bucket.reserve(61) == pytest.approx(1, abs=0.05)
+
+
+def test_gateway_waits_for_the_request_rate_limit():
+    gateway = LLMGateway(StubLLM(lambda prompt: 'ok'), requests_per_minute=120)
+    gateway.requests.reserve(120)  # Use up the burst, the next request has to wait half a second
+
+    start = time.monotonic()
+    assert gateway.invoke('prompt') == 'ok'
+    assert time.monotonic() - start >= 0.45
+    assert gateway.metrics()['wait_seconds'] == pytest.approx(0.5, abs=0.05)
+
+
+def test_gateway_charges_the_actual_completion_tokens():
+    completion = 'word ' * 100
+    gateway = LLMGateway(StubLLM(lambda prompt: completion), tokens_per_minute=6000)
+    gateway.invoke('prompt')
+
+    # Tokens refill in the meantime, so only check the charge is close to prompt + completion
+    used = gateway.tokens.capacity - gateway.tokens.tokens
+    assert used == pytest.approx(estimate_tokens('prompt') + estimate_tokens(completion), abs=2)
+    assert used < LLM_MAX_COMPLETION_TOKENS + estimate_tokens('prompt')
+
+
+def test_mock_server_serves_completions():
+    server = MockLLMServer(lambda prompt: f'echo {prompt}').start()
+    try:
+        for stream in (False, True):
+            request = urllib.request.Request(f'{server.base_url}/completions', method='POST',
+                                             data=json.dumps({'prompt': 'hello there', 'stream': stream}).encode(),
+                                             headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=5) as response:
+                body = response.read().decode()
+            if stream:
+                chunks = [json.loads(line[6:]) for line in body.splitlines() if line.startswith('data: {')]
+                text = ''.join(chunk['choices'][0]['text'] for chunk in chunks)
+                assert body.rstrip().endswith('data: [DONE]')
+            else:
+                text = json.loads(body)['choices'][0]['text']
+            assert text == 'echo hello there'
+    finally:
+        server.stop()
+
+
+def test_cancelling_a_leader_during_the_rate_limit_wait_releases_its_prompt():
+    llm = StubLLM(lambda prompt: 'answer')
+    gateway = LLMGateway(llm, requests_per_minute=60)
+    gateway.requests.reserve(61)  # The next request waits about two seconds
+
+    async def run():
+        leader = asyncio.create_task(gateway.ainvoke('prompt'))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(gateway.ainvoke('prompt'))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        # The coalesced caller sends the request itself instead of waiting forever
+        return await asyncio.wait_for(follower, timeout=5)
+
+    assert asyncio.run(run()) == 'answer'
+    assert llm.calls == ['prompt']
+    assert gateway._in_flight == {}
+    metrics = gateway.metrics()
+    assert metrics['queued'] == 0 and metrics['in_flight'] == 0 and metrics['requests'] == 1
+
+
+def test_failed_reservation_releases_the_prompt():
+    gateway = LLMGateway(StubLLM(lambda prompt: 'answer'))
+
+    def fail(prompt):
+        raise RuntimeError('rate limiter unavailable')
+
+    gateway._reserve = fail
+    with pytest.raises(RuntimeError):
+        gateway.invoke('prompt')
+    assert gateway._in_flight == {} and gateway.metrics()['queued'] == 0
+
+    del gateway._reserve
+    assert gateway.invoke('prompt') == 'answer'
+
+
+def test_cancelled_follower_does_not_cancel_the_shared_request():
+    llm = StubLLM(lambda prompt: 'answer', latency=0.3)
+    gateway = LLMGateway(llm)
+
+    async def run():
+        leader = asyncio.create_task(gateway.ainvoke('prompt'))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(gateway.ainvoke('prompt'))
+        await asyncio.sleep(0.05)
+        follower.cancel()
+        return await leader
+
+    assert asyncio.run(run()) == 'answer'
+    assert gateway.metrics()['errors'] == 0
@@ -0,0 +1,122 @@
+import os
+import zipfile
+from io import BytesIO
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+from omr import scan_sheet, scan_batch, grid_answers, write_answer_sheet, parse_key, scan_folder, MULTIPLE_MARKS
+from ingest import read_answer_sheet
+
+EXAMPLE_SHEET = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'example-sheet.png')
+EXAMPLE_ANSWERS = list('cbaadaccd')
+
+
+def example_png(width=1.0):
+    """PNG bytes of the example sheet, optionally cut to its left part (fewer questions)."""
+    image = cv2.imread(EXAMPLE_SHEET)
+    return cv2.imencode('.png', image[:, :int(image.shape[1] * width)])[1].tobytes()
+
+
+def test_scan_sheet_reads_the_example_sheet():
+    assert scan_sheet(example_png()) == EXAMPLE_ANSWERS
+
+
+def test_scan_sheet_rejects_images_without_a_grid():
+    blank = cv2.imencode('.png', np.full((100, 200), 255, dtype=np.uint8))[1].tobytes()
+    for data, message in [(blank, 'No grid'), (b'not an image', 'Not a readable image')]:
+        try:
+            scan_sheet(data)
+        except ValueError as e:
+            assert message in str(e)
+        else:
+            raise AssertionError('scan_sheet accepted an image without bubbles')
+
+
+def test_grid_answers_reads_blanks_and_multiple_marks():
+    # Two blocks of 2-option questions, one question per column
+    grid = np.array([[0.9, 0.1, 0.0, 0.8],
+                     [0.0, 0.7, 0.1, 0.9],
+                     [0.1, np.nan, 0.6, 0.0],
+                     [0.0, 0.0, 0.0, 0.0]])
+    assert grid_answers(grid, 2) == ['a', 'b', '', MULTIPLE_MARKS, '', '', 'a', '']
+    assert grid_answers(grid.T, 2, orientation='rows') == ['a', 'b', '', MULTIPLE_MARKS, '', '', 'a', '']
+
+
+def test_scan_batch_reads_an_uploaded_zip_and_reports_bad_sheets():
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('key.png', example_png())
+        for sid in ['s1', 's2']:
+            zf.writestr(f'{sid}.png', example_png())
+        zf.writestr('morning/s3.png', example_png())
+        zf.writestr('afternoon/s3.png', example_png())
+        zf.writestr('s4.png', example_png(width=0.5))
+        zf.writestr('s5.png', cv2.imencode('.png', np.full((100, 200), 255, dtype=np.uint8))[1].tobytes())
+        zf.writestr('notes.txt', 'not a scan')
+    progress = []
+    sheet_df = scan_batch(archive, max_workers=2, chunk_size=3, on_progress=lambda done, total: progress.append((done, total)))
+
+    assert sheet_df.iloc[0].tolist() == ['question_number'] + [str(q) for q in range(1, 10)]
+    assert sheet_df.iloc[1].tolist() == ['true_answers'] + EXAMPLE_ANSWERS
+    assert sheet_df.iloc[2:, 0].tolist() == ['s1', 's2']
+    assert (sheet_df.iloc[2:, 1:].to_numpy() == np.array(EXAMPLE_ANSWERS)).all()
+
+    errors = sheet_df.attrs['errors']
+    assert sorted(errors) == ['afternoon/s3.png', 'morning/s3.png', 's4.png', 's5.png']
+    assert 'shared by 2 scans' in errors['morning/s3.png']
+    assert 'the answer key has 9' in errors['s4.png']
+    assert 'No grid' in errors['s5.png']
+    assert progress[-1] == (7, 7)
+
+
+def test_scan_batch_of_a_folder_with_a_given_key(tmp_path):
+    for sid in ['b', 'a']:
+        (tmp_path / f'{sid}.png').write_bytes(example_png())
+    key = list('cbaaaaaaa')
+    sheet_df = scan_batch(str(tmp_path), key=key, max_workers=1)
+
+    assert sheet_df.iloc[1, 1:].tolist() == key
+    assert sheet_df.iloc[2:, 0].tolist() == ['a', 'b']
+    assert sheet_df.attrs['errors'] == {}
+
+
+def test_scanned_sheet_round_trips_through_ingest(tmp_path):
+    sheet_df = pd.DataFrame([['question_number', '1', '2', '3'], ['true_answers', 'a', 'b', 'c'],
+                             ['s1', 'a', 'b', ''], ['s2', MULTIPLE_MARKS, 'b', 'c']])
+    for name in ['sheet.csv', 'sheet.csv.gz', 'sheet.parquet']:
+        path = str(tmp_path / name)
+        write_answer_sheet(sheet_df, path)
+        responses = read_answer_sheet(path, name)
+        assert responses.student_ids.tolist() == ['s1', 's2']
+        assert responses.scores.tolist() == [2, 2]
+        assert responses.n_answered.tolist() == [2, 3]  # The unfilled question stays blank
+    buffer = BytesIO()
+    write_answer_sheet(sheet_df, buffer, fmt='parquet')
+    assert read_answer_sheet(BytesIO(buffer.getvalue()), 'sheet.parquet').key_labels.tolist() == ['a', 'b', 'c']
+
+
+def test_parse_key_accepts_runs_and_separated_letters():
+    assert parse_key('cbaad') == list('cbaad')
+    assert parse_key(' C, B, A;a  d ') == list('cbaad')
+    assert parse_key('') == []
+    for typed in ['c, b, x', 'cbae', 'cb, aa']:
+        with pytest.raises(ValueError):
+            parse_key(typed, n_options=4)
+    assert parse_key('e, a', n_options=5) == ['e', 'a']
+
+
+def test_scan_folder_stays_inside_the_scan_root(tmp_path):
+    root = tmp_path / 'scans'
+    (root / 'session-1').mkdir(parents=True)
+    (tmp_path / 'private').mkdir()
+    (root / 'escape').symlink_to(tmp_path / 'private')
+
+    assert scan_folder('session-1', root=str(root)) == os.path.realpath(root / 'session-1')
+    for path in ['../private', str(tmp_path / 'private'), 'escape', '/etc', 'missing']:
+        with pytest.raises(ValueError):
+            scan_folder(path, root=str(root))
+    with pytest.raises(ValueError):
+        scan_folder('session-1', root=None)
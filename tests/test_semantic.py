@@ -0,0 +1,156 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from llm import StubLLM
+from semantic import map_questions_to_topics, parse_topic_response, classify_topics_locally, question_text
+
+TOPICS = ['Geography', 'Biology']
+
+
+def question_bank(statements):
+    return pd.DataFrame({'question_number': range(1, len(statements) + 1), 'statement': statements,
+                         'option_1': 'yes', 'option_2': 'no'})
+
+
+def answer_all(topic):
+    """Responder labeling every question of a batch prompt with topic."""
+    def respond(prompt):
+        numbers = [line.split(':')[0] for line in prompt.split('Questions:\n')[1].splitlines()]
+        return json.dumps({number: [topic] for number in numbers})
+    return respond
+
+
+def test_parse_topic_response_keeps_known_topics_only():
+    response = 'Sure! {"1": ["geography", "History"], "2": "Biology, Geography", "3": 7}'
+    assert parse_topic_response(response, [1, 2, 3, 4], TOPICS) == {
+        1: ['Geography'], 2: ['Biology', 'Geography'], 3: [], 4: []}
+    assert parse_topic_response('no JSON here', [1], TOPICS) == {1: []}
+
+
+def test_llm_labels_are_cached_but_empty_answers_are_asked_again():
+    questions_df = question_bank(['Is the Nile the longest river in Africa?', 'Do mitochondria make ATP in cells?'])
+    labeled = StubLLM(answer_all('Geography'))
+    mapped_df = map_questions_to_topics(questions_df.copy(), TOPICS, llm=labeled, method='llm')
+    assert mapped_df['mapped_topics'].tolist() == [['Geography'], ['Geography']]
+    assert len(labeled.calls) == 1
+
+    mapped_df = map_questions_to_topics(questions_df.copy(), TOPICS, llm=labeled, method='llm')
+    assert (mapped_df['topic_source'] == 'cache').all() and len(labeled.calls) == 1
+
+    unparsable = StubLLM(lambda prompt: 'I cannot answer that.')
+    unparsable.model_name = 'unparsable'
+    for _ in range(2):
+        mapped_df = map_questions_to_topics(questions_df.copy(), TOPICS, llm=unparsable, method='llm')
+        assert mapped_df['mapped_topics'].tolist() == [[], []]
+    assert len(unparsable.calls) == 2
+
+
+def two_topic_bank(n_per_topic=20):
+    """Questions with clearly separated vocabulary: the first half geography, the second half biology."""
+    places = ['Nile', 'Amazon', 'Andes', 'Sahara', 'Alps', 'Danube', 'Himalaya', 'Gobi', 'Rhine', 'Yangtze']
+    organisms = ['bacteria', 'fungi', 'neurons', 'enzymes', 'chloroplasts', 'ribosomes', 'proteins', 'viruses', 'algae', 'cells']
+    geography = [f'Which country does the {places[i % 10]} river or mountain range cross on the map of continent {i}?'
+                 for i in range(n_per_topic)]
+    biology = [f'How do {organisms[i % 10]} use metabolism and membranes to divide inside living tissue {i}?'
+               for i in range(n_per_topic)]
+    return question_bank(geography + biology)
+
+
+def test_local_classifier_is_trained_on_labeled_questions():
+    questions_df = two_topic_bank()
+    texts = [question_text(row) for _, row in questions_df.iterrows()]
+    truth = ['Geography'] * 20 + ['Biology'] * 20
+    labeled = {i: [truth[i]] for i in range(len(texts)) if i % 4}  # A quarter left for prediction
+    labels, confidence, accuracy = classify_topics_locally(texts, TOPICS, labeled)
+
+    assert accuracy >= 0.9
+    assert all(labels[i][0] == truth[i] for i in range(len(texts)) if i not in labeled)
+    assert (confidence > 0).all()
+
+
+def test_hybrid_mapping_uses_the_local_classifier_once_it_is_accurate():
+    questions_df = two_topic_bank()
+    truth = {number: ['Geography' if number <= 20 else 'Biology'] for number in questions_df['question_number']}
+    teacher = StubLLM(lambda prompt: json.dumps({line.split(':')[0]: truth[int(line.split(':')[0])]
+                                                 for line in prompt.split('Questions:\n')[1].splitlines()}))
+    teacher.model_name = 'teacher'
+    # Label all but two questions of each topic through the LLM
+    known = questions_df[~questions_df['question_number'].isin([1, 2, 21, 22])]
+    map_questions_to_topics(known.copy(), TOPICS, llm=teacher, method='llm')
+
+    mapped_df = map_questions_to_topics(questions_df.copy(), TOPICS, llm=teacher, method='hybrid', min_confidence=0)
+    assert len(teacher.calls) == 2  # Only the first run reached the LLM
+    unlabeled = mapped_df.set_index('question_number').loc[[1, 2, 21, 22]]
+    assert (unlabeled['topic_source'] == 'local').all()
+    assert unlabeled['mapped_topics'].str[0].tolist() == ['Geography', 'Geography', 'Biology', 'Biology']
+
+
+def test_questions_matching_no_topic_name_are_left_unmapped_without_the_llm():
+    questions_df = question_bank(['Is the Nile the longest river in Africa?', 'Do mitochondria make ATP in cells?'])
+
+    def fail(prompt):
+        raise ConnectionError('offline')
+
+    offline = StubLLM(fail)
+    offline.model_name = 'offline'
+    for method in ['hybrid', 'local']:
+        mapped_df = map_questions_to_topics(questions_df.copy(), TOPICS, llm=offline, method=method)
+        assert mapped_df['mapped_topics'].tolist() == [[], []]
+        assert (mapped_df['topic_source'] == 'unmapped').all()
+    assert len(offline.calls) == 1  # Only the hybrid run tried the LLM
+    with pytest.raises(ConnectionError):
+        map_questions_to_topics(questions_df.copy(), TOPICS, llm=offline, method='llm')
+
+
+def river_and_cell_bank():
+    rivers = [f'Which country does the {name} river cross?' for name in ['Nile', 'Amazon', 'Danube', 'Rhine', 'Yangtze']]
+    cells = [f'How do {kind} cells divide?' for kind in ['nerve', 'muscle', 'plant', 'stem', 'blood']]
+    return question_bank(rivers + cells)
+
+
+def test_topic_names_alone_classify_a_new_bank():
+    texts = [question_text(row) for _, row in river_and_cell_bank().iterrows()]
+    labels, confidence, accuracy = classify_topics_locally(texts, ['Rivers', 'Cells'])
+
+    assert [question_labels[0] for question_labels in labels] == ['Rivers'] * 5 + ['Cells'] * 5
+    assert (confidence > 0.1).all() and np.isnan(accuracy)
+
+
+def test_local_mapping_works_offline_on_a_new_bank():
+    offline = StubLLM(lambda prompt: '{}')
+    offline.model_name = 'never-called'
+    mapped_df = map_questions_to_topics(river_and_cell_bank(), ['Rivers', 'Cells'], llm=offline, method='local')
+
+    assert mapped_df['mapped_topics'].str[0].tolist() == ['Rivers'] * 5 + ['Cells'] * 5
+    assert (mapped_df['topic_source'] == 'local').all()
+    assert offline.calls == []
+
+
+def test_hybrid_mapping_falls_back_to_the_topic_names_when_the_llm_fails():
+    def fail(prompt):
+        raise ConnectionError('offline')
+
+    offline = StubLLM(fail)
+    offline.model_name = 'offline-hybrid'
+    mapped_df = map_questions_to_topics(river_and_cell_bank(), ['Rivers', 'Cells'], llm=offline, method='hybrid')
+
+    assert len(offline.calls) == 1  # Untrained, so the LLM is tried first
+    assert mapped_df['mapped_topics'].str[0].tolist() == ['Rivers'] * 5 + ['Cells'] * 5
+    assert (mapped_df['topic_source'] == 'local').all()
+
+
+def test_bundled_bank_is_not_guessed_from_topic_names():
+    # Character n-grams of names like 'Geography' barely match these questions, so none is labeled offline
+    data = os.path.join(os.path.dirname(__file__), os.pardir, 'data')
+    questions_df = pd.read_csv(os.path.join(data, 'questions.csv'))
+    with open(os.path.join(data, 'topics.txt')) as f:
+        topics = [topic.strip() for topic in f.read().split(',')]
+    offline = StubLLM()
+    offline.model_name = 'never-called'
+    mapped_df = map_questions_to_topics(questions_df, topics, llm=offline, method='local')
+
+    assert (mapped_df['topic_source'] == 'unmapped').all()
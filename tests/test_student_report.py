@@ -0,0 +1,41 @@
+import html
+import zipfile
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from response_matrix import ResponseMatrix
+from student_report import ClassReports, export_student_reports, report_file_names
+
+STUDENT_IDS = ['a/b', 'a_b', 'A_B', 'a b?', 'plain']
+
+
+def class_reports():
+    codes = np.array([[1, 2, 1], [1, 1, 2], [2, 2, 1], [1, 1, 1], [0, 1, 2]], dtype=np.uint8)
+    responses = ResponseMatrix(codes, np.ones(3, dtype=np.uint8), ['a', 'b'], STUDENT_IDS, [1, 2, 3])
+    question_info_df = pd.DataFrame({'question_number': [1, 2, 3], 'difficulty-rate': [0.8, 0.4, 0.6],
+                                     'mapped_topics': [['Algebra'], ['Geometry'], ['Algebra']]})
+    class_info_df = pd.DataFrame({'student_id': STUDENT_IDS, 'class': ['x', 'x', 'y', 'y', 'y']})
+    return ClassReports(responses, question_info_df, class_info_df, 'class'), question_info_df
+
+
+def test_report_file_names_are_unique():
+    names = report_file_names(STUDENT_IDS)
+
+    assert names['plain'] == 'plain'
+    assert len({name.lower() for name in names.values()}) == len(STUDENT_IDS)
+    assert all(names[sid].startswith(('a_b-', 'A_B-')) for sid in ['a/b', 'a_b', 'A_B'])
+    assert names['a b?'] == 'a_b_'  # Sanitized without a collision, so no hash
+    assert report_file_names(['a_b', 'a/b']) == {sid: names[sid] for sid in ['a_b', 'a/b']}  # Independent of order
+
+
+def test_export_writes_one_file_per_student_even_when_names_collide():
+    reports, question_info_df = class_reports()
+    archive = zipfile.ZipFile(BytesIO(export_student_reports(reports, question_info_df, student_ids=STUDENT_IDS + ['a/b'],
+                                                             max_workers=1, chunk_size=2)))
+    file_names = archive.namelist()
+
+    assert len(file_names) == len(set(file_names)) == len(STUDENT_IDS)
+    for student_id, name in report_file_names(STUDENT_IDS).items():
+        assert f"Report for Student ID: {html.escape(student_id)}" in archive.read(f"{name}.html").decode()
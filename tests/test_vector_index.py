@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import vector_index
+from cache import content_hash
+from conftest import simulate_responses
+from llm import StubLLM
+from vector_index import VectorIndex, split_passages
+from explanation import build_explanation_index, create_explanations, explanation_key, passage_text
+
+QUESTIONS = ['What is the capital of France?', 'What is the powerhouse of the cell?', 'Which gas do humans breathe in?']
+
+
+def question_bank(statements):
+    return pd.DataFrame({'question_number': range(1, len(statements) + 1), 'statement': statements,
+                         'option_1': 'Paris', 'option_2': 'Rome'})
+
+
+def test_search_finds_the_most_similar_passage(tmp_path):
+    index = VectorIndex('test', directory=str(tmp_path))
+    assert index.add(QUESTIONS) == 3
+    assert index.add(QUESTIONS[:1]) == 0  # Already indexed
+
+    results = index.search(['capital city of France', 'the cell powerhouse'], k=1, exclude_self=False)
+    assert [matches[0][0] for matches in results] == QUESTIONS[:2]
+    assert all(QUESTIONS[0] != text for text, _ in index.search(QUESTIONS[:1], k=3)[0])
+
+
+def test_writers_reload_passages_added_by_other_instances(tmp_path):
+    first = VectorIndex('test', directory=str(tmp_path))
+    second = VectorIndex('test', directory=str(tmp_path))
+    first.add(QUESTIONS[:2])
+    second.add(QUESTIONS[1:])  # Opened before the first write, must not append QUESTIONS[1] again
+
+    reopened = VectorIndex('test', directory=str(tmp_path))
+    assert [passage['text'] for passage in reopened.metadata['passages']] == QUESTIONS
+    assert os.path.getsize(reopened.embeddings_path) == reopened.embeddings.nbytes
+
+
+def test_rows_of_an_interrupted_write_are_dropped(tmp_path):
+    index = VectorIndex('test', directory=str(tmp_path))
+    index.add(QUESTIONS[:1])
+    expected = np.array(index.embeddings)
+    # Embeddings appended by a writer that died before updating the passage list
+    with open(index.embeddings_path, 'ab') as f:
+        f.write(np.ones(index.metadata['dimensions'] * 2, dtype=np.float32).tobytes())
+
+    index = VectorIndex('test', directory=str(tmp_path))
+    index.add(QUESTIONS[1:])
+    assert np.array_equal(index.embeddings[:1], expected)
+    assert os.path.getsize(index.embeddings_path) == index.embeddings.nbytes
+    assert [matches[0][0] for matches in index.search(QUESTIONS, k=1, exclude_self=False)] == QUESTIONS
+
+
+def test_search_within_a_scope_only_returns_its_passages(tmp_path):
+    index = VectorIndex('test', directory=str(tmp_path))
+    index.add(QUESTIONS)
+    scope = {content_hash(text) for text in QUESTIONS[1:]}
+
+    results = index.search(['capital city of France'], k=3, exclude_self=False, within=scope)[0]
+    assert sorted(text for text, _ in results) == sorted(QUESTIONS[1:])
+    assert index.search(['capital city of France'], within=set()) == [[]]
+
+
+def test_explanation_index_is_shared_and_searched_per_bank(monkeypatch):
+    calls = []
+    real_embed = vector_index.embed_texts
+    monkeypatch.setattr(vector_index, 'embed_texts', lambda texts: calls.append(len(texts)) or real_embed(texts))
+    bank = question_bank(QUESTIONS[:2])
+    edited_bank = question_bank([QUESTIONS[0], QUESTIONS[2]])
+
+    index, scope = build_explanation_index(bank, name='test-shared')
+    edited_index, edited_scope = build_explanation_index(edited_bank, name='test-shared')
+    assert edited_index.directory == index.directory and len(edited_index) == 3
+    assert calls == [2, 1]  # Only the edited question is embedded again
+
+    passage_texts = [passage_text(row) for _, row in edited_bank.iterrows()]
+    for matches in edited_index.search(passage_texts, k=3, within=edited_scope):
+        assert {text for text, _ in matches} <= set(passage_texts)
+
+
+def test_explanations_are_cached_by_their_retrieved_passages():
+    llm = StubLLM(lambda prompt: 'Because it is.')
+    llm.model_name = 'explainer'
+    responses = simulate_responses([1, 1], [0, 0], n_examinees=10)
+    bank = question_bank(QUESTIONS[:2])
+
+    index, scope = build_explanation_index(bank, name='test-cached')
+    explanations = create_explanations(bank, responses, llm=llm, index=index, scope=scope)
+    assert explanations == {question: 'Because it is.' for question in QUESTIONS[:2]}
+    assert len(llm.calls) == 2
+
+    # Another bank growing the shared index does not invalidate this bank's explanations
+    build_explanation_index(question_bank(QUESTIONS[1:]), name='test-cached')
+    index, scope = build_explanation_index(bank, name='test-cached')
+    create_explanations(bank, responses, llm=llm, index=index, scope=scope)
+    assert len(llm.calls) == 2
+
+    assert explanation_key(QUESTIONS[0], 'Paris', llm) != explanation_key(QUESTIONS[0], 'Paris', llm, ['A passage.'])
+    assert explanation_key(QUESTIONS[0], 'Paris', llm, ('A passage.',)) == explanation_key(QUESTIONS[0], 'Paris', llm, ['A passage.'])
+
+
+def test_split_passages_respects_the_size_limit():
+    text = '\n\n'.join(f'Paragraph {i}. ' + 'word ' * 60 for i in range(10))
+    passages = split_passages(text, max_chars=400)
+    assert len(passages) > 1 and all(len(passage) <= 400 for passage in passages)